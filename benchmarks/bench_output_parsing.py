@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Compare the per-command cost of parsing ``reduce`` output with the
+single-pass :mod:`driveami.parsing` registry, against the previous approach
+of splitting the output twice and rescanning it once per matching parser.
+
+Run from the repository root::
+
+    python benchmarks/bench_output_parsing.py
+"""
+from __future__ import print_function
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import driveami.parsing as parsing
+from sample_outputs import script_outputs
+
+
+def legacy_parse(command, output):
+    """The parsing previously done in ``Reduce.run_command``."""
+    output.split('\n')  # (Formerly split once for logging, once for parsing)
+    lines = output.split('\n')
+    results = {}
+    if 'file ' in command:
+        results['incomplete'] = any('incomplete observation' in line
+                                    for line in lines)
+    if 'apply rain' in command:
+        for line in lines:
+            if "Mean amplitude correction factor" in line:
+                results['rain'] = float(line.strip().split()[-1])
+                break
+    if 'flag' in command:
+        for line in lines:
+            if "samples flagged" in line and "Total of" in line:
+                results['flagging'] = float(
+                    [t for t in line.split() if '%' in t][0].strip('%'))
+                break
+    if 'reweight' in command:
+        for line in lines:
+            if "estimated noise" in line:
+                results['est_noise'] = float(line.strip().split()[-2])
+                break
+    if 'cal inter' in command:
+        for line in lines:
+            if 'fluxes for this source not available' in line:
+                results['archive_cal_unavailable'] = True
+            if 'days apart' in line:
+                results['archive_cal_days_apart'] = float(line.split()[6])
+    return results
+
+
+def registry_parse(command, output):
+    parsing.default_parser.parse(command, output)
+    return output.split('\n')  # (Lines are still returned by run_command)
+
+
+def main():
+    print("{:>10} {:>14} {:>14} {:>8}".format(
+        'lines/cmd', 'legacy (us)', 'registry (us)', 'speedup'))
+    for n_lines in (100, 1000, 10000):
+        outputs = [(cmd, '\n'.join(lines))
+                   for cmd, lines in script_outputs(n_lines)]
+        n_cmds = len(outputs)
+        repeats = max(3, 30000 // n_lines)
+
+        def run(parse):
+            for cmd, output in outputs:
+                parse(cmd, output)
+
+        legacy = min(timeit.repeat(lambda: run(legacy_parse),
+                                   number=repeats, repeat=3))
+        registry = min(timeit.repeat(lambda: run(registry_parse),
+                                     number=repeats, repeat=3))
+        per_cmd = 1e6 / (repeats * n_cmds)
+        print("{:>10} {:>14.1f} {:>14.1f} {:>7.2f}x".format(
+            n_lines, legacy * per_cmd, registry * per_cmd, legacy / registry))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
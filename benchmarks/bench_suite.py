@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""
+End-to-end throughput benchmarks, run against the fake ``reduce`` of
+:mod:`driveami.testing`, with results saved as JSON and compared against a
+stored baseline.
+
+Cases:
+
+- ``update_files/<N>``: :meth:`.Reduce.update_files` on an archive of N files
+  (default and high-throughput mode).
+- ``load_obs_info/<N>``: :meth:`.Reduce.load_obs_info` over N files.
+- ``group_by_target_id/<N>``, ``group_by_pointing/<N>``: grouping synthetic
+  pointings, via :meth:`.Reduce.group_obs_by_target_id` and
+  :meth:`.Reduce.group_target_ids_by_pointing`.
+- ``process_rawfile``: rawfiles reduced per second by a single session.
+- ``save_listing/<N>``, ``load_listing/<N>``: JSON rawfile listings.
+
+Run from the repository root, e.g.::
+
+    # Check for regressions against benchmarks/baseline.json:
+    python benchmarks/bench_suite.py -o results.json
+
+    # Record a new baseline:
+    python benchmarks/bench_suite.py --save-baseline
+
+Each case is run ``--repeats`` times, keeping the best time (the least
+disturbed by other load on the machine). The exit status is 1 if any case
+is slower than the baseline by more than the tolerance, and by more than
+the ``--noise-floor`` in absolute terms (so millisecond-scale cases are not
+flagged on scheduler jitter alone). (Timings are only comparable on the
+same machine, so re-record the baseline when moving hosts.)
+"""
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import driveami
+import driveami.keys as keys
+from driveami.reduce import RaDecPair
+from driveami.testing import fakereduce, make_fake_ami_rootdir
+
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'baseline.json')
+
+
+class FakeArchive(object):
+    """A fake AMI rootdir listing ``n_files`` rawfiles."""
+
+    def __init__(self, n_files, **config):
+        self.tempdir = tempfile.mkdtemp(prefix='drvami')
+        self.rootdir = make_fake_ami_rootdir(
+            os.path.join(self.tempdir, 'ami'), create_rawfiles=False,
+            n_files=n_files, n_targets=max(n_files // 10, 1), **config)
+
+    def spawn(self, **kwargs):
+        return driveami.Reduce(self.rootdir, 'legacy',
+                               working_dir=self.tempdir, timeout=600,
+                               **kwargs)
+
+    def close(self):
+        shutil.rmtree(self.tempdir)
+
+
+def synthetic_files(n_files):
+    """
+    File info for ``n_files`` rawfiles, as loaded by
+    :meth:`.Reduce.load_obs_info` (but without querying ``reduce``).
+    """
+    config = dict(fakereduce.default_config, n_files=n_files,
+                  n_targets=max(n_files // 10, 1))
+    files = {}
+    for obs in fakereduce.archive(config):
+        ut = tuple(fakereduce._mjd_epoch + datetime.timedelta(days=mjd)
+                   for mjd in (obs['mjd_start'], obs['mjd_end']))
+        files[obs['name']] = {
+            keys.pointing_degrees: RaDecPair(obs['ra_hours'] * 15,
+                                             obs['dec_deg']),
+            keys.pointing_hms_dms: RaDecPair(
+                fakereduce._sexagesimal(obs['ra_hours']).replace(' ', ':'),
+                fakereduce._sexagesimal(obs['dec_deg'], sign=True)
+                .replace(' ', ':')),
+            keys.calibrator: obs['calibrator'],
+            keys.field: obs['field'],
+            keys.raster: obs['raster'],
+            keys.time_mjd: (obs['mjd_start'], obs['mjd_end']),
+            keys.time_ut: ut,
+            keys.time_st: ('00:00:00', '01:00:00'),
+            keys.duration: (obs['mjd_end'] - obs['mjd_start']) * 24,
+        }
+    return files
+
+
+def offline_reduce(files):
+    """A :class:`.Reduce` holding ``files``, with no child process."""
+    r = driveami.Reduce.__new__(driveami.Reduce)
+    r.files = files
+    return r
+
+
+def bench_update_files(n_files, high_throughput):
+    archive = FakeArchive(n_files)
+    try:
+        r = archive.spawn(high_throughput=high_throughput)
+        start = timeit.default_timer()
+        r.update_files()
+        seconds = timeit.default_timer() - start
+        assert len(r.files) == n_files
+        r.__exit__(None, None, None)
+    finally:
+        archive.close()
+    return seconds
+
+
+def bench_load_obs_info(n_files, workers):
+    archive = FakeArchive(n_files, incomplete_every=100)
+    try:
+        r = archive.spawn(high_throughput=True)
+        start = timeit.default_timer()
+        r.load_obs_info(workers=workers)
+        seconds = timeit.default_timer() - start
+        r.__exit__(None, None, None)
+    finally:
+        archive.close()
+    return seconds
+
+
+def bench_grouping(n_files):
+    r = offline_reduce(synthetic_files(n_files))
+    start = timeit.default_timer()
+    id_groups = r.group_obs_by_target_id()
+    by_id = timeit.default_timer() - start
+    start = timeit.default_timer()
+    r.group_target_ids_by_pointing(id_groups)
+    by_pointing = timeit.default_timer() - start
+    return by_id, by_pointing
+
+
+def bench_process_rawfile(n_files, output_lines):
+    archive = FakeArchive(n_files, output_lines=output_lines)
+    output_dir = os.path.join(archive.tempdir, 'out')
+    try:
+        r = archive.spawn(high_throughput=True)
+        rawfiles = sorted(r.files)
+        start = timeit.default_timer()
+        for rawfile in rawfiles:
+            driveami.process_rawfile(rawfile, output_dir, r,
+                                     driveami.scripts.standard_legacy_reduction)
+        seconds = timeit.default_timer() - start
+        r.__exit__(None, None, None)
+    finally:
+        archive.close()
+    return seconds
+
+
+def bench_listing(n_files):
+    listing = dict((fname, driveami.make_serializable(info))
+                   for fname, info in synthetic_files(n_files).items())
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, 'listing.json')
+    try:
+        start = timeit.default_timer()
+        with open(path, 'w') as f:
+            driveami.save_rawfile_listing(listing, f)
+        save = timeit.default_timer() - start
+        start = timeit.default_timer()
+        with open(path) as f:
+            loaded, _ = driveami.load_listing(f)
+        load = timeit.default_timer() - start
+        assert len(loaded) == n_files
+    finally:
+        shutil.rmtree(tempdir)
+    return save, load
+
+
+def best_of(repeats, bench, *args):
+    """
+    Run ``bench(*args)`` ``repeats`` times, returning the shortest time
+    (or for benchmarks timing several things at once, the shortest of each).
+    """
+    runs = [bench(*args) for _ in range(repeats)]
+    if isinstance(runs[0], tuple):
+        return tuple(min(times) for times in zip(*runs))
+    return min(runs)
+
+
+def run_suite(options):
+    results = {}
+    repeats = options.repeats
+
+    def record(name, seconds, items):
+        results[name] = {'seconds': seconds, 'items': items,
+                         'items_per_second': items / seconds}
+        print("{:<40} {:>10.3f} s {:>14.1f} /s".format(
+            name, seconds, items / seconds))
+        sys.stdout.flush()
+
+    for n in options.listing_sizes:
+        record('update_files/{}'.format(n),
+               best_of(repeats, bench_update_files, n, False), n)
+        record('update_files_high_throughput/{}'.format(n),
+               best_of(repeats, bench_update_files, n, True), n)
+    for n in options.obs_info_sizes:
+        record('load_obs_info/{}'.format(n),
+               best_of(repeats, bench_load_obs_info, n, options.workers), n)
+    for n in options.listing_sizes:
+        by_id, by_pointing = best_of(repeats, bench_grouping, n)
+        record('group_by_target_id/{}'.format(n), by_id, n)
+        record('group_by_pointing/{}'.format(n), by_pointing, n)
+    record('process_rawfile',
+           best_of(repeats, bench_process_rawfile, options.rawfiles,
+                   options.output_lines),
+           options.rawfiles)
+    for n in options.listing_sizes:
+        save, load = best_of(repeats, bench_listing, n)
+        record('save_listing/{}'.format(n), save, n)
+        record('load_listing/{}'.format(n), load, n)
+    return results
+
+
+def compare(results, baseline, tolerance, noise_floor=0.):
+    """
+    Returns:
+        list: ``(name, ratio)`` for each case slower than ``baseline`` by
+        more than ``tolerance`` (as a fraction), and by more than
+        ``noise_floor`` seconds.
+    """
+    regressions = []
+    print("\n{:<40} {:>10} {:>10} {:>8}".format(
+        'vs. baseline', 'base (s)', 'now (s)', 'ratio'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name]['seconds'] / baseline[name]['seconds']
+        slowdown = results[name]['seconds'] - baseline[name]['seconds']
+        flag = ''
+        if ratio > 1 + tolerance and slowdown > noise_floor:
+            regressions.append((name, ratio))
+            flag = '  <-- REGRESSION'
+        print("{:<40} {:>10.3f} {:>10.3f} {:>8.2f}{}".format(
+            name, baseline[name]['seconds'], results[name]['seconds'],
+            ratio, flag))
+    return regressions
+
+
+def handle_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Throughput benchmarks against a fake reduce.")
+    parser.add_argument('-o', '--output',
+                        help="Write the results to this JSON file.")
+    parser.add_argument('--baseline', default=default_baseline,
+                        help="Baseline results to compare against "
+                             "(default: %(default)s).")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="Write the results to the baseline file, "
+                             "rather than comparing against it.")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Fractional slowdown allowed before a case "
+                             "counts as a regression (default: %(default)s).")
+    parser.add_argument('--noise-floor', type=float, default=0.01,
+                        help="Slowdown (seconds) below which a case never "
+                             "counts as a regression, however large the "
+                             "ratio (default: %(default)s).")
+    parser.add_argument('--repeats', type=int, default=3,
+                        help="Times each case is run; the best time is kept "
+                             "(default: %(default)s).")
+    parser.add_argument('--listing-sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000],
+                        help="Archive sizes for the listing, grouping and "
+                             "serialization cases.")
+    parser.add_argument('--obs-info-sizes', type=int, nargs='+',
+                        default=[1000],
+                        help="Archive sizes for load_obs_info (which queries "
+                             "each file in turn, so is far slower).")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="Sessions used by load_obs_info.")
+    parser.add_argument('--rawfiles', type=int, default=5,
+                        help="Rawfiles reduced in the process_rawfile case.")
+    parser.add_argument('--output-lines', type=int, default=200,
+                        help="Filler lines output by each reduction command.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = handle_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+    results = run_suite(options)
+    doc = {'meta': {'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'driveami': driveami.__version__,
+                    'date': datetime.datetime.utcnow().isoformat(),
+                    'repeats': options.repeats},
+           'results': results}
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(doc, f, sort_keys=True, indent=4)
+    if options.save_baseline:
+        with open(options.baseline, 'w') as f:
+            json.dump(doc, f, sort_keys=True, indent=4)
+        print("Saved baseline to", options.baseline)
+        return 0
+    if not os.path.exists(options.baseline):
+        print("No baseline at", options.baseline)
+        return 0
+    with open(options.baseline) as f:
+        baseline = json.load(f)['results']
+    regressions = compare(results, baseline, options.tolerance,
+                          options.noise_floor)
+    if regressions:
+        print("\n{} regression(s) beyond {:.0%}".format(
+            len(regressions), options.tolerance))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
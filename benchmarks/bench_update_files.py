@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Time :meth:`.Reduce.update_files` against the fake ``reduce`` (see
+:mod:`driveami.testing`) listing archives of increasing size, with and
+without high-throughput mode.
+
+In high-throughput mode the time per listed file should stay roughly
+constant as the archive grows, i.e. ``update_files`` scales linearly. This
+is checked coarsely: the script exits with status 1 if the high-throughput
+time per file at the largest size is more than ``--max-ratio`` times that
+at the smallest (which should be at least ten times smaller).
+
+Run from the repository root::
+
+    python benchmarks/bench_update_files.py
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import driveami
+from driveami.testing import make_fake_ami_rootdir
+
+
+def time_update_files(n_files, high_throughput):
+    tempdir = tempfile.mkdtemp(prefix='drvami')
+    try:
+        rootdir = make_fake_ami_rootdir(
+            os.path.join(tempdir, 'ami'), create_rawfiles=False,
+            n_files=n_files, n_targets=max(n_files // 10, 1))
+        # (Runs update_files once as it starts; time a second run)
+        with driveami.Reduce(rootdir, 'legacy', working_dir=tempdir,
+                             timeout=600,
+                             high_throughput=high_throughput) as r:
+            start = time.time()
+            r.update_files()
+            elapsed = time.time() - start
+            assert len(r.files) == n_files
+    finally:
+        shutil.rmtree(tempdir)
+    return elapsed
+
+
+def handle_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Time update_files against a fake reduce.")
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[5000, 10000, 20000, 40000, 80000],
+                        help="Archive sizes to time.")
+    parser.add_argument('--max-ratio', type=float, default=2.0,
+                        help="Largest allowed ratio of the high-throughput "
+                             "time per file at the largest size to that at "
+                             "the smallest (default: %(default)s).")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = handle_args(argv)
+    sizes = sorted(options.sizes)
+    print("{:>8} {:>16} {:>16} {:>20}".format(
+        'files', 'default (s)', 'high-thru (s)', 'high-thru (us/file)'))
+    per_file = []
+    for n_files in sizes:
+        default = time_update_files(n_files, high_throughput=False)
+        high_thru = time_update_files(n_files, high_throughput=True)
+        per_file.append(high_thru / n_files)
+        print("{:>8} {:>16.3f} {:>16.3f} {:>20.1f}".format(
+            n_files, default, high_thru, 1e6 * per_file[-1]))
+    if sizes[-1] < 10 * sizes[0]:
+        print("\nSizes span less than a factor of ten, "
+              "so not checking the scaling")
+        return 0
+    ratio = per_file[-1] / per_file[0]
+    print("\nHigh-throughput time per file at {} files is {:.2f}x that at "
+          "{}".format(sizes[-1], ratio, sizes[0]))
+    if ratio > options.max_ratio:
+        print("Worse than linear scaling (ratio above {})".format(
+            options.max_ratio))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
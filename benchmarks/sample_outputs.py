@@ -0,0 +1,69 @@
+"""
+Representative ``reduce`` command outputs, as captured in ``.ami.log`` files.
+
+The verbose per-sample chatter is replaced by generated filler lines of
+realistic length, so the size of each output can be scaled.
+"""
+from __future__ import print_function
+
+
+def _filler(n_lines, tag):
+    return ['  {} {:6d}  baseline {:3d}  chan {:2d}  amp {:8.4f}  '
+            'phase {:8.3f}'.format(tag, i, i % 45, i % 8, 0.01 * (i % 97),
+                                   (i * 7.3) % 360)
+            for i in range(n_lines)]
+
+
+def file_output():
+    return ['',
+            ' Reading file SWIFT_590206-140305.raw',
+            ' SWIFT_590206   field observation with calibrator 3C286',
+            ' Tracking    : 15 35 42.34  +23 22 31.2  J2000',
+            '               05/03/2014',
+            ' Start time  : 13.55.49  ST 21.31.07  MJD  56721.58043  ',
+            ' Stop time   : 15.00.50  ST 22.36.18  MJD  56721.62558  ',
+            '']
+
+
+def flag_output(n_lines, percent=12.3):
+    return (_filler(n_lines, 'flag') +
+            [' Total of    123456 samples flagged ( {:.2f}% )'.format(
+                percent)])
+
+
+def rain_output(n_lines):
+    return (_filler(n_lines, 'rain') +
+            [' Mean amplitude correction factor  1.0213'])
+
+
+def cal_inter_output(n_lines):
+    return (_filler(n_lines, 'cal') +
+            [' Nearest flux cal 3C286 obs at 1.25 days apart',
+             ' Nearest flux cal 3C286 obs at 0.83 days apart'])
+
+
+def reweight_output(n_lines):
+    return (_filler(n_lines, 'rwt') +
+            [' Overall estimated noise  0.00123 Jy'])
+
+
+def scan_output(n_lines):
+    return _filler(n_lines, 'scan')
+
+
+def script_outputs(n_lines):
+    """
+    ``(command, output_lines)`` pairs covering the metric-bearing commands
+    of a typical reduction script, each with ``n_lines`` of filler output.
+    """
+    return [
+        (r'file SWIFT_590206-140305.raw \ ', file_output()),
+        ('flag all', flag_output(n_lines, 5.0)),
+        (r'flag amp field no \ ', flag_output(n_lines, 8.1)),
+        (r'apply rain \ ', rain_output(n_lines)),
+        (r'cal inter \ ', cal_inter_output(n_lines)),
+        (r'reweight \ ', reweight_output(n_lines)),
+        (r'show flagging no yes \ ', flag_output(n_lines, 12.3)),
+        (r'scan dat cal yes \ ', scan_output(n_lines)),
+        (r'scan dat field yes \ ', scan_output(n_lines)),
+    ]
@@ -6,10 +6,13 @@ import datetime
 import logging
 import os
 import sys
+import timeit
 
 import driveami
 from driveami.environments import (
     default_ami_dir, default_ami_version, default_output_dir)
+from driveami.store import is_store
+from driveami.supervisor import RestartLog, SupervisedReduce
 
 _DESCRIPTION = """
 Calibrate raw AMI data and produce uvFITs.
@@ -18,11 +21,23 @@ This will load up the AMI-REDUCE environment
 and apply the same reduction script to all listed files, outputting to 
 group directories. (See `scripts.py` in source for default scripts.)
 
-Filenames can be supplied via a grouped-file JSON listing, or specified 
+Filenames can be supplied via a grouped-file JSON listing (or a grouping
+held in a listing store, see `--grouping`), or specified
 explicitly on the command line (see `-f/--files` option).
 
 A listing of the calibrated output files is produced,
 which can then be passed on to (e.g.) imaging scripts.
+Use `--select` to process just a few groups of a large listing.
+With `--listing-format jsonl`, each rawfile is appended to the listing
+as soon as it is calibrated (rather than all at once at the end).
+
+Each calibrated rawfile is also recorded in a journal in the topdir
+(`calibrate_journal.jsonl`). If a run is interrupted, re-run it with
+`--resume` to carry on from where it stopped.
+
+With `--verify-uvfits` (or `--compress-uvfits`), the UVFITS of each rawfile
+are checksummed, checked and (optionally) gzipped in background threads,
+while the next rawfile is reduced; the results are recorded in the listing.
 
 
 """
@@ -40,7 +55,17 @@ def handle_args():
     parser.add_argument('groups_file', metavar='groups_to_process.json',
                         nargs='?',
                         help='Specify file listing rawfiles for processing '
-                             '(overrides all other file options)')
+                             '(overrides all other file options). May also '
+                             'be a listing store (SQLite database)')
+
+    parser.add_argument('--grouping', default='target_id',
+                        help='Grouping to process, when reading groups '
+                             'from a listing store')
+
+    parser.add_argument('--select', nargs='+', metavar='GROUP', default=None,
+                        help='Process only these groups of the groups file. '
+                             '(Only the selected groups are loaded, using a '
+                             'cached offset index of the listing)')
 
     parser.add_argument("-t", "--topdir", default=default_output_dir,
                         help="Top level data-output directory")
@@ -49,6 +74,11 @@ def handle_args():
                         help='Specify filename for output listing of calibrated '
                              'data.')
 
+    parser.add_argument('--listing-format', default='json',
+                        choices=['json', 'jsonl'],
+                        help='Format of the output listing. jsonl (JSON '
+                             'Lines) appends each rawfile as it completes')
+
     parser.add_argument("--amidir", default=default_ami_dir,
                         help="Path to AMI directory")
 
@@ -66,6 +96,55 @@ def handle_args():
     parser.add_argument('-g', '--group', dest='groupname', default='NOGROUP',
                         help='Specify group name for individually specified files')
 
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the rawfiles recorded as calibrated in '
+                             'the journal of a previous (interrupted) run '
+                             'in topdir, and include them in the output '
+                             'listing')
+
+    parser.add_argument('--force', action='store_true',
+                        help='Reduce every rawfile, even if its existing '
+                             'outputs are up to date')
+
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of AMI-reduce sessions to run in parallel')
+
+    parser.add_argument('--metrics-dir', default=None,
+                        help='Directory for the per-command timing summary '
+                             '(JSON) and Prometheus textfile. '
+                             'Default: same as topdir')
+
+    parser.add_argument('--timeout-policy', default=None,
+                        metavar='POLICY.json',
+                        help='Learn per-command timeouts from the command '
+                             'latencies recorded in this file (created if '
+                             'need be, and updated after the run), rather '
+                             'than applying a fixed timeout. '
+                             'E.g. ~/.driveami_timeouts.json')
+
+    parser.add_argument('--stall-timeout', type=float, default=None,
+                        metavar='SECONDS',
+                        help='Abort any command (restarting its reduce '
+                             'session) which produces no output for this '
+                             'long, and let commands which keep producing '
+                             'output run past their timeout')
+
+    parser.add_argument('--verify-uvfits', action='store_true',
+                        help='Checksum and verify the structure of each '
+                             'UVFITS written, in the background')
+
+    parser.add_argument('--compress-uvfits', action='store_true',
+                        help='Also gzip each UVFITS written, in the '
+                             'background (implies --verify-uvfits)')
+
+    parser.add_argument('--post-write-workers', type=int, default=2,
+                        help='Number of threads used to verify/compress '
+                             'UVFITS')
+
+    parser.add_argument('--trace', default=None,
+                        help='Write a Chrome trace-event timeline of the '
+                             'reduce sessions to this file')
+
     # parser.add_argument('-r', '--array', default='LA',
     #                     help='Specify array (SA/LA) for individually specified files')
 
@@ -77,7 +156,20 @@ def handle_args():
         with open(options.script) as f:
             options.script = f.read()
 
-    if options.groups_file:
+    if options.groups_file and is_store(options.groups_file):
+        print("Reducing files in grouping '{}' of store: {}".format(
+            options.grouping, options.groups_file))
+        with driveami.ListingStore(options.groups_file) as store:
+            data_groups = store.groups(options.grouping, names=options.select)
+        _check_selected(parser, options, data_groups)
+    elif options.groups_file and options.select:
+        print("Reducing selected groups listed in:", options.groups_file)
+        with driveami.open_listing(
+                options.groups_file,
+                expected_datatype=driveami.Datatype.ami_la_raw) as listing:
+            _check_selected(parser, options, listing)
+            data_groups = listing.select(options.select)
+    elif options.groups_file:
         print("Reducing files listed in:", options.groups_file)
         with open(options.groups_file) as f:
             data_groups, _ = driveami.load_listing(f,
@@ -92,6 +184,14 @@ def handle_args():
     return options, data_groups
 
 
+def _check_selected(parser, options, groups):
+    if options.select:
+        missing = [name for name in options.select if name not in groups]
+        if missing:
+            parser.error("Group(s) not found in {}: {}".format(
+                options.groups_file, ', '.join(missing)))
+
+
 def output_preamble_to_log(data_groups):
     logger.info("*************************************")
     logger.info("Processing with AMI reduce:\n"
@@ -106,64 +206,332 @@ def output_preamble_to_log(data_groups):
 
 def process_data_groups(data_groups, output_dir, ami_dir, ami_version,
                         array='LA',
-                        script=None):
+                        script=None,
+                        jobs=1,
+                        force=False,
+                        on_processed=None,
+                        restart_log=None,
+                        timeout_policy=None,
+                        stall_timeout=None,
+                        post_write=None):
     """Args:
     data_groups: Dictionary mapping groupname -> list of raw filenames
     output_dir: Folder where dataset group subfolders will be created.
     ami_dir: Top dir of the AMI ``reduce`` installation.
     array: 'LA' or 'SA' (Default: LA)
+    jobs: Number of AMI-reduce sessions to run in parallel.
+    force: Reduce every rawfile, even those whose outputs are recorded as
+        up to date in the group's manifest.
+    on_processed: Optional callback, ``on_processed(rawfile, file_info)``.
+        If supplied, the (serializable) info for each rawfile is passed to
+        it as soon as the rawfile is processed, rather than collected in
+        the returned dict.
+    restart_log: Optional :class:`driveami.supervisor.RestartLog`, recording
+        the reduce sessions restarted after hanging or dying. (The rawfile
+        in progress is skipped, and the group carries on with a fresh
+        session.)
+    timeout_policy: Optional :class:`driveami.timeouts.TimeoutPolicy`, used
+        by every reduce session.
+    stall_timeout: Seconds without output before a command is taken to have
+        stalled (see :class:`driveami.Reduce`).
+    post_write: Optional :class:`driveami.postwrite.PostWritePipeline`.
+        If supplied, each rawfile's UVFITS are handed to it, and the rawfile
+        is passed on (to ``on_processed``) once they are done. Waits for
+        the pipeline before returning.
     """
+    if restart_log is None:
+        restart_log = RestartLog()
     if not script:
         if ami_version == 'legacy':
             script = driveami.scripts.standard_legacy_reduction
         else:
             script = driveami.scripts.standard_digital_reduction
 
+    if jobs > 1:
+        return process_data_groups_in_parallel(data_groups, output_dir,
+                                               ami_dir, ami_version,
+                                               array=array, script=script,
+                                               jobs=jobs, force=force,
+                                               on_processed=on_processed,
+                                               restart_log=restart_log,
+                                               timeout_policy=timeout_policy,
+                                               stall_timeout=stall_timeout,
+                                               post_write=post_write)
+
     processed_files_info = {}
     for grp_name in sorted(data_groups.keys()):
 
         try:
-            r = driveami.Reduce(ami_dir, ami_version, array=array)
+            session = SupervisedReduce(
+                driveami.Reduce(ami_dir, ami_version, array=array,
+                                timeout_policy=timeout_policy,
+                                stall_timeout=stall_timeout),
+                restart_log)
             files = data_groups[grp_name][driveami.keys.files]
             grp_dir = os.path.join(output_dir, grp_name, 'ami')
             driveami.ensure_dir(grp_dir)
+            manifest = driveami.ResultManifest.for_output_dir(grp_dir)
             logger.info(
                 'Calibrating rawfiles and writing to {}'.format(grp_dir))
             for rawfile in files:
                 try:
                     logger.info("Reducing rawfile %s ...", rawfile)
-                    file_info = driveami.process_rawfile(rawfile,
-                                                         output_dir=grp_dir,
-                                                         reduce=r,
-                                                         script=script)
+                    file_info = session.process_rawfile(rawfile,
+                                                        output_dir=grp_dir,
+                                                        script=script,
+                                                        manifest=manifest,
+                                                        force=force)
                 except (ValueError, IOError) as e:
                     logger.exception("Hit exception reducing file: %s\n"
                                      "Exception reads:\n%s\n",
                                      rawfile, e)
                     continue
-                # Also save the group assignment in the listings:
-                file_info[driveami.keys.group_name] = grp_name
-                processed_files_info[rawfile] = driveami.make_serializable(
-                    file_info)
+                if file_info is None:
+                    continue
+                _record_processed(processed_files_info, on_processed,
+                                  rawfile, grp_name, file_info,
+                                  output_dir=grp_dir, post_write=post_write)
         except Exception as e:
             logger.exception(
                 "Hit exception (probable timeout) reducing group: {}".format(
                     grp_name))
             continue
+    if post_write is not None:
+        post_write.wait()
+    return processed_files_info
+
+
+def _record_processed(processed_files_info, on_processed, rawfile, grp_name,
+                      file_info, output_dir=None, post_write=None):
+    # Also save the group assignment in the listings:
+    file_info[driveami.keys.group_name] = grp_name
+
+    def deliver(rawfile, file_info):
+        file_info = driveami.make_serializable(file_info)
+        if on_processed is not None:
+            on_processed(rawfile, file_info)
+        else:
+            processed_files_info[rawfile] = file_info
+
+    if post_write is not None:
+        post_write.submit(rawfile, file_info, output_dir=output_dir,
+                          on_done=deliver)
+    else:
+        deliver(rawfile, file_info)
+
+
+def process_data_groups_in_parallel(data_groups, output_dir, ami_dir,
+                                    ami_version, array, script, jobs,
+                                    force=False, on_processed=None,
+                                    restart_log=None, timeout_policy=None,
+                                    stall_timeout=None, post_write=None):
+    """
+    As for :func:`process_data_groups`, but shares the rawfiles out
+    amongst a pool of ``jobs`` AMI-reduce sessions.
+    """
+    rawfile_jobs = []
+    for grp_name in sorted(data_groups.keys()):
+        grp_dir = os.path.join(output_dir, grp_name, 'ami')
+        driveami.ensure_dir(grp_dir)
+        for rawfile in data_groups[grp_name][driveami.keys.files]:
+            rawfile_jobs.append(driveami.RawfileJob(rawfile=rawfile,
+                                                    output_dir=grp_dir,
+                                                    script=script,
+                                                    group_name=grp_name))
+    logger.info('Calibrating %s rawfiles with %s parallel sessions',
+                len(rawfile_jobs), jobs)
+
+    processed_files_info = {}
+
+    def record(job, file_info):
+        _record_processed(processed_files_info, on_processed, job.rawfile,
+                          job.group_name, file_info,
+                          output_dir=job.output_dir, post_write=post_write)
+
+    with driveami.ReducePool(jobs, ami_dir, ami_version, array=array,
+                             restart_log=restart_log,
+                             timeout_policy=timeout_policy,
+                             stall_timeout=stall_timeout) as pool:
+        pool.process_rawfiles(rawfile_jobs, incremental=True, force=force,
+                              on_result=record)
+    if post_write is not None:
+        post_write.wait()
     return processed_files_info
 
 
+class IncrementalListing(object):
+    """
+    Appends the info for each calibrated rawfile to a JSON Lines listing as
+    it completes (so nothing accumulates in memory over the run).
+    """
+
+    def __init__(self, path):
+        self.writer = driveami.ListingWriter.open(
+            path, driveami.Datatype.ami_la_calibrated)
+
+    def __call__(self, rawfile, file_info):
+        # (As for save_calfile_listing)
+        file_info.pop(driveami.keys.raw_obs_text, None)
+        self.writer.write(rawfile, file_info)
+
+    def close(self):
+        self.writer.close()
+
+
+class CalibrationJournal(object):
+    """
+    Append-only record (a JSON Lines listing) of the rawfiles calibrated
+    into an output topdir, synced to disk as each completes. So if a run is
+    interrupted, at most the rawfile in progress is lost.
+
+    With ``resume``, the rawfiles recorded by the previous run are loaded
+    into :attr:`completed`, and the journal is extended; otherwise it is
+    started afresh.
+    """
+    basename = 'calibrate_journal.jsonl'
+
+    def __init__(self, topdir, resume=False):
+        driveami.ensure_dir(topdir)
+        self.path = os.path.join(topdir, self.basename)
+        self.completed = {}
+        if resume and os.path.exists(self.path):
+            self.completed = self.load()
+        self.writer = driveami.ListingWriter.open(
+            self.path, driveami.Datatype.ami_la_calibrated,
+            append=resume, sync=True)
+        # Tallies for the rawfiles calibrated in this run:
+        self.timings = driveami.CommandTimings()
+        self.n_rawfiles = 0
+        # (Those skipped as up to date are only counted.)
+        self.n_skipped = 0
+
+    def load(self):
+        with open(self.path) as f:
+            listing, _ = driveami.load_listing(
+                f, expected_datatype=driveami.Datatype.ami_la_calibrated)
+        return listing
+
+    def remaining(self, data_groups):
+        """``data_groups``, less the rawfiles already completed."""
+        remaining = {}
+        for grp_name, group in data_groups.items():
+            files = [rawfile for rawfile in group[driveami.keys.files]
+                     if rawfile not in self.completed]
+            if files:
+                remaining[grp_name] = dict(group)
+                remaining[grp_name][driveami.keys.files] = files
+        return remaining
+
+    def __call__(self, rawfile, file_info):
+        if file_info.pop(driveami.keys.skipped, False):
+            self.n_skipped += 1
+        else:
+            self.timings.add_file_info(file_info)
+            self.n_rawfiles += 1
+        # (As for save_calfile_listing)
+        file_info.pop(driveami.keys.raw_obs_text, None)
+        self.writer.write(rawfile, file_info)
+
+    def close(self):
+        self.writer.close()
+
+
+def write_run_metrics(timings, n_rawfiles, metrics_dir, run_seconds,
+                      restart_log=None, n_skipped=0):
+    """
+    Summarise the command timings recorded for the processed rawfiles,
+    writing per-command p50 / p95 / max durations as JSON and as a
+    Prometheus textfile. (Plus any reduce session restarts, and the number
+    of rawfiles skipped as up to date, in the JSON.)
+    """
+    driveami.ensure_dir(metrics_dir)
+    summary_path = os.path.join(metrics_dir,
+                                'driveami_calibrate_summary.json')
+    extra = {}
+    if restart_log is not None:
+        extra = restart_log.summary()
+    timings.write_json_summary(summary_path,
+                               run_seconds=run_seconds,
+                               n_rawfiles=n_rawfiles,
+                               n_skipped=n_skipped,
+                               **extra)
+    prom_path = os.path.join(metrics_dir, 'driveami_calibrate.prom')
+    timings.write_prometheus_textfile(prom_path)
+    logger.info("Wrote command timing summary to %s", summary_path)
+
+
 def main(options, data_groups):
+    journal = CalibrationJournal(options.topdir, resume=options.resume)
+    if journal.completed:
+        logger.info("Resuming: %s rawfiles already calibrated, per %s",
+                    len(journal.completed), journal.path)
+        data_groups = journal.remaining(data_groups)
     output_preamble_to_log(data_groups)
-    processed_files_info = process_data_groups(data_groups,
-                                               options.topdir,
-                                               options.amidir,
-                                               options.amiversion,
-                                               array='LA',
-                                               script=options.script)
-
-    with open(options.outfile, 'w') as f:
-        driveami.save_calfile_listing(processed_files_info, f)
+    start = timeit.default_timer()
+    trace = None
+    if options.trace:
+        trace = driveami.ChromeTraceHook(options.trace)
+        driveami.global_hooks.add(trace)
+    incremental_listing = None
+    if options.listing_format == 'jsonl':
+        incremental_listing = IncrementalListing(options.outfile)
+        for rawfile in sorted(journal.completed):
+            incremental_listing.writer.write(rawfile,
+                                             journal.completed[rawfile])
+
+    def on_processed(rawfile, file_info):
+        journal(rawfile, file_info)
+        if incremental_listing is not None:
+            incremental_listing(rawfile, file_info)
+
+    restart_log = RestartLog()
+    timeout_policy = None
+    if options.timeout_policy:
+        timeout_policy = driveami.TimeoutPolicy.load(options.timeout_policy)
+    post_write = None
+    if options.verify_uvfits or options.compress_uvfits:
+        post_write = driveami.PostWritePipeline(
+            workers=options.post_write_workers,
+            compress=options.compress_uvfits)
+    process_data_groups(
+        data_groups,
+        options.topdir,
+        options.amidir,
+        options.amiversion,
+        array='LA',
+        script=options.script,
+        jobs=options.jobs,
+        force=options.force,
+        on_processed=on_processed,
+        restart_log=restart_log,
+        timeout_policy=timeout_policy,
+        stall_timeout=options.stall_timeout,
+        post_write=post_write)
+    if post_write is not None:
+        post_write.close()
+    journal.close()
+    if timeout_policy is not None:
+        timeout_policy.save()
+
+    if incremental_listing is not None:
+        incremental_listing.close()
+    else:
+        # The journal holds both the resumed and the newly calibrated files:
+        with open(options.outfile, 'w') as f:
+            driveami.save_calfile_listing(journal.load(), f)
+    write_run_metrics(journal.timings, journal.n_rawfiles,
+                      options.metrics_dir or options.topdir,
+                      run_seconds=timeit.default_timer() - start,
+                      restart_log=restart_log,
+                      n_skipped=journal.n_skipped)
+    if restart_log.restarts:
+        logger.warning("Restarted %s hung or dead reduce session(s), losing "
+                       "%.1f seconds; failed rawfiles: %s",
+                       restart_log.restarts, restart_log.lost_seconds,
+                       ', '.join(restart_log.failed_rawfiles))
+    if trace is not None:
+        trace.write()
+        logger.info("Wrote trace timeline to %s", options.trace)
     sys.exit(0)
 
 
@@ -10,6 +10,7 @@ import logging
 import sys
 
 import driveami
+from driveami.store import is_store
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -21,13 +22,17 @@ Load full listings, and then return just those groups for which any of the
 files in the group has a filename containing the given 'match string'.
 
 Matching is insensitive to case.
+
+The listings may also be read from a listing store (SQLite database, see
+`driveami.store`), in which case the matching groups are looked up directly.
 """
 
 def handle_args():
     parser = argparse.ArgumentParser(description=_DESCRIPTION)
 
     parser.add_argument('listings',
-                       help="Path to full-list (all datasets) input file")
+                       help="Path to full-list (all datasets) input file, "
+                            "or listing store")
 
     parser.add_argument('match',
                         help="String to match in observation groups.")
@@ -36,21 +41,37 @@ def handle_args():
                        help="Specify path to matching-datasets-list output file."
                             "Default: '{matchstring}_rawfiles.json'.")
 
+    parser.add_argument('-g', '--grouping', default='target_id',
+                        help="Grouping to filter, if reading from a listing "
+                             "store. Default: %(default)s")
+
     args = parser.parse_args()
     return args
 
-def main():
-    options = handle_args()
-    with open(options.listings) as f:
+def filter_listing(path, match):
+    with open(path) as f:
         all_datasets, _ = driveami.load_listing(f,
                                  expected_datatype=driveami.Datatype.ami_la_raw)
 
     matching_datasets={}
     for grp_name, grp_info in all_datasets.iteritems():
         for fname in grp_info['files']:
-            if str.upper(options.match) in str.upper(str(fname)):
+            if str.upper(match) in str.upper(str(fname)):
                 matching_datasets[grp_name]=grp_info
                 break
+    return matching_datasets
+
+
+def main():
+    options = handle_args()
+    if is_store(options.listings):
+        with driveami.ListingStore(options.listings) as store:
+            matching_datasets = store.groups(
+                options.grouping,
+                names=store.groups_containing(options.grouping,
+                                              options.match))
+    else:
+        matching_datasets = filter_listing(options.listings, options.match)
 
     if len(matching_datasets)==0:
         print("No matches found")
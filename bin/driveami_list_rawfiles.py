@@ -6,10 +6,12 @@ then dumps them in JSON format.
 """
 import argparse
 import logging
+import os
 import sys
 
 import driveami
-from driveami.environments import (default_ami_dir, default_ami_version)
+from driveami.environments import (default_ami_dir, default_ami_version,
+                                   default_output_dir)
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -26,11 +28,24 @@ are produced:
     <outfilename>_metadata.json - a full listing of all file data
     <outfilename>_by_id.json - a listing of filenames grouped by ID
     <outfilename>_by_pointing.json - a listing of filenames grouped by pointing.
+
+If several pointing tolerances are given, one pointing-grouped listing is
+written per tolerance, named e.g. <outfilename>_by_pointing_0.5deg.json.
+The single-linkage tree used to group the pointings is also saved, as
+<outfilename>_pointing_tree.json, so that further tolerances can be tried
+without redoing the clustering.
+
+With --incremental, the previous listings and tree are loaded and only the
+newly seen rawfiles are inserted. Existing pointing groups keep their keys
+(they may be merged, but are never split); for a from-scratch regrouping,
+run without --incremental.
 """
 
 def handle_args():
     default_array = 'LA'
     default_full_listings_filename = 'all_ami_rawfiles'
+    default_cache = os.path.join(default_output_dir,
+                                 'ami_rawfile_metadata_cache.sqlite')
 
     parser = argparse.ArgumentParser(
         description=_DESCRIPTION)
@@ -54,6 +69,28 @@ def handle_args():
                              "Default: '{}'".format(
                             default_full_listings_filename))
 
+    parser.add_argument('-p', '--pointing-tolerance', type=float, nargs='+',
+                        default=[0.5], dest='tolerances',
+                        help="Pointing tolerance(s) in degrees used when "
+                             "grouping targets by pointing. Default: 0.5")
+
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="Number of reduce sessions used to load the "
+                             "observation metadata in parallel. Default: 1")
+
+    parser.add_argument('--cache', default=default_cache,
+                        help="Path to the persistent metadata cache; only new "
+                             "or changed rawfiles are queried via reduce. "
+                             "Default: '{}'".format(default_cache))
+
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Query every rawfile, ignoring the metadata cache.")
+
+    parser.add_argument('--incremental', action='store_true',
+                        help="Update the previous by-id and by-pointing "
+                             "listings with any new rawfiles, rather than "
+                             "regrouping everything.")
+
     parser.add_argument('--rawtext', action='store_true',
                         help="Save the file-listing rawtext when outputting"
                              "metadata file (useful for debugging crashes)."
@@ -65,15 +102,59 @@ def handle_args():
     return args
 
 
+def pointing_groups_filename(options, tolerance):
+    if len(options.tolerances) == 1:
+        return options.outfile + '_by_pointing.json'
+    return options.outfile + '_by_pointing_{:g}deg.json'.format(tolerance)
+
+
+def load_previous_groupings(options, grouped_by_id_filename,
+                            pointing_tree_filename):
+    """
+    Returns:
+        tuple: (id_groups, pointing_tree, {tolerance: pointing_groups}), or
+        ``None`` if the previous listings are missing or unsuitable.
+    """
+    filenames = [grouped_by_id_filename, pointing_tree_filename]
+    filenames.extend(pointing_groups_filename(options, tolerance)
+                     for tolerance in options.tolerances)
+    missing = [fname for fname in filenames if not os.path.isfile(fname)]
+    if missing:
+        logger.warning("Previous listing {} not found".format(missing[0]))
+        return None
+    with open(pointing_tree_filename) as f:
+        pointing_tree = driveami.load_pointing_tree(f)
+    if pointing_tree.max_tolerance_deg < max(options.tolerances):
+        logger.warning("Previous pointing tree does not cover the requested "
+                       "tolerances")
+        return None
+    with open(grouped_by_id_filename) as f:
+        id_groups, _ = driveami.load_listing(
+            f, expected_datatype=driveami.Datatype.ami_la_raw)
+    previous_pointing_groups = {}
+    for tolerance in options.tolerances:
+        with open(pointing_groups_filename(options, tolerance)) as f:
+            previous_pointing_groups[tolerance], _ = driveami.load_listing(
+                f, expected_datatype=driveami.Datatype.ami_la_raw)
+    return id_groups, pointing_tree, previous_pointing_groups
+
+
 def main():
     options = handle_args()
     grouped_by_id_filename = options.outfile + '_by_id.json'
-    grouped_by_pointing_filename = options.outfile + '_by_pointing.json'
+    pointing_tree_filename = options.outfile + '_pointing_tree.json'
     metadata_filename = options.outfile + '_metadata.json'
 
-    r = driveami.Reduce(options.amidir, options.amiversion, options.array)
+    if options.no_cache:
+        cache = None
+    else:
+        cache = driveami.ObsInfoCache(os.path.expanduser(options.cache))
+    r = driveami.Reduce(options.amidir, options.amiversion, options.array,
+                        obs_info_cache=cache)
     logger.info("Loading observation metadata.")
-    r.load_obs_info()
+    r.load_obs_info(workers=options.workers)
+    if cache is not None:
+        cache.close()
 
     #Write file metadata
     with open(metadata_filename, 'w') as f:
@@ -85,22 +166,50 @@ def main():
         driveami.save_rawfile_listing(rawfile_dict, f)
     logger.info("Wrote file metadata listings to {}".format(metadata_filename))
 
+    previous = None
+    if options.incremental:
+        previous = load_previous_groupings(options, grouped_by_id_filename,
+                                           pointing_tree_filename)
+        if previous is None:
+            logger.warning("Falling back to full regrouping")
+
+    if previous is not None:
+        id_groups, pointing_tree, previous_pointing_groups = previous
+        logger.info("Adding new observations to target ID groups")
+        updated_ids = r.update_obs_groups_by_target_id(id_groups)
+        logger.info("Updating pointing groups for {} target IDs".format(
+            len(updated_ids)))
+        pointing_tree.update(id_groups, updated_ids)
+        pointing_groups = dict(
+            (tolerance, driveami.merge_pointing_groups(
+                previous_pointing_groups[tolerance], id_groups,
+                pointing_tree, tolerance))
+            for tolerance in options.tolerances)
+    else:
+        logger.info("Grouping observations by target ID")
+        id_groups = r.group_obs_by_target_id()
+        logger.info("Grouping targets by pointing")
+        pointing_tree = driveami.PointingTree.build(
+            id_groups, max_tolerance_deg=max(options.tolerances))
+        pointing_groups = pointing_tree.group_by_tolerances(
+            id_groups, options.tolerances)
+
     #Write listings grouped by ID
-    logger.info("Grouping observations by target ID")
-    id_groups = r.group_obs_by_target_id()
     with open(grouped_by_id_filename, 'w') as f:
         driveami.save_rawfile_listing(id_groups, f)
     logger.info("Wrote id-grouped file-listings to {}".format(grouped_by_id_filename))
 
     #Write listings grouped by pointing:
-    logger.info("Grouping targets by pointing")
-    pointing_groups = r.group_target_ids_by_pointing(id_groups,
-                                                     pointing_tolerance_in_degrees=0.5)
-    with open(grouped_by_pointing_filename, 'w') as f:
-        driveami.save_rawfile_listing(pointing_groups, f)
-    logger.info(
-        "Wrote pointing-grouped file-listings to {}".format(
-            grouped_by_pointing_filename))
+    with open(pointing_tree_filename, 'w') as f:
+        driveami.save_pointing_tree(pointing_tree, f)
+    for tolerance in options.tolerances:
+        grouped_by_pointing_filename = pointing_groups_filename(options,
+                                                                tolerance)
+        with open(grouped_by_pointing_filename, 'w') as f:
+            driveami.save_rawfile_listing(pointing_groups[tolerance], f)
+        logger.info(
+            "Wrote pointing-grouped file-listings to {}".format(
+                grouped_by_pointing_filename))
 
     return 0
 
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Import JSON listings into, or export them from, a listing store.
+"""
+from __future__ import print_function
+
+import argparse
+import logging
+import sys
+
+import driveami
+
+logging.basicConfig(level=logging.INFO)
+
+_DESCRIPTION = """
+Import JSON listings into, or export them from, a listing store
+(SQLite database, see `driveami.store`).
+
+Rawfile metadata listings are imported as is; id- or pointing-grouped
+listings need a grouping name (e.g. 'target_id', 'pointing_0.5').
+Calibrated-file listings are recognised automatically.
+
+E.g.:
+    driveami_listing_store.py import ami.db all_rawfiles_metadata.json
+    driveami_listing_store.py import ami.db all_rawfiles_by_id.json -g target_id
+    driveami_listing_store.py export ami.db by_id.json -g target_id
+"""
+
+
+def handle_args():
+    parser = argparse.ArgumentParser(
+        description=_DESCRIPTION,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('store', help="Path to the listing store")
+    parser.add_argument('listings', nargs='+',
+                        help="Listing file(s) to import, or the file to "
+                             "export to")
+    parser.add_argument('-g', '--grouping', default=None,
+                        help="Grouping name for grouped rawfile listings")
+    parser.add_argument('-c', '--calibrated', action='store_true',
+                        help="Export the calibrated results")
+    parser.add_argument('--jsonl', action='store_true',
+                        help="Export calibrated results as JSON Lines")
+    return parser.parse_args()
+
+
+def main():
+    options = handle_args()
+    with driveami.ListingStore(options.store) as store:
+        if options.action == 'import':
+            for path in options.listings:
+                with open(path) as f:
+                    n_entries = store.import_listing(f, options.grouping)
+                print("Imported {} entries from {}".format(n_entries, path))
+            return 0
+
+        if len(options.listings) != 1:
+            print("Export takes a single output file")
+            return 1
+        with open(options.listings[0], 'w') as f:
+            if options.calibrated:
+                store.export_calibrated(f, jsonl=options.jsonl)
+            elif options.grouping is not None:
+                store.export_groups(f, options.grouping)
+            else:
+                store.export_files(f)
+    print("Exported to", options.listings[0])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
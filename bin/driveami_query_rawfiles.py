@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Query a rawfile metadata listing by position and / or time range.
+"""
+from __future__ import print_function
+
+import argparse
+import logging
+import sys
+
+import driveami
+from driveami.index import load_or_build_index
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+_DESCRIPTION = """
+Query rawfile metadata listings by position and / or time range.
+
+Loads the '_metadata.json' listing produced by driveami_list_rawfiles.py,
+and prints the rawfiles pointed within the given radius of a position,
+and / or observed during the given MJD range.
+
+A lookup index is saved alongside the listing on first use, and rebuilt
+whenever the listing is newer.
+"""
+
+
+def handle_args():
+    parser = argparse.ArgumentParser(description=_DESCRIPTION)
+
+    parser.add_argument('listing',
+                        help="Path to rawfile metadata listing, "
+                             "e.g. 'rawfiles_metadata.json'.")
+
+    parser.add_argument('-c', '--cone', nargs=3, type=float, default=None,
+                        metavar=('RA', 'DEC', 'RADIUS'),
+                        help="Cone search; position and radius in degrees.")
+
+    parser.add_argument('-t', '--mjd-range', nargs=2, type=float, default=None,
+                        metavar=('MJD_MIN', 'MJD_MAX'),
+                        help="Select observations overlapping this MJD range.")
+
+    parser.add_argument('--index', default=None,
+                        help="Path to the lookup index. "
+                             "Default: the listing path with its extension "
+                             "replaced by '_index.npz'.")
+
+    parser.add_argument('-o', '--outfile', default=None,
+                        help="Write the metadata of matching rawfiles "
+                             "to this listing file.")
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    options = handle_args()
+    index = load_or_build_index(options.listing, options.index)
+    matches = index.query(cone=options.cone, mjd_range=options.mjd_range)
+
+    if len(matches) == 0:
+        print("No matches found")
+        return 1
+
+    for fname in matches:
+        print(fname)
+
+    if options.outfile is not None:
+        with open(options.listing) as f:
+            listing, _ = driveami.load_listing(
+                f, expected_datatype=driveami.Datatype.ami_la_raw)
+        with open(options.outfile, 'w') as f:
+            driveami.save_rawfile_listing(
+                dict((fname, listing[fname]) for fname in matches), f)
+        print("Metadata for {} matching rawfiles written to".format(
+            len(matches)), options.outfile)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,11 +5,25 @@ import json
 from colorlog import ColoredFormatter
 import driveami.keys as keys
 import driveami.scripts as scripts
-from driveami.reduce import (Reduce, AmiVersion)
+from driveami.reduce import (Reduce, AmiVersion, CommandStalled)
+from driveami.pool import (ReducePool, RawfileJob)
+from driveami.supervisor import SupervisedReduce, RestartLog
 
 from driveami.serialization import (Datatype, make_serializable,
                                     save_calfile_listing, save_rawfile_listing,
-                                    load_listing)
+                                    load_listing, iter_listing,
+                                    ListingWriter, restore_file_info,
+                                    save_pointing_tree, load_pointing_tree)
+from driveami.pointing import PointingTree, merge_pointing_groups
+from driveami.cache import ObsInfoCache
+from driveami.store import ListingStore
+from driveami.lazylisting import LazyListing, open_listing
+from driveami.manifest import ResultManifest, result_key
+from driveami.index import RawfileIndex
+from driveami.metrics import CommandTimings
+from driveami.timeouts import TimeoutPolicy
+from driveami.postwrite import PostWritePipeline
+from driveami.hooks import HookRegistry, global_hooks, ChromeTraceHook
 
 
 from ._version import get_versions
@@ -28,7 +42,9 @@ def ensure_dir(dirname):
 def process_rawfile(rawfile, output_dir,
                     reduce,
                     script,
-                    file_logging=True
+                    file_logging=True,
+                    manifest=None,
+                    force=False
                     ):
     """
     A convenience function applying sensible defaults to reduce a rawfile.
@@ -39,6 +55,12 @@ def process_rawfile(rawfile, output_dir,
     reduce: instance of ami.Reduce
     array: 'LA' or 'SA' (Default: LA)
     script: Reduction commands.
+    manifest: (Optional) A :class:`driveami.manifest.ResultManifest` for
+        ``output_dir``. If supplied, the reduction is skipped when the
+        manifest shows the existing outputs are up to date, and the
+        previously saved info is returned instead (marked with
+        ``keys.skipped``, so it is not mistaken for fresh work).
+    force: Reduce the rawfile even if the manifest says it is up to date.
 
     Returns:
         - A dictionary containing information about the rawfile,
@@ -46,6 +68,21 @@ def process_rawfile(rawfile, output_dir,
           See also: ``ami.keys``
     """
     r = reduce
+    if manifest is not None:
+        if keys.raster not in r.files[rawfile]:
+            r.get_obs_details(rawfile)
+        key, components = result_key(script,
+                                     _write_command_overrides(r, rawfile),
+                                     r.get_version(),
+                                     r.rawfile_path(rawfile))
+        if not force:
+            info = manifest.load_if_current(rawfile, key, output_dir)
+            if info is not None:
+                logger.info("Outputs for %s are up to date, skipping.",
+                            rawfile)
+                info[keys.skipped] = True
+                return info
+
     if file_logging:
         file_logdir = output_dir
     else:
@@ -53,22 +90,36 @@ def process_rawfile(rawfile, output_dir,
     r.set_active_file(rawfile, file_logdir)
     r.run_script(script)
     r.update_flagging_info()
+    r.write_files(rawfile, output_dir,
+                  write_command_overrides=_write_command_overrides(r, rawfile))
+    info = _save_file_info(r, rawfile, output_dir)
+    if manifest is not None:
+        manifest.record(rawfile, key, components,
+                        info_file=_info_filename(rawfile))
+    return info
+
+
+def _write_command_overrides(reduce, rawfile):
     write_command_overrides = {}
-    if r.ami_version=='legacy':
+    if reduce.ami_version=='legacy':
         write_command_overrides['channels'] = '3-8'
-    if r.files[rawfile]['raster']:
+    if reduce.files[rawfile]['raster']:
         write_command_overrides['fits_or_multi'] = 'multi'
         write_command_overrides['offsets'] = 'all'
+    return write_command_overrides
+
+
+def _info_filename(rawfile):
+    return os.path.splitext(rawfile)[0] + '.json'
 
-    r.write_files(rawfile, output_dir,
-                  write_command_overrides=write_command_overrides)
 
-    r.files[rawfile][keys.obs_name] = os.path.splitext(rawfile)[0]
-    info_filename = os.path.splitext(rawfile)[0] + '.json'
-    with open(os.path.join(output_dir, info_filename), 'w') as f:
-        json.dump(make_serializable(r.files[rawfile]), f,
+def _save_file_info(reduce, rawfile, output_dir):
+    """Dump the info for a freshly reduced rawfile alongside its UVFITS."""
+    reduce.files[rawfile][keys.obs_name] = os.path.splitext(rawfile)[0]
+    with open(os.path.join(output_dir, _info_filename(rawfile)), 'w') as f:
+        json.dump(make_serializable(reduce.files[rawfile]), f,
                   sort_keys=True, indent=4)
-    return r.files[rawfile]
+    return reduce.files[rawfile]
 
 
 def get_color_log_formatter():
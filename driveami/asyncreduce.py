@@ -0,0 +1,272 @@
+"""
+An asyncio-native counterpart to :class:`driveami.reduce.Reduce`.
+
+Each :class:`AsyncReduce` method that talks to the ``reduce`` child is a
+coroutine, built on pexpect's async expect. A single event loop can then
+drive many reduce children at once, e.g.::
+
+    sessions = [await AsyncReduce.create(ami_dir, 'digital')
+                for _ in range(8)]
+    results = await asyncio.gather(*[
+        process_rawfile(rawfile, output_dir, reduce=r, script=script)
+        for r, rawfile in zip(sessions, rawfiles)])
+
+NB requires Python 3 (and pexpect >= 4.3), so unlike the rest of the
+package this module is not imported by ``driveami/__init__.py``.
+"""
+import logging
+import timeit
+
+import driveami
+import driveami.keys as keys
+from driveami.reduce import Reduce
+import driveami.scripts as scripts
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncReduce(Reduce):
+    """
+    Coroutine interface to an AMI-reduce session.
+
+    Construction only records the settings; the child is spawned by
+    :meth:`start` (or use the :meth:`create` shortcut).
+    The file-grouping and output-parsing routines are inherited unchanged
+    from :class:`.Reduce`.
+    """
+
+    def __init__(self,
+                 ami_rootdir,
+                 ami_version,
+                 array='LA',
+                 working_dir='/tmp',
+                 additional_env_variables=None,
+                 timeout=120,
+                 high_throughput=False,
+                 hooks=None,
+                 timeout_policy=None,
+                 streaming=False,
+                 pipelined=False,
+                 stall_timeout=None,
+                 ):
+        """
+        As for :class:`.Reduce`, except that ``streaming``, ``pipelined``
+        and ``stall_timeout`` are not supported (and raise ValueError).
+        """
+        for option, value in (('streaming', streaming),
+                              ('pipelined', pipelined),
+                              ('stall_timeout', stall_timeout)):
+            if value:
+                raise ValueError(
+                    "AsyncReduce does not support the '{}' option".format(
+                        option))
+        self._configure(ami_rootdir, ami_version, array, working_dir,
+                        additional_env_variables, timeout,
+                        high_throughput=high_throughput)
+        self.hooks = hooks
+        self.timeout_policy = timeout_policy
+        self.child = None
+
+    @classmethod
+    async def create(cls, *args, **kwargs):
+        """Instantiate and start a session, returning it once ready."""
+        session = cls(*args, **kwargs)
+        await session.start()
+        return session
+
+    async def start(self):
+        """
+        Spawn the AMI-REDUCE instance, and update the list of available files.
+        """
+        logger.debug("Spawning instance of " + self.reduce_binary + "...")
+        self.child = self._spawn_child(encoding='ascii',
+                                       codec_errors='replace')
+        await self._expect_prompt()
+        logger.debug("...success.")
+        self._fire_hook('session_spawn')
+        if self.array == 'LA':
+            await self.switch_to_large_array()
+        await self.update_files()
+        return self
+
+    async def spawn_sibling(self):
+        """See :meth:`.Reduce.spawn_sibling`."""
+        return await type(self).create(
+            self.ami_rootdir, self.ami_version,
+            array=self.array,
+            working_dir=self.working_dir,
+            additional_env_variables=self.additional_env_variables,
+            timeout=self.timeout,
+            high_throughput=self.high_throughput,
+            hooks=self.hooks,
+            timeout_policy=self.timeout_policy)
+
+    async def __aenter__(self):
+        if self.child is None:
+            await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.child.sendline('exit')
+        self.child.close()
+        self._fire_hook('session_exit')
+
+    async def _expect_prompt(self, command=None):
+        if self.high_throughput:
+            await self.child.expect_exact(
+                self.prompt, async_=True,
+                searchwindowsize=self.high_throughput_search_window)
+        else:
+            await self.child.expect(self.prompt, async_=True)
+        return self.child.before
+
+    async def _exchange(self, command):
+        """See :meth:`.Reduce._exchange`."""
+        self._fire_hook('before_command', command=command)
+        self._apply_timeout_policy(command)
+        start = timeit.default_timer()
+        self.child.sendline(command)
+        output = await self._expect_prompt(command)
+        seconds = timeit.default_timer() - start
+        self._observe_latency(command, seconds)
+        self._fire_hook('after_command', command=command, seconds=seconds,
+                        output_bytes=len(output))
+        return output, seconds
+
+    async def get_version(self):
+        """See :meth:`.Reduce.get_version`."""
+        if self._version_text is None:
+            output, _ = await self._exchange('version')
+            lines = [l.strip() for l in output.split('\n')[1:]]
+            self._version_text = ' '.join(l for l in lines if l)
+        return self._version_text
+
+    async def switch_to_large_array(self):
+        """NB resets file list"""
+        self.files = dict()
+        await self._exchange('set def la')
+
+    async def update_files(self):
+        """See :meth:`.Reduce.update_files`."""
+        output, _ = await self._exchange(r'list files \ ')
+        self._parse_file_list(output)
+        output, _ = await self._exchange(r'list comment \ ')
+        self._parse_comment_list(output)
+
+    async def get_obs_details(self, filename, incomplete=False):
+        """See :meth:`.Reduce.get_obs_details`."""
+        if not incomplete:
+            command = r'list observation {0} \ '.format(filename)
+        else:  # incomplete observation, load fully to check end-timetamp:
+            if not self.active_file == filename:
+                await self.set_active_file(filename)
+            command = r'show observation \ '
+        obs_output, seconds = await self._exchange(command)
+        if filename == self.active_file:
+            self._record_timing(command, seconds, len(obs_output))
+        info = self._update_obs_info(filename, obs_output, incomplete)
+        if (info[keys.duration] == 0.0 and not incomplete):
+            logger.warning(
+                "Incomplete obs ({}), pulling timestamps from filedata".format(
+                    filename))
+            await self.get_obs_details(filename, incomplete=True)
+        return info
+
+    async def load_obs_info(self):
+        """See :meth:`.Reduce.load_obs_info`."""
+        logger.info("Loading observation information, patience...")
+        await self.update_files()
+        for filename, info in sorted(self.files.items()):
+            if info.get(keys.pointing_degrees, None) is None:
+                logger.debug("Getting obs info for %s", filename)
+                try:
+                    await self.get_obs_details(filename)
+                except Exception:
+                    logger.exception("Threw an exception trying to parse "
+                                     "details for %s", filename)
+
+    async def run_command(self, command):
+        """See :meth:`.Reduce.run_command`."""
+        self.file_cmd_log.debug(command)
+        self._fire_hook('before_command', command=command)
+        self._apply_timeout_policy(command)
+        start = timeit.default_timer()
+        try:
+            self.child.sendline(command)
+            output = await self._expect_prompt()
+        except:
+            logger.error("Exception running command '{}'".format(command))
+            raise
+        self._command_finished(command, timeit.default_timer() - start,
+                               len(output))
+        return self._handle_command_output(command, output)
+
+    async def run_script(self, script_string):
+        """Takes a script of commands, one command per line"""
+        for command in script_string.split('\n'):
+            await self.run_command(command)
+
+    async def set_active_file(self, filename, file_logdir=None):
+        """See :meth:`.Reduce.set_active_file`."""
+        start = timeit.default_timer()
+        filename = self._activate_file(filename, file_logdir)
+        await self.run_command(r'file %s \ ' % filename)
+        await self.get_obs_details(filename, incomplete=self._is_incomplete())
+        self._fire_hook('file_activated', filename=filename)
+        self._record_timing('set_active_file',
+                            timeit.default_timer() - start, 0)
+        logger.debug('Active file: %s', filename)
+
+    async def write_files(self, rawfile, output_dir,
+                          write_command_template=scripts.write_command,
+                          write_command_overrides=None):
+        """See :meth:`.Reduce.write_files`."""
+        self._fire_hook('write_files_start', rawfile=rawfile,
+                        output_dir=output_dir)
+        start = timeit.default_timer()
+        write_command, renames = self._prepare_write(rawfile, output_dir,
+                                                     write_command_template,
+                                                     write_command_overrides)
+        await self.run_command(write_command)
+        self._finish_write(renames)
+        seconds = timeit.default_timer() - start
+        self._record_timing('write_files', seconds, 0)
+        self._fire_hook('write_files_end', rawfile=rawfile,
+                        output_dir=output_dir, seconds=seconds)
+
+    async def update_flagging_info(self):
+        """See :meth:`.Reduce.update_flagging_info`."""
+        await self.run_command(r'show flagging no yes \ ')
+        final_flagging = self.last_output_metrics['flagging']
+        self.files[self.active_file][keys.flagged_final] = final_flagging
+
+
+async def process_rawfile(rawfile, output_dir,
+                          reduce,
+                          script,
+                          file_logging=True
+                          ):
+    """
+    Coroutine equivalent of :func:`driveami.process_rawfile`.
+
+    Args:
+    rawfile: Name of a file in the ami data dir, e.g. "SWIFT121101-121101.raw"
+    output_dir: Folder where UVFITS for the target and calibrator will be output.
+    reduce: instance of :class:`AsyncReduce`
+    script: Reduction commands.
+
+    Returns:
+        - A dictionary containing information about the rawfile.
+    """
+    r = reduce
+    if file_logging:
+        file_logdir = output_dir
+    else:
+        file_logdir = None
+    await r.set_active_file(rawfile, file_logdir)
+    await r.run_script(script)
+    await r.update_flagging_info()
+    overrides = driveami._write_command_overrides(r, rawfile)
+    await r.write_files(rawfile, output_dir,
+                        write_command_overrides=overrides)
+    return driveami._save_file_info(r, rawfile, output_dir)
@@ -0,0 +1,108 @@
+"""
+Persistent on-disk cache of parsed observation info.
+
+A raw file never changes once its observation has ended, so there's no need
+to ask ``reduce`` to ``list observation`` it more than once. The parsed info
+(as produced by :meth:`.Reduce.get_obs_details`) is stored in a SQLite
+database, keyed by the rawfile path and validated against its size and mtime.
+"""
+from __future__ import absolute_import
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+import driveami.keys as keys
+from driveami.serialization import make_serializable, restore_file_info
+
+logger = logging.getLogger(__name__)
+
+
+def rawfile_fingerprint(path):
+    """
+    Returns:
+        tuple: (size, mtime) identifying the current contents of ``path``,
+        or ``None`` if it cannot be accessed.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+class ObsInfoCache(object):
+    """
+    Cache of rawfile observation info, backed by a SQLite database.
+
+    Safe to share between threads. Writes are batched; call :meth:`close`
+    (or use as a context manager) to be sure they land on disk.
+    """
+    # Keys which are refreshed by every ``list comment``, or specific to a
+    # particular reduction run, so not cached:
+    uncached_keys = (keys.comment, keys.command_timings)
+
+    def __init__(self, db_path, commit_every=100):
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self.db_path = db_path
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS obs_info ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, info TEXT)")
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get(self, path):
+        """
+        Returns:
+            dict: Cached info for the rawfile at ``path``, or ``None`` if
+            there is no entry or the file has changed since it was cached.
+        """
+        fingerprint = rawfile_fingerprint(path)
+        if fingerprint is None:
+            return None
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT size, mtime, info FROM obs_info WHERE path=?",
+                (path,)).fetchone()
+        if row is None or tuple(row[:2]) != fingerprint:
+            return None
+        return restore_file_info(json.loads(row[2]))
+
+    def put(self, path, info):
+        """Store the info for the rawfile at ``path``."""
+        fingerprint = rawfile_fingerprint(path)
+        if fingerprint is None:
+            logger.debug("Not caching info for missing rawfile %s", path)
+            return
+        info = dict((k, v) for k, v in info.items()
+                    if k not in self.uncached_keys)
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO obs_info VALUES (?, ?, ?, ?)",
+                (path, fingerprint[0], fingerprint[1],
+                 json.dumps(make_serializable(info))))
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self.connection.commit()
+                self._uncommitted = 0
+
+    def commit(self):
+        with self._lock:
+            self.connection.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
@@ -0,0 +1,165 @@
+"""
+Callbacks on the lifecycle of AMI-reduce sessions, for profiling and tracing.
+
+Hooks are registered either globally (:data:`global_hooks`, applying to
+every session) or with a particular :class:`.Reduce` instance (via its
+``hooks`` argument / attribute). Each callback is called with the session
+as its first argument, plus event-specific keyword arguments:
+
+================== ==========================================================
+Event              Keyword arguments
+================== ==========================================================
+session_spawn      (none)
+file_activated     ``filename``
+before_command     ``command``
+after_command      ``command``, ``seconds``, ``output_bytes``
+write_files_start  ``rawfile``, ``output_dir``
+write_files_end    ``rawfile``, ``output_dir``, ``seconds``
+session_exit       (none)
+================== ==========================================================
+
+E.g.::
+
+    def log_slow_commands(session, command, seconds, output_bytes):
+        if seconds > 10:
+            print(session.active_file, command, seconds)
+
+    driveami.global_hooks.register('after_command', log_slow_commands)
+
+An object with ``on_<event>`` methods can be registered for all the events
+it handles in one go with :meth:`HookRegistry.add`, see
+:class:`ChromeTraceHook`.
+"""
+from __future__ import absolute_import
+import json
+import os
+import threading
+import time
+
+from driveami.metrics import command_key
+
+events = ('session_spawn', 'file_activated', 'before_command',
+          'after_command', 'write_files_start', 'write_files_end',
+          'session_exit')
+
+
+class HookRegistry(object):
+    """Callbacks registered for each event."""
+
+    def __init__(self):
+        self.callbacks = dict((event, []) for event in events)
+
+    def register(self, event, callback):
+        if event not in self.callbacks:
+            raise ValueError("Unknown hook event '{}', choose from {}".format(
+                event, events))
+        self.callbacks[event].append(callback)
+
+    def unregister(self, event, callback):
+        self.callbacks[event].remove(callback)
+
+    def add(self, hook):
+        """Register each ``on_<event>`` method of ``hook``."""
+        for event in events:
+            callback = getattr(hook, 'on_' + event, None)
+            if callback is not None:
+                self.register(event, callback)
+
+    def remove(self, hook):
+        """Undo :meth:`add`."""
+        for event in events:
+            callback = getattr(hook, 'on_' + event, None)
+            if callback is not None and callback in self.callbacks[event]:
+                self.unregister(event, callback)
+
+    def fire(self, event, session, **kwargs):
+        for callback in self.callbacks[event]:
+            callback(session, **kwargs)
+
+
+#: Hooks applied to every session.
+global_hooks = HookRegistry()
+
+
+def fire_hooks(session_hooks, event, session, **kwargs):
+    """Call the global and session-specific callbacks for ``event``."""
+    global_hooks.fire(event, session, **kwargs)
+    if session_hooks is not None:
+        session_hooks.fire(event, session, **kwargs)
+
+
+class ChromeTraceHook(object):
+    """
+    Records sessions, commands and writes as Chrome trace events.
+
+    Each session appears as a separate thread in the timeline. Load the
+    output file in ``chrome://tracing`` or https://ui.perfetto.dev , e.g.::
+
+        trace = ChromeTraceHook('calibration_trace.json')
+        driveami.global_hooks.add(trace)
+        ... # Run the calibration
+        trace.write()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.trace_events = []
+        self._lock = threading.Lock()
+        self._origin = time.time()
+        self._pid = os.getpid()
+        self._session_ids = {}
+
+    def _now_us(self):
+        return (time.time() - self._origin) * 1e6
+
+    def _tid(self, session):
+        key = id(session)
+        if key not in self._session_ids:
+            tid = len(self._session_ids) + 1
+            self._session_ids[key] = tid
+            self.trace_events.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': self._pid,
+                'tid': tid, 'args': {'name': 'reduce session {}'.format(tid)}})
+        return self._session_ids[key]
+
+    def _add(self, session, event):
+        with self._lock:
+            event['pid'] = self._pid
+            event['tid'] = self._tid(session)
+            self.trace_events.append(event)
+
+    def _instant(self, session, name, **args):
+        self._add(session, {'name': name, 'ph': 'i', 's': 't',
+                            'ts': self._now_us(), 'args': args})
+
+    def _complete(self, session, name, seconds, category, **args):
+        duration = seconds * 1e6
+        self._add(session, {'name': name, 'cat': category, 'ph': 'X',
+                            'ts': self._now_us() - duration, 'dur': duration,
+                            'args': args})
+
+    def on_session_spawn(self, session):
+        self._instant(session, 'session_spawn')
+
+    def on_file_activated(self, session, filename):
+        self._instant(session, 'file ' + filename, filename=filename)
+
+    def on_after_command(self, session, command, seconds, output_bytes):
+        self._complete(session, command_key(command), seconds, 'command',
+                       command=command, output_bytes=output_bytes,
+                       rawfile=session.active_file)
+
+    def on_write_files_end(self, session, rawfile, output_dir, seconds):
+        self._complete(session, 'write_files', seconds, 'write',
+                       rawfile=rawfile, output_dir=output_dir)
+
+    def on_session_exit(self, session):
+        self._instant(session, 'session_exit')
+
+    def write(self):
+        """Write the events recorded so far to :attr:`path`."""
+        with self._lock:
+            doc = {'traceEvents': list(self.trace_events),
+                   'displayTimeUnit': 'ms'}
+        with open(self.path, 'w') as f:
+            json.dump(doc, f)
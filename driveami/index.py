@@ -0,0 +1,181 @@
+"""
+Positional and time-range lookups over rawfile listings.
+
+Answers queries such as 'which rawfiles were pointed within 0.3 degrees of
+this position, between these MJDs?' without looping over the full listing.
+Pointings are held as unit vectors sorted by declination, so a cone search
+only has to check the narrow declination band around the search position.
+Observations are held sorted by start time; since no observation runs for
+longer than the longest in the listing, an overlap search only has to check
+a short run of start times.
+"""
+from __future__ import absolute_import
+import os
+
+import numpy as np
+
+import driveami.keys as keys
+from driveami.pointing import degrees_to_chord, unit_vectors
+
+
+class RawfileIndex(object):
+    """
+    Cone-search and time-overlap index over a set of rawfiles.
+
+    Build with :meth:`from_listing`, persist with :meth:`save` / :meth:`load`.
+    """
+
+    def __init__(self, filenames, ra_deg, dec_deg, mjd_start, mjd_end):
+        filenames = np.asarray(filenames)
+        ra_deg = np.asarray(ra_deg, dtype=float)
+        dec_deg = np.asarray(dec_deg, dtype=float)
+        mjd_start = np.asarray(mjd_start, dtype=float)
+        mjd_end = np.asarray(mjd_end, dtype=float)
+
+        has_pointing = ~(np.isnan(ra_deg) | np.isnan(dec_deg))
+        dec_order = np.nonzero(has_pointing)[0]
+        dec_order = dec_order[np.argsort(dec_deg[dec_order], kind='mergesort')]
+        self.pointing_filenames = filenames[dec_order]
+        self.sorted_dec = dec_deg[dec_order]
+        self.sorted_ra = ra_deg[dec_order]
+        self.vectors = unit_vectors(self.sorted_ra, self.sorted_dec)
+
+        has_times = ~(np.isnan(mjd_start) | np.isnan(mjd_end))
+        time_order = np.nonzero(has_times)[0]
+        time_order = time_order[np.argsort(mjd_start[time_order],
+                                           kind='mergesort')]
+        self.time_filenames = filenames[time_order]
+        self.sorted_start = mjd_start[time_order]
+        self.sorted_end = mjd_end[time_order]
+        if len(time_order):
+            self.max_duration = float(np.max(self.sorted_end -
+                                              self.sorted_start))
+        else:
+            self.max_duration = 0.0
+
+    @classmethod
+    def from_listing(cls, rawfile_listing):
+        """
+        Build an index from a rawfile metadata listing, e.g. as loaded from
+        the ``_metadata.json`` produced by ``driveami_list_rawfiles.py``.
+        Files without pointing or timestamp info are left out of the
+        corresponding lookups.
+        """
+        filenames = sorted(rawfile_listing.keys())
+        n = len(filenames)
+        ra, dec = np.full(n, np.nan), np.full(n, np.nan)
+        mjd_start, mjd_end = np.full(n, np.nan), np.full(n, np.nan)
+        for idx, fname in enumerate(filenames):
+            info = rawfile_listing[fname]
+            if info.get(keys.pointing_degrees) is not None:
+                ra[idx], dec[idx] = info[keys.pointing_degrees]
+            if info.get(keys.time_mjd) is not None:
+                mjd_start[idx], mjd_end[idx] = info[keys.time_mjd]
+        return cls(filenames, ra, dec, mjd_start, mjd_end)
+
+    def save(self, path):
+        """
+        Save the index as a numpy ``.npz`` file, at exactly ``path`` (numpy
+        would append ``.npz`` to a bare path not already ending in it).
+        """
+        with open(path, 'wb') as f:
+            np.savez(f,
+                     pointing_filenames=self.pointing_filenames,
+                     sorted_ra=self.sorted_ra,
+                     sorted_dec=self.sorted_dec,
+                     time_filenames=self.time_filenames,
+                     sorted_start=self.sorted_start,
+                     sorted_end=self.sorted_end)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index saved with :meth:`save`."""
+        index = cls.__new__(cls)
+        with np.load(path) as data:
+            index.pointing_filenames = data['pointing_filenames']
+            index.sorted_ra = data['sorted_ra']
+            index.sorted_dec = data['sorted_dec']
+            index.time_filenames = data['time_filenames']
+            index.sorted_start = data['sorted_start']
+            index.sorted_end = data['sorted_end']
+        index.vectors = unit_vectors(index.sorted_ra, index.sorted_dec)
+        if len(index.sorted_start):
+            index.max_duration = float(np.max(index.sorted_end -
+                                               index.sorted_start))
+        else:
+            index.max_duration = 0.0
+        return index
+
+    def cone_search(self, ra_deg, dec_deg, radius_deg):
+        """
+        Returns:
+            list: Filenames of the rawfiles pointed within ``radius_deg`` of
+            the given position, sorted by name.
+        """
+        lo = np.searchsorted(self.sorted_dec, dec_deg - radius_deg,
+                             side='left')
+        hi = np.searchsorted(self.sorted_dec, dec_deg + radius_deg,
+                             side='right')
+        centre = unit_vectors([ra_deg], [dec_deg])[0]
+        offsets = self.vectors[lo:hi] - centre
+        chord_sq = np.einsum('ij,ij->i', offsets, offsets)
+        matches = np.nonzero(chord_sq <= degrees_to_chord(radius_deg) ** 2)[0]
+        return sorted(self.pointing_filenames[lo + matches].tolist())
+
+    def time_overlap(self, mjd_min, mjd_max):
+        """
+        Returns:
+            list: Filenames of the rawfiles whose observations overlap the
+            MJD range ``[mjd_min, mjd_max]``, sorted by name.
+        """
+        lo = np.searchsorted(self.sorted_start, mjd_min - self.max_duration,
+                             side='left')
+        hi = np.searchsorted(self.sorted_start, mjd_max, side='right')
+        matches = np.nonzero(self.sorted_end[lo:hi] >= mjd_min)[0]
+        return sorted(self.time_filenames[lo + matches].tolist())
+
+    def query(self, cone=None, mjd_range=None):
+        """
+        Combined lookup.
+
+        Args:
+            cone: Optional ``(ra_deg, dec_deg, radius_deg)`` tuple.
+            mjd_range: Optional ``(mjd_min, mjd_max)`` tuple.
+
+        Returns:
+            list: Filenames matching all the given criteria, sorted by name.
+        """
+        results = None
+        if cone is not None:
+            results = set(self.cone_search(*cone))
+        if mjd_range is not None:
+            in_range = set(self.time_overlap(*mjd_range))
+            results = in_range if results is None else results & in_range
+        if results is None:
+            results = set(self.pointing_filenames.tolist())
+            results.update(self.time_filenames.tolist())
+        return sorted(results)
+
+
+def index_path_for_listing(listing_path):
+    """Default location of the index for a given listing file."""
+    return os.path.splitext(listing_path)[0] + '_index.npz'
+
+
+def load_or_build_index(listing_path, index_path=None):
+    """
+    Load the index for a listing file, (re)building and saving it if it is
+    missing or older than the listing.
+    """
+    # Avoid a circular import, serialization is not needed elsewhere here:
+    from driveami.serialization import load_listing, Datatype
+    if index_path is None:
+        index_path = index_path_for_listing(listing_path)
+    if (os.path.isfile(index_path) and
+            os.path.getmtime(index_path) >= os.path.getmtime(listing_path)):
+        return RawfileIndex.load(index_path)
+    with open(listing_path) as f:
+        listing, _ = load_listing(f, expected_datatype=Datatype.ami_la_raw)
+    index = RawfileIndex.from_listing(listing)
+    index.save(index_path)
+    return index
@@ -3,6 +3,7 @@ archive_cal_days_apart = 'archive_cal_days_apart'
 cal_uvfits = 'calib_uvfits'
 calibrator = 'calibrator'
 comment = 'comment'
+command_timings = 'command_timings'
 duration = 'duration_hrs'
 est_noise_jy = 'estimated_noise_jy'
 field = 'field'
@@ -16,10 +17,12 @@ pointing_hms_dms = 'pointing_hms_dms'
 rain = 'rain_amp_corr'
 raster = 'raster'
 raw_obs_text = 'raw_obs_listing_text'
+skipped = 'skipped_up_to_date'
 target_pointing_deg = 'target_median_pointing'
 target_uvfits = 'target_uvfits'
 time_mjd = 'time_mjd'
 time_st = 'time_sidereal'
 time_ut = 'time_utc'
+uvfits_checks = 'uvfits_checks'
 warning_incomplete = 'incomplete_observation'
 warnings = 'warning_flags'
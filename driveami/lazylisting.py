@@ -0,0 +1,246 @@
+"""
+Lazy loading of large JSON listings.
+
+:func:`open_listing` scans a listing once, recording the byte range of each
+top-level entry (e.g. each group of a ``_by_id`` listing), and caches that
+offset index next to the listing. It returns a :class:`LazyListing`, a
+read-only mapping which decodes only the entries actually accessed. So
+e.g. picking out a few groups from a huge metadata listing costs little
+more than reading those groups.
+
+Both the legacy single-dict format and the JSON Lines format (see
+:class:`driveami.serialization.ListingWriter`) are supported.
+"""
+from __future__ import absolute_import
+import json
+import logging
+import os
+import re
+import threading
+
+from driveami.cache import rawfile_fingerprint
+from driveami.serialization import (Datatype, _check_datatype,
+                                    _parse_jsonl_header)
+
+logger = logging.getLogger(__name__)
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
+_whitespace_regex = re.compile(r'[ \t\n\r]*')
+
+_legacy_format = 'json'
+_jsonl_format = 'jsonl'
+
+
+def offsets_path_for_listing(listing_path):
+    """Default location of the cached offset index for a given listing."""
+    return os.path.splitext(listing_path)[0] + '_offsets.json'
+
+
+def _scan_legacy(data):
+    """
+    Returns:
+        list: ``(key, start, end)`` for each top-level entry of the JSON
+        object in ``data`` (bytes), where ``data[start:end]`` is the
+        ``"key": value`` text.
+    """
+    # Decoding as latin-1 maps bytes one-to-one onto characters, so string
+    # indices are byte offsets; values are only parsed to find their ends.
+    raw = data
+    if not isinstance(data, str):  # (Python 3)
+        data = data.decode('latin-1')
+    decoder = json.JSONDecoder()
+    skip = lambda idx: _whitespace_regex.match(data, idx).end()
+    entries = []
+    try:
+        idx = skip(0)
+        if data[idx] != '{':
+            raise ValueError
+        idx = skip(idx + 1)
+        while data[idx] != '}':
+            start = idx
+            _, idx = decoder.raw_decode(data, idx)
+            key = json.loads(raw[start:idx].decode('utf-8'))
+            idx = skip(idx)
+            if data[idx] != ':':
+                raise ValueError
+            _, idx = decoder.raw_decode(data, skip(idx + 1))
+            entries.append((key, start, idx))
+            idx = skip(idx)
+            if data[idx] == ',':
+                idx = skip(idx + 1)
+    except (IndexError, ValueError):
+        raise ValueError("Listing is not a complete JSON object")
+    return entries
+
+
+def _scan_jsonl(f):
+    """
+    As for :func:`_scan_legacy`, over the records of a JSON Lines listing
+    (positioned just after the header line).
+    """
+    entries = []
+    offset = f.tell()
+    while True:
+        line = f.readline()
+        if not line:
+            break
+        if line.strip():
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                if not line.endswith(b'\n'):
+                    # (A final record cut short, e.g. by a crash mid-write)
+                    break
+                raise
+            for key in record:
+                entries.append((key, offset, offset + len(line)))
+        offset += len(line)
+    return entries
+
+
+def build_offset_index(listing_path):
+    """
+    Scan the listing at ``listing_path``.
+
+    Returns:
+        dict: The listing ``format``, ``datatype`` and ``offsets`` (a dict
+        mapping each entry key to its ``[start, end]`` byte range), plus the
+        listing's ``size`` and ``mtime``.
+    """
+    fingerprint = rawfile_fingerprint(listing_path)
+    with open(listing_path, 'rb') as f:
+        header = _parse_jsonl_header(f.readline().decode('utf-8'))
+        if header is not None:
+            listing_format = _jsonl_format
+            datatype = header[Datatype.magic_key]
+            entries = _scan_jsonl(f)
+        else:
+            listing_format = _legacy_format
+            datatype = None
+            f.seek(0)
+            entries = _scan_legacy(f.read())
+    offsets = {}
+    for key, start, end in entries:
+        offsets[key] = [start, end]
+    if listing_format == _legacy_format and Datatype.magic_key in offsets:
+        start, end = offsets.pop(Datatype.magic_key)
+        with open(listing_path, 'rb') as f:
+            f.seek(start)
+            datatype = _decode_entry(f.read(end - start),
+                                     _legacy_format)[1]
+    return {'format': listing_format, 'datatype': datatype,
+            'offsets': offsets,
+            'size': fingerprint[0], 'mtime': fingerprint[1]}
+
+
+def _decode_entry(text, listing_format):
+    """Decode the text of an entry, returning ``(key, value)``."""
+    text = text.decode('utf-8')
+    if listing_format == _legacy_format:
+        text = '{' + text + '}'
+    return next(iter(json.loads(text).items()))
+
+
+def load_offset_index(listing_path, offsets_path=None):
+    """
+    Load the cached offset index for a listing, rebuilding (and re-caching)
+    it if missing or out of date.
+    """
+    if offsets_path is None:
+        offsets_path = offsets_path_for_listing(listing_path)
+    fingerprint = rawfile_fingerprint(listing_path)
+    if fingerprint is None:
+        raise IOError("Cannot access listing " + listing_path)
+    if os.path.exists(offsets_path):
+        try:
+            with open(offsets_path) as f:
+                index = json.load(f)
+            if (index['size'], index['mtime']) == fingerprint:
+                return index
+        except (ValueError, KeyError):
+            pass
+        logger.info("Offset index %s is stale, rebuilding", offsets_path)
+    index = build_offset_index(listing_path)
+    tmp_path = offsets_path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp_path, offsets_path)
+    except (IOError, OSError):
+        logger.warning("Could not cache listing offsets at %s",
+                       offsets_path)
+    return index
+
+
+class LazyListing(Mapping):
+    """
+    Read-only mapping over the entries of a listing, decoding each entry
+    from the file when accessed. (Use :func:`open_listing` to create.)
+    """
+
+    def __init__(self, listing_path, index):
+        self.path = listing_path
+        self.datatype = index['datatype']
+        self._format = index['format']
+        self._offsets = index['offsets']
+        self._file = open(listing_path, 'rb')
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        start, end = self._offsets[key]
+        with self._lock:
+            self._file.seek(start)
+            text = self._file.read(end - start)
+        return _decode_entry(text, self._format)[1]
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, key):
+        return key in self._offsets
+
+    def select(self, keys):
+        """
+        Returns:
+            dict: The entries for ``keys`` (raises KeyError for any missing).
+        """
+        return dict((key, self[key]) for key in keys)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_listing(listing_path, expected_datatype=None, offsets_path=None):
+    """
+    Open a listing for lazy access.
+
+    Args:
+        listing_path: Path to a JSON (or JSON Lines) listing.
+        expected_datatype: If defined, raise a ValueError if the listing
+            is of a different datatype.
+        offsets_path: Location of the cached offset index
+            (default: see :func:`offsets_path_for_listing`).
+
+    Returns:
+        LazyListing: Read-only mapping of the listing entries.
+    """
+    index = load_offset_index(listing_path, offsets_path)
+    if index['datatype'] is None:
+        raise ValueError(
+            "{} does not appear to be an AMI listing".format(listing_path))
+    _check_datatype({Datatype.magic_key: index['datatype']}, listing_path,
+                    expected_datatype)
+    return LazyListing(listing_path, index)
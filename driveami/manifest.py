@@ -0,0 +1,105 @@
+"""
+Manifests recording how calibrated outputs were produced.
+
+Each group output directory gets a manifest, stored alongside its ``ami/``
+folder. For every rawfile reduced into that folder, the manifest records a
+key hashed from everything that determines the output: the reduction script,
+the write-command overrides, the ``reduce`` version, and the rawfile's size
+and mtime. If nothing has changed since the last run, the reduction can be
+skipped and the previously written info loaded instead.
+"""
+from __future__ import absolute_import
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import driveami.keys as keys
+from driveami.cache import rawfile_fingerprint
+from driveami.serialization import restore_file_info
+
+logger = logging.getLogger(__name__)
+
+
+def _sha1(text):
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+
+def result_key(script, write_command_overrides, reduce_version,
+               rawfile_path):
+    """
+    Returns:
+        tuple: (key, components) - a hash identifying this reduction, and a
+        dict of the values it was derived from.
+    """
+    components = {
+        'script_sha1': _sha1(script),
+        'write_command_overrides': write_command_overrides,
+        'reduce_version': reduce_version,
+        'rawfile_fingerprint': rawfile_fingerprint(rawfile_path),
+    }
+    key = _sha1(json.dumps(components, sort_keys=True))
+    return key, components
+
+
+class ResultManifest(object):
+    """
+    Per-group-directory record of up-to-date reduction outputs.
+
+    Safe to share between threads; saved to disk each time an entry is
+    recorded.
+    """
+    filename = 'ami_manifest.json'
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    @classmethod
+    def for_output_dir(cls, output_dir):
+        """Load the manifest stored alongside ``output_dir``."""
+        group_dir = os.path.dirname(os.path.abspath(output_dir))
+        return cls(os.path.join(group_dir, cls.filename))
+
+    def load_if_current(self, rawfile, key, output_dir):
+        """
+        Returns:
+            dict: The file info previously saved for ``rawfile``, if it was
+            produced with the same ``key`` and its outputs still exist.
+            Otherwise ``None``.
+        """
+        with self._lock:
+            entry = self.entries.get(rawfile)
+        if entry is None or entry['key'] != key:
+            return None
+        info_path = os.path.join(output_dir, entry['info_file'])
+        if not os.path.isfile(info_path):
+            return None
+        with open(info_path) as f:
+            info = restore_file_info(json.load(f))
+        for uvfits_key in (keys.target_uvfits, keys.cal_uvfits):
+            if uvfits_key in info and not os.path.isfile(info[uvfits_key]):
+                return None
+        return info
+
+    def record(self, rawfile, key, components, info_file):
+        """Record an up-to-date output, and save the manifest."""
+        with self._lock:
+            self.entries[rawfile] = {'key': key,
+                                     'components': components,
+                                     'info_file': info_file}
+            self._save()
+
+    def _save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.entries, f, sort_keys=True, indent=4)
+        os.rename(temp_path, self.path)
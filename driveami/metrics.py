@@ -0,0 +1,134 @@
+"""
+Aggregation and export of the per-command timings recorded by
+:class:`.Reduce` (see ``keys.command_timings``).
+
+Timings are grouped by :func:`command_key`, so e.g. all the
+``flag amp field ...`` variants of a script are summarised together.
+"""
+from __future__ import absolute_import
+import json
+import os
+import re
+from collections import defaultdict
+
+import numpy as np
+
+import driveami.keys as keys
+
+_argument_regex = re.compile(r'[0-9./\\]|^(yes|no|y|n)$', re.I)
+
+
+def command_key(command):
+    """
+    Reduce a command to the words naming it, dropping its arguments.
+
+    E.g. ``'flag amp field no 0.95 1 yes \\'`` -> ``'flag amp field'``,
+    ``'file SWIFT_590206-140305.raw \\'`` -> ``'file'``.
+    """
+    words = []
+    for word in command.split():
+        if _argument_regex.search(word):
+            break
+        words.append(word.lower())
+    return ' '.join(words[:3]) or '(blank)'
+
+
+class CommandTimings(object):
+    """
+    Collects command timings over a run, e.g. from each processed rawfile.
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.output_bytes = defaultdict(int)
+
+    def add(self, command, seconds, output_bytes=0):
+        key = command_key(command)
+        self.durations[key].append(seconds)
+        self.output_bytes[key] += output_bytes
+
+    def add_file_info(self, file_info):
+        """Add the timings recorded in a rawfile's info dict."""
+        for record in file_info.get(keys.command_timings, []):
+            self.add(record['command'], record['seconds'],
+                     record['output_bytes'])
+
+    def summary(self):
+        """
+        Returns:
+            dict: Per-command-key statistics: ``count``, ``total_seconds``,
+            ``p50_seconds``, ``p95_seconds``, ``max_seconds`` and
+            ``output_bytes``.
+        """
+        summary = {}
+        for key, durations in self.durations.items():
+            p50, p95 = np.percentile(durations, [50, 95])
+            summary[key] = {'count': len(durations),
+                            'total_seconds': float(np.sum(durations)),
+                            'p50_seconds': float(p50),
+                            'p95_seconds': float(p95),
+                            'max_seconds': float(np.max(durations)),
+                            'output_bytes': self.output_bytes[key]}
+        return summary
+
+    def write_json_summary(self, path, **extra):
+        """
+        Write the :meth:`summary` as JSON, under ``'commands'``, alongside
+        any extra run-level values passed as keyword arguments.
+        """
+        doc = dict(extra)
+        doc['commands'] = self.summary()
+        _write_atomically(path, json.dumps(doc, sort_keys=True, indent=4))
+
+    def write_prometheus_textfile(self, path, prefix='driveami'):
+        """
+        Write the timings in the Prometheus text exposition format, e.g.
+        for collection by node_exporter's textfile collector.
+        """
+        duration = prefix + '_command_duration_seconds'
+        duration_max = prefix + '_command_duration_max_seconds'
+        output = prefix + '_command_output_bytes_total'
+        lines = [
+            '# HELP {} Wall-clock duration of AMI-reduce commands.'.format(
+                duration),
+            '# TYPE {} summary'.format(duration)]
+        summary = self.summary()
+        for key in sorted(summary):
+            stats = summary[key]
+            label = 'command="{}"'.format(_escape_label(key))
+            for quantile, stat in (('0.5', 'p50_seconds'),
+                                   ('0.95', 'p95_seconds')):
+                lines.append('{}{{{},quantile="{}"}} {!r}'.format(
+                    duration, label, quantile, stats[stat]))
+            lines.append('{}_sum{{{}}} {!r}'.format(
+                duration, label, stats['total_seconds']))
+            lines.append('{}_count{{{}}} {}'.format(
+                duration, label, stats['count']))
+        lines.extend([
+            '# HELP {} Longest duration of each AMI-reduce command.'.format(
+                duration_max),
+            '# TYPE {} gauge'.format(duration_max)])
+        for key in sorted(summary):
+            lines.append('{}{{command="{}"}} {!r}'.format(
+                duration_max, _escape_label(key),
+                summary[key]['max_seconds']))
+        lines.extend([
+            '# HELP {} Output produced by AMI-reduce commands.'.format(output),
+            '# TYPE {} counter'.format(output)])
+        for key in sorted(summary):
+            lines.append('{}{{command="{}"}} {}'.format(
+                output, _escape_label(key), summary[key]['output_bytes']))
+        _write_atomically(path, '\n'.join(lines) + '\n')
+
+
+def _escape_label(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _write_atomically(path, text):
+    # (So a collector never reads a half-written file.)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.rename(tmp_path, path)
@@ -0,0 +1,282 @@
+"""
+Extraction of metrics from the output of ``reduce`` commands.
+
+Each metric is described by a :class:`LineMetric`, which names the commands
+whose output carries it, and a compiled regex picking out the relevant
+lines. An :class:`OutputParser` holds the registered metrics, and walks the
+output of a command exactly once, handing matching lines to the relevant
+extractors.
+
+New metrics can be added without touching :mod:`driveami.reduce`, e.g.::
+
+    driveami.parsing.register(LineMetric(
+        'n_baselines', command='show base',
+        pattern=r'(\\d+) baselines', extract=lambda m, line: int(m.group(1))))
+
+after which ``n_baselines`` is reported in
+:attr:`.Reduce.last_output_metrics` for any command containing
+``'show base'``. Pass an ``update`` function to also store the value in the
+active file's info dict.
+"""
+from __future__ import absolute_import
+import logging
+import re
+
+import driveami.keys as keys
+
+logger = logging.getLogger(__name__)
+
+
+class LineMetric(object):
+    """
+    A metric extracted from the output of a class of ``reduce`` commands.
+
+    Args:
+        name (str): Key under which the value is reported.
+        command (str): Substring identifying the commands whose output
+            carries this metric.
+        pattern (str): Regex picking out the relevant output lines (applied
+            with ``search``).
+        extract: Called as ``extract(match, line)`` for each matching line,
+            returning the value. Returning None means 'no value on this
+            line'. Default: True for any matching line.
+        mode (str): Which value to report if several lines match - one of
+            ``'first'``, ``'last'`` or ``'any'`` (True if any line matched).
+        default: Reported if no line yields a value.
+        update: Optional; called as ``update(reduce, file_info, value)`` to
+            store the value in the active file's info dict.
+    """
+    modes = ('first', 'last', 'any')
+
+    def __init__(self, name, command, pattern, extract=None, mode='first',
+                 default=None, update=None):
+        if mode not in self.modes:
+            raise ValueError("Unknown mode '{}', choose from {}".format(
+                mode, self.modes))
+        self.name = name
+        self.command = command
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.extract = extract
+        self.mode = mode
+        self.default = default
+        if mode == 'any' and default is None:
+            self.default = False
+        self.update = update
+
+    def applies_to(self, command):
+        return self.command in command
+
+
+class _ParsePlan(object):
+    """The metrics relevant to one command, with a combined line filter."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        if metrics:
+            self.prefilter = re.compile(
+                '|'.join('(?:{})'.format(m.pattern) for m in metrics),
+                re.MULTILINE)
+        else:
+            self.prefilter = None
+
+    def parse(self, output):
+        state = _ParseState(self.metrics)
+        if self.prefilter is None:
+            return state.results
+        search = self.prefilter.search
+        # Let the regex engine skip over the (vast majority of) lines of no
+        # interest, and only split out those which contain a candidate match:
+        match = search(output)
+        while match is not None and state.pending:
+            line_start = output.rfind('\n', 0, match.start()) + 1
+            line_end = output.find('\n', match.end())
+            if line_end == -1:
+                line_end = len(output)
+            state.dispatch(output[line_start:line_end])
+            match = search(output, line_end + 1)
+        return state.results
+
+
+class _ParseState(object):
+    """Metric values accumulated so far from the output of one command."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.results = dict((m.name, m.default) for m in metrics)
+        self.pending = set(m.name for m in metrics)
+
+    def dispatch(self, line):
+        for m in self.metrics:
+            if m.name not in self.pending:
+                continue
+            line_match = m.regex.search(line)
+            if line_match is None:
+                continue
+            value = True if m.extract is None else m.extract(line_match, line)
+            if value is None:
+                continue
+            self.results[m.name] = value
+            if m.mode != 'last':
+                self.pending.discard(m.name)
+
+
+class LineFeed(object):
+    """
+    Incremental parse of a command's output, fed one line at a time.
+
+    Obtain via :meth:`OutputParser.line_feed`; once the command has
+    finished, :attr:`results` holds the same values :meth:`OutputParser.parse`
+    would have returned for the full output.
+    """
+
+    def __init__(self, plan):
+        self._state = _ParseState(plan.metrics)
+        self._prefilter = plan.prefilter
+
+    def feed(self, line):
+        if (self._prefilter is not None and self._state.pending and
+                self._prefilter.search(line)):
+            self._state.dispatch(line)
+
+    @property
+    def results(self):
+        return self._state.results
+
+
+class OutputParser(object):
+    """
+    Registry of :class:`LineMetric` extractors.
+
+    The set of metrics relevant to each distinct command string is worked
+    out once and cached, so parsing the output of a repeated command costs
+    a single pass over its lines.
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = []
+        self._plans = {}
+        for m in metrics or []:
+            self.register(m)
+
+    def register(self, metric):
+        """Add a metric, replacing any existing metric of the same name."""
+        self.metrics = [m for m in self.metrics if m.name != metric.name]
+        self.metrics.append(metric)
+        self._plans = {}
+
+    def _plan_for(self, command):
+        plan = self._plans.get(command)
+        if plan is None:
+            plan = _ParsePlan([m for m in self.metrics
+                               if m.applies_to(command)])
+            self._plans[command] = plan
+        return plan
+
+    def parse(self, command, output):
+        """
+        Args:
+            command (str): The command which was run.
+            output (str): Its output, as a single string.
+
+        Returns:
+            dict: Metric values keyed by name, for each metric relevant to
+            ``command``.
+        """
+        return self._plan_for(command).parse(output)
+
+    def line_feed(self, command):
+        """
+        Returns:
+            LineFeed: For parsing the output of ``command`` as it arrives.
+        """
+        return LineFeed(self._plan_for(command))
+
+    def apply(self, reduce, command, metrics, file_info):
+        """Store parsed metric values in ``file_info``, where so configured."""
+        for m in self._plan_for(command).metrics:
+            if m.update is not None:
+                m.update(reduce, file_info, metrics[m.name])
+
+
+def _total_flagged_percentage(match, line):
+    if 'Total of' not in line:
+        return None
+    for t in line.split():
+        if '%' in t:
+            return float(t.strip('%'))
+
+
+def _store_rain(reduce, file_info, rain_amp_corr):
+    file_info[keys.rain] = rain_amp_corr
+    if rain_amp_corr is None:
+        logger.warning("Could not parse rain modulation for {}.".format(
+            reduce.active_file))
+
+
+def _store_flagged_max(reduce, file_info, flagging):
+    previous_max = file_info.get(keys.flagged_max, None)
+    # (NB avoids comparisons against None, which fail under Python 3)
+    if previous_max is None or (flagging is not None and
+                                flagging > previous_max):
+        file_info[keys.flagged_max] = flagging
+
+
+def _store_noise(reduce, file_info, est_noise):
+    if est_noise is None:
+        raise ValueError("Parsing error, could not find noise estimate.")
+    file_info[keys.est_noise_jy] = est_noise
+
+
+def _store_archive_cal_unavailable(reduce, file_info, unavailable):
+    file_info[keys.archive_cal_available] = not unavailable
+
+
+def _store_cal_days_apart(reduce, file_info, days_apart):
+    file_info[keys.archive_cal_days_apart] = days_apart
+
+
+rain = LineMetric(
+    'rain', command='apply rain',
+    pattern=r'Mean amplitude correction factor',
+    extract=lambda m, line: float(line.strip().split()[-1]),
+    update=_store_rain)
+
+flagging = LineMetric(
+    'flagging', command='flag',
+    pattern=r'samples flagged',
+    extract=_total_flagged_percentage,
+    update=_store_flagged_max)
+
+est_noise = LineMetric(
+    'est_noise', command='reweight',
+    pattern=r'estimated noise',
+    extract=lambda m, line: float(line.strip().split()[-2]),
+    update=_store_noise)
+
+archive_cal_unavailable = LineMetric(
+    'archive_cal_unavailable', command='cal inter',
+    pattern=r'fluxes for this source not available',
+    mode='any',
+    update=_store_archive_cal_unavailable)
+
+archive_cal_days_apart = LineMetric(
+    'archive_cal_days_apart', command='cal inter',
+    pattern=r'days apart',
+    extract=lambda m, line: float(line.strip().split()[6]),
+    mode='last',
+    update=_store_cal_days_apart)
+
+incomplete = LineMetric(
+    'incomplete', command='file ',
+    pattern=r'incomplete observation',
+    mode='any')
+
+default_parser = OutputParser([rain, flagging, est_noise,
+                               archive_cal_unavailable, archive_cal_days_apart,
+                               incomplete])
+
+
+def register(metric):
+    """Register a :class:`LineMetric` with the default parser."""
+    default_parser.register(metric)
@@ -0,0 +1,396 @@
+"""
+Clustering of sky pointings.
+
+Pointings are converted to 3D unit vectors, so separations are simple
+chord-length comparisons and there's no special handling needed for the
+RA wrap or the poles. Candidate neighbours are found with a sweep over
+declination-sorted positions (any pair closer than the tolerance must also
+be closer than the tolerance in declination), and clusters are built from
+the neighbour pairs with a union-find.
+"""
+from __future__ import absolute_import
+import numpy as np
+
+import driveami.keys as keys
+
+
+def unit_vectors(ra_deg, dec_deg):
+    """
+    Returns:
+        numpy.ndarray: Array of shape (n, 3), one unit vector per position.
+    """
+    ra = np.radians(np.asarray(ra_deg, dtype=float))
+    dec = np.radians(np.asarray(dec_deg, dtype=float))
+    cos_dec = np.cos(dec)
+    return np.column_stack((cos_dec * np.cos(ra),
+                            cos_dec * np.sin(ra),
+                            np.sin(dec)))
+
+
+def chord_to_degrees(chord):
+    """Convert chord length(s) between unit vectors to angular separation."""
+    return np.degrees(2.0 * np.arcsin(np.clip(np.asarray(chord) / 2.0,
+                                              0.0, 1.0)))
+
+
+def degrees_to_chord(angle_deg):
+    """Convert angular separation(s) to chord length between unit vectors."""
+    return 2.0 * np.sin(np.radians(np.asarray(angle_deg, dtype=float)) / 2.0)
+
+
+def neighbour_pairs(ra_deg, dec_deg, max_separation_deg):
+    """
+    Find all pairs of positions separated by less than ``max_separation_deg``.
+
+    Returns:
+        tuple: (i, j, separation_deg) arrays, with ``i < j`` indexing the
+        input positions.
+    """
+    dec_deg = np.asarray(dec_deg, dtype=float)
+    n = len(dec_deg)
+    if n < 2:
+        return (np.zeros(0, dtype=int), np.zeros(0, dtype=int),
+                np.zeros(0, dtype=float))
+    order = np.argsort(dec_deg, kind='mergesort')
+    sorted_dec = dec_deg[order]
+    vectors = unit_vectors(np.asarray(ra_deg, dtype=float)[order], sorted_dec)
+    max_chord_sq = degrees_to_chord(max_separation_deg) ** 2
+    # For each position, the end of the run of positions which are within
+    # range in declination alone:
+    window_ends = np.searchsorted(sorted_dec, sorted_dec + max_separation_deg,
+                                  side='right')
+
+    i_chunks, j_chunks, chord_sq_chunks = [], [], []
+    for k in range(n - 1):
+        end = window_ends[k]
+        if end <= k + 1:
+            continue
+        offsets = vectors[k + 1:end] - vectors[k]
+        chord_sq = np.einsum('ij,ij->i', offsets, offsets)
+        close = np.nonzero(chord_sq < max_chord_sq)[0]
+        if len(close):
+            i_chunks.append(np.repeat(k, len(close)))
+            j_chunks.append(close + k + 1)
+            chord_sq_chunks.append(chord_sq[close])
+
+    if not i_chunks:
+        return (np.zeros(0, dtype=int), np.zeros(0, dtype=int),
+                np.zeros(0, dtype=float))
+    i = order[np.concatenate(i_chunks)]
+    j = order[np.concatenate(j_chunks)]
+    separation = chord_to_degrees(np.sqrt(np.concatenate(chord_sq_chunks)))
+    swap = i > j
+    i[swap], j[swap] = j[swap], i[swap]
+    return i, j, separation
+
+
+class UnionFind(object):
+    """Disjoint-set forest over the integers ``0 .. n-1``."""
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, x):
+        parent = self.parent
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    def union(self, x, y):
+        """Merge the sets containing x and y; returns False if already joined."""
+        root_x, root_y = self.find(x), self.find(y)
+        if root_x == root_y:
+            return False
+        # Keep the lowest index as root, so results don't depend on the
+        # order in which pairs are merged.
+        if root_y < root_x:
+            root_x, root_y = root_y, root_x
+        self.parent[root_y] = root_x
+        return True
+
+    def clusters(self):
+        """
+        Returns:
+            list: Clusters as sorted lists of members, ordered by first member.
+        """
+        members = {}
+        for x in range(len(self.parent)):
+            members.setdefault(self.find(x), []).append(x)
+        return [members[root] for root in sorted(members)]
+
+
+def friends_of_friends(ra_deg, dec_deg, tolerance_deg):
+    """
+    Single-linkage ('friends of friends') clustering of sky positions.
+
+    Any two positions separated by less than ``tolerance_deg`` end up in the
+    same cluster.
+
+    Returns:
+        list: Clusters as sorted lists of indices into the input positions,
+        ordered by first index.
+    """
+    i, j, _ = neighbour_pairs(ra_deg, dec_deg, tolerance_deg)
+    uf = UnionFind(len(np.atleast_1d(ra_deg)))
+    for x, y in zip(i.tolist(), j.tolist()):
+        uf.union(x, y)
+    return uf.clusters()
+
+
+def pointing_groups_from_clusters(target_id_groups, target_ids, clusters):
+    """
+    Build a pointing-groups dict, as returned by
+    :meth:`.Reduce.group_target_ids_by_pointing`.
+
+    Args:
+        target_id_groups: Target-id groups dict (files and median pointing).
+        target_ids: List of target ids, indexed by the clusters.
+        clusters: Lists of indices into ``target_ids``.
+    """
+    pointing_groups_dict = {}
+    for cluster in clusters:
+        cluster_ids = sorted(target_ids[idx] for idx in cluster)
+        first_id = cluster_ids[0]
+        pointing_groups_dict[first_id] = {}
+        pointing_groups_dict[first_id][keys.target_pointing_deg] = (
+            target_id_groups[first_id][keys.target_pointing_deg])
+        pointing_groups_dict[first_id][keys.files] = []
+        for target_id in cluster_ids:
+            pointing_groups_dict[first_id][keys.files].extend(
+                target_id_groups[target_id][keys.files])
+    return pointing_groups_dict
+
+
+class PointingTree(object):
+    """
+    Single-linkage hierarchy over target pointings.
+
+    Stores a minimum spanning forest of the target pointings, including all
+    edges shorter than ``max_tolerance_deg``. The friends-of-friends grouping
+    at any tolerance up to that maximum is then just the connected components
+    of the forest edges shorter than the tolerance, so grouping at a new
+    tolerance needs no further separation calculations.
+    """
+
+    def __init__(self, target_ids, ra, dec, edges, max_tolerance_deg):
+        """
+        Args:
+            target_ids: List of target ids.
+            ra, dec: Median pointing of each target id, in degrees.
+            edges: Forest edges as ``(i, j, separation_deg)`` arrays,
+                sorted by separation.
+            max_tolerance_deg: Largest tolerance the tree can group at.
+        """
+        self.target_ids = list(target_ids)
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+        self.edges = tuple(edges)
+        self.max_tolerance_deg = max_tolerance_deg
+
+    @classmethod
+    def build(cls, target_id_groups, max_tolerance_deg):
+        """Build the tree from a target-id groups dict."""
+        target_ids = sorted(target_id_groups.keys())
+        pointings = [target_id_groups[id][keys.target_pointing_deg]
+                     for id in target_ids]
+        ra = [ra_dec[0] for ra_dec in pointings]
+        dec = [ra_dec[1] for ra_dec in pointings]
+        return cls(target_ids, ra, dec,
+                   minimum_spanning_forest(ra, dec, max_tolerance_deg),
+                   max_tolerance_deg)
+
+    def clusters(self, tolerance_deg):
+        """
+        Returns:
+            list: Clusters at the given tolerance, as sorted lists of indices
+            into ``target_ids``, ordered by first index.
+        """
+        if tolerance_deg > self.max_tolerance_deg:
+            raise ValueError(
+                "Tolerance {} exceeds the maximum ({}) this tree was "
+                "built for.".format(tolerance_deg, self.max_tolerance_deg))
+        i, j, separation = self.edges
+        n_edges = np.searchsorted(separation, tolerance_deg, side='left')
+        uf = UnionFind(len(self.target_ids))
+        for x, y in zip(i[:n_edges].tolist(), j[:n_edges].tolist()):
+            uf.union(x, y)
+        return uf.clusters()
+
+    def update(self, target_id_groups, updated_ids):
+        """
+        Insert new target ids, and move those whose median pointing changed.
+
+        Only the parts of the forest near the updated ids are rebuilt: the
+        forest components (at ``max_tolerance_deg``) which contained them,
+        plus any components now within range of their new pointings.
+        The result is the same as rebuilding the whole tree from scratch.
+
+        Args:
+            target_id_groups: Target-id groups dict, including the updates.
+            updated_ids: Target ids which are new, or whose median pointing
+                has changed.
+        """
+        index = dict((id, idx) for idx, id in enumerate(self.target_ids))
+        ra, dec = self.ra.tolist(), self.dec.tolist()
+        updated_idx = []
+        for id in sorted(updated_ids):
+            pointing = target_id_groups[id].get(keys.target_pointing_deg)
+            if pointing is None:
+                continue
+            if id not in index:
+                index[id] = len(self.target_ids)
+                self.target_ids.append(id)
+                ra.append(None)
+                dec.append(None)
+            ra[index[id]], dec[index[id]] = pointing
+            updated_idx.append(index[id])
+        if not updated_idx:
+            return
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+
+        # Label the forest components (new ids are singletons):
+        i, j, separation = self.edges
+        uf = UnionFind(len(self.target_ids))
+        for x, y in zip(i.tolist(), j.tolist()):
+            uf.union(x, y)
+        roots = np.array([uf.find(x) for x in range(len(self.target_ids))])
+
+        vectors = unit_vectors(self.ra, self.dec)
+        max_chord_sq = degrees_to_chord(self.max_tolerance_deg) ** 2
+        affected = set(roots[updated_idx].tolist())
+        for idx in updated_idx:
+            offsets = vectors - vectors[idx]
+            chord_sq = np.einsum('ij,ij->i', offsets, offsets)
+            affected.update(roots[chord_sq < max_chord_sq].tolist())
+
+        in_affected = np.in1d(roots, list(affected))
+        members = np.nonzero(in_affected)[0]
+        sub_i, sub_j, sub_separation = minimum_spanning_forest(
+            self.ra[members], self.dec[members], self.max_tolerance_deg)
+        keep = ~in_affected[i]
+        i = np.concatenate((i[keep], members[sub_i]))
+        j = np.concatenate((j[keep], members[sub_j]))
+        separation = np.concatenate((separation[keep], sub_separation))
+        order = np.argsort(separation, kind='mergesort')
+        self.edges = (i[order], j[order], separation[order])
+
+    def group(self, target_id_groups, tolerance_deg):
+        """
+        Equivalent to :meth:`.Reduce.group_target_ids_by_pointing` at the
+        given tolerance.
+        """
+        return pointing_groups_from_clusters(target_id_groups,
+                                             self.target_ids,
+                                             self.clusters(tolerance_deg))
+
+    def group_by_tolerances(self, target_id_groups, tolerances_deg):
+        """
+        Returns:
+            dict: Mapping tolerance -> pointing-groups dict.
+        """
+        return dict((tolerance, self.group(target_id_groups, tolerance))
+                    for tolerance in tolerances_deg)
+
+    def to_dict(self):
+        """JSON-serializable representation, see also
+        :func:`driveami.serialization.save_pointing_tree`."""
+        i, j, separation = self.edges
+        return {'max_tolerance_deg': self.max_tolerance_deg,
+                'target_ids': self.target_ids,
+                'ra_deg': self.ra.tolist(),
+                'dec_deg': self.dec.tolist(),
+                'edges': [i.tolist(), j.tolist(), separation.tolist()]}
+
+    @classmethod
+    def from_dict(cls, d):
+        i, j, separation = d['edges']
+        edges = (np.asarray(i, dtype=int), np.asarray(j, dtype=int),
+                 np.asarray(separation, dtype=float))
+        return cls(d['target_ids'], d['ra_deg'], d['dec_deg'], edges,
+                   d['max_tolerance_deg'])
+
+
+def minimum_spanning_forest(ra_deg, dec_deg, max_separation_deg):
+    """
+    Kruskal's algorithm over all pairs closer than ``max_separation_deg``.
+
+    Returns:
+        tuple: (i, j, separation_deg) arrays of forest edges, sorted by
+        separation.
+    """
+    i, j, separation = neighbour_pairs(ra_deg, dec_deg, max_separation_deg)
+    order = np.argsort(separation, kind='mergesort')
+    uf = UnionFind(len(np.atleast_1d(ra_deg)))
+    keep = [idx for idx, x, y in zip(order.tolist(), i[order].tolist(),
+                                      j[order].tolist())
+            if uf.union(x, y)]
+    keep = np.asarray(keep, dtype=int)
+    return i[keep], j[keep], separation[keep]
+
+
+def merge_pointing_groups(previous_pointing_groups, target_id_groups,
+                          pointing_tree, tolerance_deg):
+    """
+    Incrementally update a pointing-groups listing.
+
+    Target ids are grouped as for :meth:`PointingTree.group`, except that
+    the membership of the previous groups is also respected: groups may be
+    merged (e.g. when a new pointing bridges two of them), but are never
+    split. Each group keeps the key of the earliest-sorting previous group
+    it contains, so output directories named after the keys stay put.
+    Entirely new groups are keyed by their first sorted target id.
+
+    Args:
+        previous_pointing_groups: Previous pointing-groups dict.
+        target_id_groups: Up to date target-id groups dict.
+        pointing_tree: A :class:`PointingTree`, updated to match
+            ``target_id_groups``.
+        tolerance_deg: Pointing tolerance.
+
+    Returns:
+        dict: Updated pointing-groups dict.
+    """
+    target_ids = pointing_tree.target_ids
+    index = dict((id, idx) for idx, id in enumerate(target_ids))
+    target_id_of_file = {}
+    for target_id, group in target_id_groups.items():
+        for filename in group[keys.files]:
+            target_id_of_file[filename] = target_id
+
+    uf = UnionFind(len(target_ids))
+    for cluster in pointing_tree.clusters(tolerance_deg):
+        for idx in cluster[1:]:
+            uf.union(cluster[0], idx)
+    previous_key = {}
+    for key, group in previous_pointing_groups.items():
+        members = sorted(set(index[target_id_of_file[filename]]
+                             for filename in group[keys.files]
+                             if target_id_of_file.get(filename) in index))
+        for idx in members:
+            previous_key[idx] = key
+            uf.union(members[0], idx)
+
+    pointing_groups_dict = {}
+    for cluster in uf.clusters():
+        cluster_ids = sorted(target_ids[idx] for idx in cluster)
+        keys_found = sorted(set(previous_key[idx] for idx in cluster
+                                if idx in previous_key))
+        if keys_found:
+            group_key = keys_found[0]
+        else:
+            group_key = cluster_ids[0]
+        # (Group keys are target ids, unless the listing was hand-edited)
+        source = (target_id_groups.get(group_key) or
+                  previous_pointing_groups[group_key])
+        pointing_groups_dict[group_key] = {
+            keys.target_pointing_deg: source[keys.target_pointing_deg],
+            keys.files: []}
+        for target_id in cluster_ids:
+            pointing_groups_dict[group_key][keys.files].extend(
+                target_id_groups[target_id][keys.files])
+    return pointing_groups_dict
+
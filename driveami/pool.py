@@ -0,0 +1,176 @@
+"""
+Drive several AMI-reduce sessions at once.
+
+Each ``reduce`` child is a single-threaded process, so a lone
+:class:`.Reduce` instance can only ever keep one core busy.
+A :class:`ReducePool` owns several sessions and drives each from its own
+thread - pexpect spends nearly all its time blocked on the pty, so the
+threads happily share the interpreter.
+"""
+from __future__ import absolute_import
+import functools
+import logging
+import threading
+from collections import namedtuple
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import pexpect
+
+import driveami
+from driveami.manifest import ResultManifest
+from driveami.reduce import Reduce
+from driveami.supervisor import SupervisedReduce
+
+logger = logging.getLogger(__name__)
+
+RawfileJob = namedtuple('RawfileJob', 'rawfile output_dir script group_name')
+
+
+class ReducePool(object):
+    """
+    A pool of :class:`.Reduce` sessions, used to process rawfiles concurrently.
+
+    Rawfiles are handed out to whichever session is idle. If a session
+    hits a pexpect error (typically a timeout) it is retired, and the
+    remaining sessions carry on with the queued work - unless the pool is
+    supervised, in which case the session is replaced instead (see
+    :mod:`driveami.supervisor`).
+    """
+
+    def __init__(self, n_sessions, ami_rootdir, ami_version, array='LA',
+                 restart_log=None, **reduce_kwargs):
+        """
+        Spawn ``n_sessions`` AMI-REDUCE instances.
+
+        If a ``restart_log`` (:class:`driveami.supervisor.RestartLog`) is
+        supplied, the sessions are supervised, with any restarts recorded
+        in it.
+
+        Any extra keyword arguments are passed on to :class:`.Reduce`.
+        """
+        if n_sessions < 1:
+            raise ValueError("ReducePool requires at least one session.")
+        self.restart_log = restart_log
+        self.sessions = []
+        spawned = False
+        try:
+            for _ in range(n_sessions):
+                session = Reduce(ami_rootdir, ami_version, array=array,
+                                 **reduce_kwargs)
+                if restart_log is not None:
+                    session = SupervisedReduce(session, restart_log)
+                self.sessions.append(session)
+            spawned = True
+        finally:
+            if not spawned:
+                # Don't leave the sessions spawned so far running:
+                self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Exit all the sessions."""
+        for r in self.sessions:
+            try:
+                r.__exit__(None, None, None)
+            except (pexpect.ExceptionPexpect, OSError):
+                logger.debug("Error closing reduce session", exc_info=True)
+        self.sessions = []
+
+    def process_rawfiles(self, jobs, file_logging=True, incremental=False,
+                         force=False, on_result=None):
+        """
+        Apply :func:`driveami.process_rawfile` to each job, in parallel.
+
+        Args:
+            jobs: Iterable of :class:`RawfileJob`.
+            file_logging: Passed on to :func:`driveami.process_rawfile`.
+            incremental: Record outputs in a :class:`.ResultManifest` for each
+                output directory, and skip rawfiles whose outputs are
+                already up to date.
+            force: (With ``incremental``) reduce every rawfile regardless,
+                but still update the manifests.
+            on_result: Optional callback, called as
+                ``on_result(job, file_info)`` as each rawfile completes
+                (one call at a time, from the worker threads). The results
+                are then handed over rather than collected, so memory use
+                does not grow with the number of rawfiles.
+
+        Returns:
+            list: ``(job, file_info)`` pairs for each successfully processed
+            rawfile, in order of completion (empty, if ``on_result`` is
+            given).
+        """
+        job_queue = queue.Queue()
+        manifests = {}
+        for job in jobs:
+            if incremental and job.output_dir not in manifests:
+                manifests[job.output_dir] = (
+                    ResultManifest.for_output_dir(job.output_dir))
+            job_queue.put(job)
+        results = []
+        results_lock = threading.Lock()
+
+        workers = [threading.Thread(target=self._worker,
+                                    args=(r, job_queue, results,
+                                          results_lock, file_logging,
+                                          manifests, force, on_result))
+                   for r in self.sessions]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        for w in workers:
+            w.join()
+
+        if not job_queue.empty():
+            logger.error("All reduce sessions retired, %s rawfiles abandoned.",
+                         job_queue.qsize())
+        return results
+
+    def _worker(self, session, job_queue, results, results_lock, file_logging,
+                manifests, force, on_result):
+        if self.restart_log is not None:
+            process_rawfile = session.process_rawfile
+        else:
+            process_rawfile = functools.partial(driveami.process_rawfile,
+                                                reduce=session)
+        while True:
+            try:
+                job = job_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                logger.info("Reducing rawfile %s ...", job.rawfile)
+                file_info = process_rawfile(
+                    job.rawfile,
+                    output_dir=job.output_dir,
+                    script=job.script,
+                    file_logging=file_logging,
+                    manifest=manifests.get(job.output_dir),
+                    force=force)
+                if file_info is None:
+                    # (The supervised session was restarted)
+                    continue
+            except (ValueError, IOError) as e:
+                logger.exception("Hit exception reducing file: %s\n"
+                                 "Exception reads:\n%s\n",
+                                 job.rawfile, e)
+                continue
+            except Exception:
+                logger.exception(
+                    "Hit exception (probable timeout) reducing file: {}, "
+                    "retiring reduce session.".format(job.rawfile))
+                return
+            with results_lock:
+                if on_result is not None:
+                    on_result(job, file_info)
+                else:
+                    results.append((job, file_info))
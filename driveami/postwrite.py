@@ -0,0 +1,223 @@
+"""
+Check (and optionally compress) freshly written UVFITS in the background.
+
+Once a rawfile's UVFITS are written, a :class:`PostWritePipeline` takes them
+over: each file is checksummed and checked for a well-formed FITS structure
+(and optionally gzipped), in a pool of threads - so the I/O overlaps with
+the reduction of the next rawfile, rather than holding up the session.
+
+The results are recorded in the rawfile's info dict under
+``keys.uvfits_checks``, e.g.::
+
+    {'target_uvfits': {'path': '/data/GRB1234/ami/GRB1234-140310.fits.gz',
+                       'sha256': '9f86d0...',
+                       'bytes': 1503360,
+                       'compressed_bytes': 402117,
+                       'verified': True,
+                       'problem': None},
+     'calib_uvfits': {...}}
+
+(The checksum and size are of the uncompressed FITS.) A UVFITS which cannot
+be read (or compressed) is recorded as not verified, with the error as the
+``problem``.
+"""
+from __future__ import absolute_import
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from multiprocessing.pool import ThreadPool
+
+import driveami
+import driveami.keys as keys
+
+logger = logging.getLogger(__name__)
+
+fits_block_bytes = 2880
+_card_bytes = 80
+# Read this many FITS blocks at a time:
+_read_blocks = 256
+
+
+def check_fits(path, algorithm='sha256'):
+    """
+    Checksum the (uncompressed) FITS file at ``path``, checking its structure
+    along the way: a primary header starting with ``SIMPLE = T`` and
+    closed by an ``END`` card, and a whole number of 2880-byte blocks.
+
+    Returns:
+        dict: The ``algorithm`` checksum, ``bytes``, ``verified`` and
+        ``problem`` (None, or a description of what is wrong).
+    """
+    digest = hashlib.new(algorithm)
+    n_bytes = 0
+    problem = None
+    header_ended = False
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        while True:
+            chunk = f.read(fits_block_bytes * _read_blocks)
+            if not chunk:
+                break
+            if n_bytes == 0:
+                first_card = chunk[:_card_bytes]
+                if not (first_card.startswith(b'SIMPLE  =') and
+                        first_card[10:30].strip() == b'T'):
+                    problem = 'No SIMPLE = T card opening the primary header'
+            if not header_ended:
+                for start in range(0, len(chunk), _card_bytes):
+                    card = chunk[start:start + _card_bytes]
+                    if card[:8].rstrip() == b'END':
+                        header_ended = True
+                        break
+            digest.update(chunk)
+            n_bytes += len(chunk)
+    if problem is None:
+        if not n_bytes:
+            problem = 'Empty file'
+        elif not header_ended:
+            problem = 'No END card closing the primary header'
+        elif n_bytes % fits_block_bytes:
+            problem = 'Not a whole number of {}-byte blocks'.format(
+                fits_block_bytes)
+    return {algorithm: digest.hexdigest(),
+            'bytes': n_bytes,
+            'verified': problem is None,
+            'problem': problem}
+
+
+def gzip_file(path):
+    """
+    Compress ``path`` to ``path + '.gz'``, removing the original.
+
+    Returns:
+        str: The path of the compressed file.
+    """
+    gz_path = path + '.gz'
+    try:
+        with open(path, 'rb') as f_in:
+            with gzip.open(gz_path + '.tmp', 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+    except Exception:
+        if os.path.exists(gz_path + '.tmp'):
+            os.remove(gz_path + '.tmp')
+        raise
+    os.rename(gz_path + '.tmp', gz_path)
+    os.remove(path)
+    return gz_path
+
+
+class PostWritePipeline(object):
+    """
+    Checksums, verifies and (with ``compress``) gzips the UVFITS of each
+    rawfile submitted, using ``workers`` threads.
+    """
+
+    def __init__(self, workers=2, compress=False, algorithm='sha256'):
+        self.compress = compress
+        self.algorithm = algorithm
+        self._pool = ThreadPool(workers)
+        self._pending = 0
+        self._idle = threading.Condition()
+        # Serialises the ``on_done`` callbacks:
+        self._done_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, rawfile, file_info, output_dir=None, on_done=None):
+        """
+        Queue the UVFITS listed in ``file_info`` (``keys.target_uvfits``,
+        ``keys.cal_uvfits``) for processing, returning straight away.
+
+        The results are added to ``file_info`` (and if compressed, the
+        UVFITS paths updated). If ``output_dir`` is given, the rawfile's
+        info JSON there (see :func:`driveami.process_rawfile`) is re-saved
+        to match. Then ``on_done(rawfile, file_info)`` is called (one call
+        at a time, from the worker threads) - whatever the outcome, so a
+        rawfile with a bad UVFITS is still passed on.
+        """
+        with self._idle:
+            self._pending += 1
+        self._pool.apply_async(self._process,
+                               (rawfile, file_info, output_dir, on_done))
+
+    def wait(self):
+        """Wait until all the submitted rawfiles are done."""
+        with self._idle:
+            while self._pending:
+                self._idle.wait()
+
+    def close(self):
+        """Wait for the submitted rawfiles, then stop the worker threads."""
+        self.wait()
+        self._pool.close()
+        self._pool.join()
+
+    def _process(self, rawfile, file_info, output_dir, on_done):
+        try:
+            try:
+                self._check_uvfits(rawfile, file_info)
+                if output_dir is not None:
+                    self._save_info(rawfile, file_info, output_dir)
+            except Exception:
+                logger.exception("Error in post-write processing of %s",
+                                 rawfile)
+            if on_done is not None:
+                with self._done_lock:
+                    on_done(rawfile, file_info)
+        except Exception:
+            logger.exception("Error passing on %s after post-write "
+                             "processing", rawfile)
+        finally:
+            with self._idle:
+                self._pending -= 1
+                self._idle.notify_all()
+
+    def _check_uvfits(self, rawfile, file_info):
+        checks = file_info.setdefault(keys.uvfits_checks, {})
+        for info_key in (keys.target_uvfits, keys.cal_uvfits):
+            path = file_info.get(info_key)
+            if path is None:
+                continue
+            previous = checks.get(info_key, {})
+            if previous.get('path') == path and previous.get('verified'):
+                continue  # (Already done, e.g. in a previous run)
+            try:
+                checks[info_key] = self._process_uvfits(path)
+            except Exception as e:
+                # (E.g. a missing or truncated file)
+                checks[info_key] = {self.algorithm: None,
+                                    'bytes': None,
+                                    'compressed_bytes': None,
+                                    'verified': False,
+                                    'problem': '{}: {}'.format(
+                                        type(e).__name__, e),
+                                    'path': path}
+            file_info[info_key] = checks[info_key]['path']
+            if not checks[info_key]['verified']:
+                logger.warning("UVFITS for %s failed verification: "
+                               "%s (%s)", rawfile,
+                               checks[info_key]['problem'], path)
+
+    def _save_info(self, rawfile, file_info, output_dir):
+        info_path = os.path.join(output_dir, driveami._info_filename(rawfile))
+        saved_info = driveami.make_serializable(file_info)
+        saved_info.pop(keys.skipped, None)
+        with open(info_path, 'w') as f:
+            json.dump(saved_info, f, sort_keys=True, indent=4)
+
+    def _process_uvfits(self, path):
+        check = check_fits(path, self.algorithm)
+        check['compressed_bytes'] = None
+        if self.compress and not path.endswith('.gz'):
+            path = gzip_file(path)
+            check['compressed_bytes'] = os.path.getsize(path)
+        check['path'] = path
+        return check
@@ -17,11 +17,15 @@ the underlying fortran code, but this is a reasonably good quick solution.
 # So I often use raw strings to make it clear what is being sent.
 from __future__ import absolute_import, print_function
 import os
+import re
 import shutil
+import tempfile
+import threading
+import timeit
 import pexpect
-from collections import namedtuple
+from collections import deque, namedtuple
 import logging
-from astropy.coordinates import SkyCoord, Longitude, Latitude
+from astropy.coordinates import Longitude, Latitude
 import astropy.units
 import warnings
 import datetime
@@ -29,6 +33,10 @@ import datetime
 from numpy import median
 
 from driveami.environments import init_ami_env
+from driveami.hooks import fire_hooks
+import driveami.parsing as parsing
+from driveami.pointing import (friends_of_friends,
+                               pointing_groups_from_clusters)
 import driveami.scripts as scripts
 
 RaDecPair = namedtuple('RaDecPair', 'ra dec')
@@ -37,11 +45,36 @@ import driveami.keys as keys
 
 logger = logging.getLogger(__name__)
 
+# Astropy's sexagesimal angle parser is not thread-safe, and sessions may
+# parse obs details concurrently (``load_obs_info(workers=...)`` shards the
+# files across sibling sessions, each driven from its own thread; likewise
+# the sessions of a ReducePool):
+_angle_parser_lock = threading.Lock()
+
 
 def ensure_dir(dirname):
     if not os.path.isdir(dirname):
         os.makedirs(dirname)
 
+class CommandStalled(pexpect.TIMEOUT):
+    """
+    Raised when a reduce session produces no output for the stall window
+    (see the ``stall_timeout`` option of :class:`Reduce`).
+
+    A subclass of :class:`pexpect.TIMEOUT`, so handled as any other timeout.
+    """
+
+    def __init__(self, command, rawfile, stalled_seconds, output_bytes):
+        self.command = command
+        self.rawfile = rawfile
+        self.stalled_seconds = stalled_seconds
+        self.output_bytes = output_bytes
+        super(CommandStalled, self).__init__(
+            "No output for {:.1f} seconds from command {!r} (rawfile {}), "
+            "after {} bytes".format(stalled_seconds, command, rawfile,
+                                    output_bytes))
+
+
 class AmiVersion:
     legacy = 'legacy'
     digital = 'digital'
@@ -52,6 +85,17 @@ class Reduce(object):
     legacy_prompt = 'AMI-reduce>'
     #New version of REDUCE for use with digital correlator data:
     dc_prompt = 'AMIDC-reduce>'
+    # Child settings used in high-throughput mode (bytes):
+    high_throughput_maxread = 65536
+    high_throughput_search_window = 256
+    # Limits on the commands sent ahead of the prompts in pipelined mode:
+    pipeline_depth = 8
+    pipeline_max_bytes = 512
+    # Output lines taken to mean a command failed, in pipelined mode:
+    command_error_regex = re.compile(
+        r'^\s*(\*+\s*)?(error|unknown command|invalid)', re.I | re.M)
+    # How often (seconds) to check for output while watching for stalls:
+    stall_poll_interval = 0.5
 
     def __init__(self,
                  ami_rootdir,
@@ -60,6 +104,13 @@ class Reduce(object):
                  working_dir='/tmp',
                  additional_env_variables=None,
                  timeout=120,
+                 obs_info_cache=None,
+                 streaming=False,
+                 high_throughput=False,
+                 pipelined=False,
+                 hooks=None,
+                 timeout_policy=None,
+                 stall_timeout=None,
                  ):
         """
         Spawn an AMI-REDUCE instance.
@@ -68,7 +119,67 @@ class Reduce(object):
         but will not load the full info for each file, as this is time consuming.
         (See :py:func:`load_obs_info`.)
 
+        If an ``obs_info_cache`` (e.g. :class:`driveami.cache.ObsInfoCache`)
+        is supplied, :func:`get_obs_details` only queries ``reduce`` for
+        rawfiles which are new or have changed since they were cached.
+
+        If ``streaming`` is set, :func:`run_command` consumes command output
+        line by line as it arrives, logging and parsing each line in turn,
+        rather than buffering the full output. Memory use then stays flat
+        however verbose the command, but the output lines are not returned.
+        Likewise :func:`update_files` parses the (archive-sized) output of
+        ``list files`` and ``list comment`` line by line.
+
+        If ``high_throughput`` is set, the child reads output in larger
+        chunks, and the prompt is matched as an exact string within a
+        bounded window at the end of the output. The time spent waiting for
+        the prompt then scales linearly with the length of the output
+        (regex matching rescans the whole output on every read), which
+        matters for e.g. ``list files`` on a very large archive.
+
+        If ``pipelined`` is set, :func:`run_script` sends commands ahead in
+        batches, rather than waiting for each prompt in turn
+        (see :func:`run_script`).
+
+        ``hooks`` is an optional :class:`driveami.hooks.HookRegistry` of
+        callbacks specific to this session (in addition to those registered
+        with :data:`driveami.hooks.global_hooks`).
+
+        If a ``timeout_policy`` (:class:`driveami.timeouts.TimeoutPolicy`) is
+        supplied, the timeout for each command is set by the policy (which
+        also learns from the time each command takes), rather than fixed at
+        ``timeout``.
+
+        If ``stall_timeout`` is set, the output from each command is watched:
+        a command which produces no output for ``stall_timeout`` seconds is
+        aborted straight away with :class:`CommandStalled`, while one which
+        keeps producing output is allowed to run past its timeout (the
+        deadline is extended to ``stall_timeout`` after the latest output).
+        So e.g. a session wedged on a graphics device is caught quickly,
+        without cutting short a long but busy ``scan``.
         """
+        self._configure(ami_rootdir, ami_version, array, working_dir,
+                        additional_env_variables, timeout,
+                        high_throughput=high_throughput)
+        self.obs_info_cache = obs_info_cache
+        self.streaming = streaming
+        self.pipelined = pipelined
+        self.hooks = hooks
+        self.timeout_policy = timeout_policy
+        self.stall_timeout = stall_timeout
+        logger.debug("Spawning instance of "+self.reduce_binary+"...")
+        self.child = self._spawn_child()
+        self._expect_prompt()
+        logger.debug("...success.")
+        self._fire_hook('session_spawn')
+
+        if array == 'LA':
+            self.switch_to_large_array()
+        self.update_files()
+
+    def _configure(self, ami_rootdir, ami_version, array, working_dir,
+                   additional_env_variables, timeout, high_throughput=False):
+        """Check and record the session settings, prior to spawning."""
         self.ami_version = ami_version
         if ami_version == AmiVersion.digital:
             self.reduce_binary = 'reduce_dc'
@@ -81,6 +192,11 @@ class Reduce(object):
             raise RuntimeError("Unrecognised 'reduce' binary name supplied; "
                                "unclear which command line prompt to expect")
 
+        if array not in ('LA', 'SA'):
+            raise ValueError(
+                "Initialisation error: Array must be 'LA' or 'SA'.")
+        self.array = array
+
         if len(ami_rootdir) > 32:
             warnings.warn("Long AMI root path detected - this may cause bugs!\n"
                           "It is recommended to use a short symlink instead.\n")
@@ -90,31 +206,134 @@ class Reduce(object):
             raise IOError("Cannot access ami-reduce binary at: " +
                           os.path.join(ami_rootdir, 'bin', self.reduce_binary))
         self.working_dir = working_dir
-        ami_env = init_ami_env(ami_rootdir)
-        if additional_env_variables is not None:
-            ami_env.update(additional_env_variables)
-        logger.debug("Spawning instance of "+self.reduce_binary+"...")
-        self.child = pexpect.spawn('tcsh -c '+ self.reduce_binary,
-                                   cwd=self.working_dir,
-                                   env=ami_env,
-                                   timeout=timeout)
-        self.child.expect(self.prompt)
-        logger.debug("...success.")
+        # Retained so that equivalent sessions can be spawned, e.g. by a pool:
+        self.ami_rootdir = ami_rootdir
+        self.additional_env_variables = additional_env_variables
+        self.timeout = timeout
+        self.high_throughput = high_throughput
+        # Location of the rawfiles listed by ``list files``:
+        self.data_dir = os.path.join(ami_rootdir, array, 'data')
+        self.obs_info_cache = None
+        self.streaming = False
+        self.pipelined = False
+        self.hooks = None
+        self.timeout_policy = None
+        self.stall_timeout = None
+        self._version_text = None
+
         # Records all known information about the fileset.
         self.files = dict()
         # Used for updating the relevant record in self.files, also logging:
         self.active_file = None
-
-        if array == 'LA':
-            self.switch_to_large_array()
-        elif array != 'SA':
-            raise ValueError(
-                "Initialisation error: Array must be 'LA' or 'SA'.")
-        self.array = array
-        self.update_files()
-
         self.file_log = None
         self.file_cmd_log = None
+        # Extracts metrics from command output, see :mod:`driveami.parsing`:
+        self.output_parser = parsing.default_parser
+        # Metrics parsed from the output of the most recent command:
+        self.last_output_metrics = {}
+
+    def _spawn_child(self, **spawn_kwargs):
+        ami_env = init_ami_env(self.ami_rootdir)
+        if self.additional_env_variables is not None:
+            ami_env.update(self.additional_env_variables)
+        if self.high_throughput:
+            spawn_kwargs.setdefault('maxread', self.high_throughput_maxread)
+        return pexpect.spawn('tcsh -c ' + self.reduce_binary,
+                             cwd=self.working_dir,
+                             env=ami_env,
+                             timeout=self.timeout,
+                             **spawn_kwargs)
+
+    def _expect_prompt(self, command=None):
+        """
+        Wait for the prompt (following ``command``, if any), returning the
+        output preceding it.
+        """
+        if self.high_throughput:
+            # The prompt is always the last thing output, so need only look
+            # for it at the end of each newly read chunk:
+            self._expect_watched(
+                command, self.child.expect_exact, self.prompt,
+                searchwindowsize=self.high_throughput_search_window)
+        else:
+            self._expect_watched(command, self.child.expect, self.prompt)
+        return self.child.before
+
+    def _expect_watched(self, command, expect, *args, **kwargs):
+        """
+        Call ``expect`` (a pexpect expect method of the child), watching for
+        stalled output if there is a ``stall_timeout``.
+        """
+        if self.stall_timeout is None:
+            return expect(*args, **kwargs)
+        now = last_output = timeit.default_timer()
+        deadline = now + self.child.timeout
+        output_bytes = 0
+        while True:
+            wait = min(self.stall_poll_interval, deadline - now)
+            try:
+                return expect(*args, timeout=max(wait, 0), **kwargs)
+            except pexpect.TIMEOUT:
+                now = timeit.default_timer()
+                # (Unmatched output accumulates in ``before``)
+                if len(self.child.before) > output_bytes:
+                    output_bytes = len(self.child.before)
+                    last_output = now
+                    deadline = max(deadline, now + self.stall_timeout)
+                elif now - last_output >= self.stall_timeout:
+                    stalled = CommandStalled(command, self.active_file,
+                                             now - last_output, output_bytes)
+                    logger.error(str(stalled))
+                    raise stalled
+                elif now >= deadline:
+                    raise
+
+    def _fire_hook(self, event, **kwargs):
+        fire_hooks(self.hooks, event, self, **kwargs)
+
+    def _exchange(self, command):
+        """
+        Send a command and wait for the prompt, without the per-file logging
+        and parsing of :func:`run_command` (used for session housekeeping).
+
+        Returns:
+            tuple: (output, seconds taken)
+        """
+        self._fire_hook('before_command', command=command)
+        self._apply_timeout_policy(command)
+        start = timeit.default_timer()
+        self.child.sendline(command)
+        output = self._expect_prompt(command)
+        seconds = timeit.default_timer() - start
+        self._observe_latency(command, seconds)
+        self._fire_hook('after_command', command=command, seconds=seconds,
+                        output_bytes=len(output))
+        return output, seconds
+
+    def _exchange_lines(self, command):
+        """
+        As :func:`_exchange`, but yields the output line by line as it
+        arrives, rather than buffering it. (The command is finished once the
+        generator is exhausted.)
+        """
+        self._fire_hook('before_command', command=command)
+        self._apply_timeout_policy(command)
+        start = timeit.default_timer()
+        self.child.sendline(command)
+        patterns = self.child.compile_pattern_list([self.prompt, '\r\n'])
+        output_bytes = 0
+        while True:
+            at_prompt = (self._expect_watched(
+                command, self.child.expect_list, patterns) == 0)
+            line = self.child.before
+            output_bytes += len(line) + (0 if at_prompt else 2)
+            yield line
+            if at_prompt:
+                break
+        seconds = timeit.default_timer() - start
+        self._observe_latency(command, seconds)
+        self._fire_hook('after_command', command=command, seconds=seconds,
+                        output_bytes=output_bytes)
 
     def __enter__(self):
         return self
@@ -122,13 +341,25 @@ class Reduce(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.child.sendline('exit')
         self.child.close()
+        self._fire_hook('session_exit')
 
     def switch_to_large_array(self):
         """NB resets file list"""
-        p = self.child
-        p.sendline('set def la')
         self.files = dict()
-        p.expect(self.prompt)
+        self._exchange('set def la')
+
+    def get_version(self):
+        """
+        Returns the version text reported by ``reduce``.
+
+        (Queried once, then cached.)
+        """
+        if self._version_text is None:
+            output, _ = self._exchange('version')
+            # First line in 'before' is the command.
+            lines = [l.strip() for l in output.split('\n')[1:]]
+            self._version_text = ' '.join(l for l in lines if l)
+        return self._version_text
 
     def update_files(self):
         """
@@ -137,18 +368,36 @@ class Reduce(object):
         Also fetches any associated comments.
         
         This uses the REDUCE commands ``list files`` and ``list comment``.
+        In streaming mode their output is parsed line by line as it arrives.
 
         """
-        p = self.child
-        p.sendline(r'list files \ ')
-        #        p.sendline(r'list comment \ ')
-        p.expect(self.prompt)
+        if self.streaming:
+            self._parse_file_lines(self._exchange_lines(r'list files \ '))
+            self._parse_comment_lines(
+                self._exchange_lines(r'list comment \ '))
+            return
+        output, _ = self._exchange(r'list files \ ')
+        self._parse_file_list(output)
+
+        output, _ = self._exchange(r'list comment \ ')
+        self._parse_comment_list(output)
+
+    def _parse_file_list(self, list_files_output):
+        self._parse_file_lines(list_files_output.split('\n'))
+
+    def _parse_file_lines(self, lines):
         # First line in 'before' is command.
         # second line is blank
         # last 4 lines are blanks and 'total obs time'
-        file_lines = p.before.split('\n')[2:-4]
-        for l in file_lines:
-            l = l.strip('\r').strip(' ')
+        # (so each line is held back until 4 more have arrived)
+        held_back = deque()
+        for idx, l in enumerate(lines):
+            if idx < 2:
+                continue
+            held_back.append(l)
+            if len(held_back) <= 4:
+                continue
+            l = held_back.popleft().strip('\r').strip(' ')
             # Occasionally we get a junk, single-char line, due to
             # misformatted comments. Ignore those:
             if len(l) > 12:
@@ -157,11 +406,13 @@ class Reduce(object):
                 if fname not in self.files:
                     self.files[fname] = {}
 
-        p.sendline(r'list comment \ ')
-        #        p.sendline(r'list comment \ ')
-        p.expect(self.prompt)
-        file_lines = p.before.split('\n')[2:]
-        for l in file_lines:
+    def _parse_comment_list(self, list_comment_output):
+        self._parse_comment_lines(list_comment_output.split('\n'))
+
+    def _parse_comment_lines(self, lines):
+        for idx, l in enumerate(lines):
+            if idx < 2:
+                continue
             l = l.strip('\r').strip(' ')
             cols = l.split(' ', 1)
             fname = cols[0]
@@ -190,22 +441,47 @@ class Reduce(object):
         Returns:
             dict: Dictionary of file info.
         """
-        p = self.child
+        if not incomplete and self.obs_info_cache is not None:
+            cached_info = self.obs_info_cache.get(self.rawfile_path(filename))
+            if cached_info is not None:
+                self.files[filename].update(cached_info)
+                return self.files[filename]
         if not incomplete:
-            p.sendline(r'list observation {0} \ '.format(filename))
-            p.expect(self.prompt)
+            command = r'list observation {0} \ '.format(filename)
         else:  # incomplete observation, load fully to check end-timetamp:
             if not self.active_file == filename:
                 self.set_active_file(filename)
-            p.sendline(r'show observation \ ')
-            p.expect(self.prompt)
-        obs_lines = p.before.decode('ascii').split('\n')[2:]
+            command = r'show observation \ '
+        obs_output, seconds = self._exchange(command)
+        if filename == self.active_file:
+            self._record_timing(command, seconds, len(obs_output))
+        info = self._update_obs_info(filename, obs_output, incomplete)
+        if (info[keys.duration] == 0.0 and not incomplete):
+            logger.warn(
+                "Incomplete obs ({}), pulling timestamps from filedata".format(
+                    filename))
+            self.get_obs_details(filename, incomplete=True)
+
+        if not incomplete and self.obs_info_cache is not None:
+            self.obs_info_cache.put(self.rawfile_path(filename), info)
+        return info
+
+    def rawfile_path(self, filename):
+        """Full path to a rawfile listed in the AMI data directory."""
+        return os.path.join(self.data_dir, filename)
+
+    def _update_obs_info(self, filename, obs_output, incomplete):
+        """Parse observation listing output into the info for ``filename``."""
+        obs_text = obs_output
+        if isinstance(obs_text, bytes):
+            obs_text = obs_text.decode('ascii')
+        obs_lines = obs_text.split('\n')[2:]
         info = self.files[filename]
         if incomplete:
             warnings_dict = info.setdefault(keys.warnings, {})
             warnings_dict[keys.warning_incomplete] = True
 
-        info[keys.raw_obs_text] = p.before
+        info[keys.raw_obs_text] = obs_output
         info[keys.raster] = Reduce._parse_raster(obs_lines)
         hms_dms = Reduce._parse_coords(filename, obs_lines)
         info[keys.pointing_hms_dms] = hms_dms
@@ -214,12 +490,6 @@ class Reduce(object):
         info[keys.calibrator] = Reduce._parse_calibrator(obs_lines)
         info[keys.field] = Reduce._parse_field(obs_lines)
         info.update(Reduce._parse_obs_datetime(obs_lines))
-        if (info[keys.duration] == 0.0 and not incomplete):
-            logger.warn(
-                "Incomplete obs ({}), pulling timestamps from filedata".format(
-                    filename))
-            self.get_obs_details(filename, incomplete=True)
-
         return info
 
     @staticmethod
@@ -229,31 +499,121 @@ class Reduce(object):
 
           - a tuple-pair of ('h:m:s','d:m:s') strings representing ra/dec
         """
-        ra = Longitude(hms_dms_pair.ra, unit=astropy.units.hourangle)
-        dec = Latitude(hms_dms_pair.dec, unit=astropy.units.deg)
+        with _angle_parser_lock:
+            ra = Longitude(hms_dms_pair.ra, unit=astropy.units.hourangle)
+            dec = Latitude(hms_dms_pair.dec, unit=astropy.units.deg)
         return RaDecPair(ra.degree, dec.degree)
 
-    def load_obs_info(self):
+    def load_obs_info(self, workers=1):
         """
         Load all available information for every datafile.
          
         First runs :func:`.update_files` to refresh the file-list,
         then :func:`.get_obs_details` on every file.
+
+        Args:
+            workers: If greater than 1, the files are sharded across this many
+                reduce sessions (this one, plus freshly spawned siblings)
+                which query them in parallel. The resulting info is merged
+                back into ``self.files``, and is identical to a serial load.
         """
         logger.info("Loading observation information, patience...")
         self.update_files()
-        for filename, info in sorted(self.files.items()):
-            if info.get(keys.pointing_degrees, None) is None:
-                logger.debug("Getting obs info for %s", filename)
-                try:
-                    self.get_obs_details(filename)
-                except Exception as error:
-                    logger.exception("\n"
-                                     "**********************\n"
-                                     "Warning! Threw an exception trying to parse "
-                                     "details for %s"
-                                     "***********************\n"
-                                     "\n", filename)
+        pending = [filename for filename, info in sorted(self.files.items())
+                   if info.get(keys.pointing_degrees, None) is None]
+        if workers > 1 and len(pending) > 1:
+            self._load_obs_info_in_parallel(pending, workers)
+        else:
+            self._load_obs_info_for(pending)
+
+    def _load_obs_info_for(self, filenames):
+        for filename in filenames:
+            logger.debug("Getting obs info for %s", filename)
+            try:
+                self.get_obs_details(filename)
+            except Exception as error:
+                logger.exception("\n"
+                                 "**********************\n"
+                                 "Warning! Threw an exception trying to parse "
+                                 "details for %s"
+                                 "***********************\n"
+                                 "\n", filename)
+
+    def _load_obs_info_in_parallel(self, filenames, workers):
+        # Cache lookups and updates are done here, in the calling thread;
+        # the worker sessions only handle the misses.
+        if self.obs_info_cache is not None:
+            cache_misses = []
+            for filename in filenames:
+                cached_info = self.obs_info_cache.get(
+                    self.rawfile_path(filename))
+                if cached_info is not None:
+                    self.files[filename].update(cached_info)
+                else:
+                    cache_misses.append(filename)
+            filenames = cache_misses
+            if not filenames:
+                return
+        n_shards = min(workers, len(filenames))
+        shards = [filenames[i::n_shards] for i in range(n_shards)]
+        logger.info("Sharding %s files across %s reduce sessions",
+                    len(filenames), n_shards)
+        siblings = [None] * n_shards
+
+        def harvest_shard(idx):
+            try:
+                siblings[idx] = self.spawn_sibling()
+            except Exception:
+                logger.exception("Could not spawn worker reduce session; "
+                                 "its shard will be loaded serially.")
+                return
+            siblings[idx]._load_obs_info_for(shards[idx])
+
+        threads = [threading.Thread(target=harvest_shard, args=(idx,))
+                   for idx in range(1, n_shards)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        self._load_obs_info_for(shards[0])
+        for t in threads:
+            t.join()
+
+        for idx in range(1, n_shards):
+            sibling = siblings[idx]
+            if sibling is None:
+                self._load_obs_info_for(shards[idx])
+                continue
+            for filename in shards[idx]:
+                self.files[filename].update(sibling.files.get(filename, {}))
+            sibling.__exit__(None, None, None)
+
+        if self.obs_info_cache is not None:
+            # (Shards loaded by this session were cached by get_obs_details.)
+            for idx in range(1, n_shards):
+                if siblings[idx] is None:
+                    continue
+                for filename in shards[idx]:
+                    if keys.time_ut in self.files[filename]:
+                        self.obs_info_cache.put(self.rawfile_path(filename),
+                                                self.files[filename])
+
+    def spawn_sibling(self):
+        """
+        Spawn a new session with the same installation, array and environment.
+
+        (NB the sibling does not share this session's ``obs_info_cache``.)
+        """
+        return type(self)(self.ami_rootdir, self.ami_version,
+                          array=self.array,
+                          working_dir=self.working_dir,
+                          additional_env_variables=self.additional_env_variables,
+                          timeout=self.timeout,
+                          streaming=self.streaming,
+                          high_throughput=self.high_throughput,
+                          pipelined=self.pipelined,
+                          hooks=self.hooks,
+                          timeout_policy=self.timeout_policy,
+                          stall_timeout=self.stall_timeout)
 
     def group_obs_by_target_id(self):
         """
@@ -286,27 +646,65 @@ class Reduce(object):
             target_groups[target_id][keys.files].append(filename)
 
         for target_id in target_groups:
-            ra_list, dec_list = [], []
-            for filename in target_groups[target_id][keys.files]:
-                info = self.files[filename]
-                obs_pointing = info.get(keys.pointing_degrees, None)
-                if obs_pointing is not None:
-                    ra, dec = obs_pointing.ra, obs_pointing.dec
-                    ra_list.append(ra)
-                    dec_list.append(dec)
-            if ra_list:
-                median_ra, median_dec = median(ra_list), median(dec_list)
-                target_groups[target_id][keys.target_pointing_deg] = (
-                    median_ra, median_dec)
+            self._update_median_pointing(target_groups[target_id])
 
         return target_groups
 
+    def _update_median_pointing(self, target_group):
+        ra_list, dec_list = [], []
+        for filename in target_group[keys.files]:
+            info = self.files.get(filename, {})
+            obs_pointing = info.get(keys.pointing_degrees, None)
+            if obs_pointing is not None:
+                ra, dec = obs_pointing.ra, obs_pointing.dec
+                ra_list.append(ra)
+                dec_list.append(dec)
+        if ra_list:
+            median_ra, median_dec = median(ra_list), median(dec_list)
+            target_group[keys.target_pointing_deg] = (median_ra, median_dec)
+
+    def update_obs_groups_by_target_id(self, target_groups):
+        """
+        Incremental version of :func:`group_obs_by_target_id`.
+
+        Adds any files in ``self.files`` which are not already listed in
+        ``target_groups`` (e.g. as loaded from a previous ``_by_id`` listing),
+        and updates the median pointing of the target ids they belong to.
+        ``target_groups`` is modified in place.
+
+        NB the median pointings are recalculated from ``self.files``, so this
+        should hold info on all the files of any updated target id.
+
+        Returns:
+            set: The target ids which were added or updated.
+        """
+        known_files = set()
+        for group in target_groups.values():
+            known_files.update(group[keys.files])
+        updated_ids = set()
+        for filename in sorted(self.files):
+            if filename in known_files:
+                continue
+            target_id = filename.rsplit('-', 1)[0]
+            group = target_groups.setdefault(target_id, {keys.files: []})
+            group[keys.files].append(filename)
+            updated_ids.add(target_id)
+        for target_id in updated_ids:
+            self._update_median_pointing(target_groups[target_id])
+        return updated_ids
+
     def group_target_ids_by_pointing(self,
                                      target_id_groups,
                                      pointing_tolerance_in_degrees=0.5):
         """
         Attempt to group together datasets by inspecting pointing target.
 
+        Target IDs are grouped by friends-of-friends: any two IDs with median
+        pointings separated by less than ``pointing_tolerance_in_degrees``
+        end up in the same group. Each group is keyed by its first sorted ID.
+        (To group at several tolerances, see
+        :class:`driveami.pointing.PointingTree`.)
+
         Returns:
             dict: Nested dict with structure:
             { TARGET_ID:
@@ -318,84 +716,23 @@ class Reduce(object):
             }
         """
 
-        def _find_close_targets(first_target_id, ungrouped, skycoords_cache,
-                                tolerance_deg):
-            """
-            Grow a network graph to include all points separated by less than
-            'tolerance_deg'.
-
-            Given a starting point ('first_target_id', and a bunch of
-            un-matched positions ('ungrouped'), work through checking for
-            close positions. Once a new network node has been added,
-            re-run to see if this puts us close enough to another point.
-            """
-            logger.debug(
-                "Finding observations near " + first_target_id + " ... ")
-            cluster_ids = [first_target_id]
-
-            # Take the list of positions belonging to the current group
-            # Split it into three lists, to avoid modifying the list as we
-            # iterate over it:
-            # Cluster positions we've already scanned for matches previously
-            processed = []
-            # Positions we're about to scan for matches:
-            process_next = [skycoords_cache[first_target_id]]
-            # Newly added positions that could extend the cluster in the next
-            # iteration:
-            newly_included = []
-
-            while process_next:
-                for pointing1 in process_next:
-                    for id2 in list(ungrouped):
-                        pointing2 = skycoords_cache[id2]
-                        if pointing1.separation(
-                                pointing2).degree < tolerance_deg:
-                            cluster_ids.append(id2)
-                            newly_included.append(pointing2)
-                            ungrouped.remove(id2)
-                            logger.debug("... " + id2 + " added to group.")
-                # Cycle the lists before next iteration
-                processed.extend(process_next)
-                process_next = newly_included
-                newly_included = []
-            logger.debug("... {} rawfiles in group.".format(len(cluster_ids)))
-            return cluster_ids
-
-        ungrouped = set(target_id_groups.keys())
-        # Cache a pre-built set of Astropy SkyCoord objects, one for each id
-        # This avoids constantly rebuilding as we iterate through.
-        temp_skycoords = {}
-        for id in ungrouped:
-            ra_dec = target_id_groups[id][keys.target_pointing_deg]
-            temp_skycoords[id] = SkyCoord(ra_dec[0], ra_dec[1], unit='deg')
-
-        pointing_groups_dict = {}
-
-        # Now, pop off un-searched IDs and match them up, one-by-one until done
-        while ungrouped:
-            cluster_ids = _find_close_targets(ungrouped.pop(), ungrouped,
-                                              temp_skycoords,
-                                              pointing_tolerance_in_degrees)
-            first_id = sorted(cluster_ids)[0]
-            pointing_groups_dict[first_id] = {}
-            pointing_groups_dict[first_id][keys.target_pointing_deg] = (
-                target_id_groups[first_id][keys.target_pointing_deg])
-            pointing_groups_dict[first_id][keys.files] = []
-            for target_id in cluster_ids:
-                pointing_groups_dict[first_id][keys.files].extend(
-                    target_id_groups[target_id][keys.files])
-
-        return pointing_groups_dict
+        # Sort the IDs, so each cluster's first member is its first sorted ID:
+        target_ids = sorted(target_id_groups.keys())
+        pointings = [target_id_groups[id][keys.target_pointing_deg]
+                     for id in target_ids]
+        ra = [ra_dec[0] for ra_dec in pointings]
+        dec = [ra_dec[1] for ra_dec in pointings]
+        clusters = friends_of_friends(ra, dec, pointing_tolerance_in_degrees)
+
+        return pointing_groups_from_clusters(target_id_groups, target_ids,
+                                             clusters)
 
     def close_per_file_logs(self):
-        """Close any logging file handlers from the last file"""
-        if self.file_log is not None:
-            for hdlr in self.file_log.handlers:
-                if hasattr(hdlr, 'close'):
-                    hdlr.close()
-        if self.file_cmd_log is not None:
-            for hdlr in self.file_cmd_log.handlers:
-                if hasattr(hdlr, 'close'):
+        """Close (and detach) any logging file handlers from the last file"""
+        for file_logger in (self.file_log, self.file_cmd_log):
+            if file_logger is not None:
+                for hdlr in list(file_logger.handlers):
+                    file_logger.removeHandler(hdlr)
                     hdlr.close()
 
     def _setup_file_loggers(self, filename, file_logdir):
@@ -414,6 +751,8 @@ class Reduce(object):
             '.'.join((logger.name, 'commands', target)))
         self.file_cmd_log.propagate = False
         self.file_cmd_log.setLevel(logging.DEBUG)
+        # Drop any handlers left by another session which processed this file:
+        self.close_per_file_logs()
 
         if file_logdir is not None:
             ensure_dir(file_logdir)
@@ -438,36 +777,200 @@ class Reduce(object):
             command: 
 
         Returns:
-
+            list: The lines of output. NB in streaming mode the output is
+            only logged and parsed as it arrives, not kept, so this is
+            always an empty list.
         """
         self.file_cmd_log.debug(command)
+        self._fire_hook('before_command', command=command)
+        self._apply_timeout_policy(command)
+        start = timeit.default_timer()
         try:
             self.child.sendline(command)
-            self.child.expect(self.prompt)
+            if self.streaming:
+                return self._stream_command_output(command, start)
+            output = self._expect_prompt(command)
         except:
             logger.error("Exception running command '{}'".format(command))
             raise
-        self.file_log.debug('%s%s', self.prompt, self.child.before)
-        self._parse_command_output(command, self.child.before.split('\n'))
-        return self.child.before.split('\n')
+        self._command_finished(command, timeit.default_timer() - start,
+                               len(output))
+        return self._handle_command_output(command, output)
+
+    def _apply_timeout_policy(self, command):
+        """Set the timeout for ``command``, if there is a timeout policy."""
+        if self.timeout_policy is not None:
+            self.child.timeout = self.timeout_policy.timeout(
+                command, self._active_duration())
+
+    def _observe_latency(self, command, seconds):
+        if self.timeout_policy is not None:
+            self.timeout_policy.observe(command, seconds,
+                                        self._active_duration())
+
+    def _active_duration(self):
+        """Duration (hours) of the active file's observation, if known."""
+        return self.files.get(self.active_file, {}).get(keys.duration)
+
+    def _command_finished(self, command, seconds, output_bytes):
+        self._record_timing(command, seconds, output_bytes)
+        self._observe_latency(command, seconds)
+        self._fire_hook('after_command', command=command, seconds=seconds,
+                        output_bytes=output_bytes)
+
+    def _record_timing(self, command, seconds, output_bytes, filename=None):
+        """
+        Append a timing record to the info for ``filename`` (by default, the
+        active file), under ``keys.command_timings``.
+        """
+        if filename is None:
+            filename = self.active_file
+        if filename is None or filename not in self.files:
+            return
+        self.files[filename].setdefault(keys.command_timings, []).append(
+            {'command': command, 'seconds': seconds,
+             'output_bytes': output_bytes})
+
+    def _handle_command_output(self, command, output):
+        """Log and parse the output of a command, returning the output lines."""
+        self.file_log.debug('%s%s', self.prompt, output)
+        self._parse_command_output(command, output)
+        return output.split('\n')
+
+    def _stream_command_output(self, command, start):
+        """
+        Log and parse the output of a command line by line, as it arrives.
+        """
+        line_feed = self.output_parser.line_feed(command)
+        patterns = self.child.compile_pattern_list([self.prompt, '\r\n'])
+        prefix = self.prompt
+        output_bytes = 0
+        while True:
+            at_prompt = (self._expect_watched(
+                command, self.child.expect_list, patterns) == 0)
+            line = self.child.before
+            if line or not at_prompt:
+                self.file_log.debug('%s%s', prefix, line)
+                prefix = ''
+                line_feed.feed(line)
+                output_bytes += len(line) + (0 if at_prompt else 2)
+            if at_prompt:
+                break
+        self._command_finished(command, timeit.default_timer() - start,
+                               output_bytes)
+        self._record_metrics(command, line_feed.results)
+        return []
 
     def run_script(self, script_string):
-        """Takes a script of commands, one command per line"""
+        """
+        Takes a script of commands, one command per line.
+
+        In pipelined mode (and not streaming), commands are sent ahead of
+        the prompts, with terminal echo switched off - up to
+        :attr:`pipeline_depth` commands (and :attr:`pipeline_max_bytes`)
+        at a time. The output is split back into one block per command by
+        counting prompts, so each command is logged and parsed just as in
+        lockstep.
+
+        Each command's output is checked against :attr:`command_error_regex`
+        as its prompt arrives. Once an error is seen no more commands are
+        sent ahead, and the rest of the script is run in lockstep. NB any
+        commands already sent after the failing one (at most
+        ``pipeline_depth - 1``) still run.
+        """
         command_list = script_string.split('\n')
-        for command in command_list:
-            self.run_command(command)
+        if not self.pipelined or self.streaming:
+            for command in command_list:
+                self.run_command(command)
+            return
+
+        n_sent = self._run_pipelined(command_list)
+        if n_sent < len(command_list):
+            logger.warning("Error reported by reduce in pipelined script, "
+                           "running remainder of script in lockstep.")
+            for command in command_list[n_sent:]:
+                self.run_command(command)
+
+    def _run_pipelined(self, command_list):
+        """
+        Send commands ahead, until one reports an error.
+
+        Returns:
+            int: The number of commands sent (and run).
+        """
+        in_flight = deque()
+        n_sent = 0
+        n_bytes = 0  # (Of the commands in flight)
+        error_seen = False
+        self.child.setecho(False)
+        try:
+            start = timeit.default_timer()
+            while True:
+                while (not error_seen and n_sent < len(command_list) and
+                       len(in_flight) < self.pipeline_depth):
+                    command = command_list[n_sent]
+                    if (in_flight and n_bytes + len(command) + 1 >
+                            self.pipeline_max_bytes):
+                        break
+                    self._fire_hook('before_command', command=command)
+                    self.child.sendline(command)
+                    in_flight.append(command)
+                    n_bytes += len(command) + 1
+                    n_sent += 1
+                if not in_flight:
+                    break
+                command = in_flight[0]
+                self._apply_timeout_policy(command)
+                # (NB no search window, as several prompts may arrive at once)
+                self._expect_watched(command, self.child.expect_exact,
+                                     self.prompt)
+                output = self.child.before
+                in_flight.popleft()
+                n_bytes -= len(command) + 1
+                # Commands run back to back, so time each from the last prompt:
+                finish = timeit.default_timer()
+                self._command_finished(command, finish - start, len(output))
+                start = finish
+                self.file_cmd_log.debug(command)
+                # Restore the echoed command line, as seen in lockstep mode:
+                self._handle_command_output(command, command + '\r\n' + output)
+                if self.command_error_regex.search(output):
+                    error_seen = True
+        except:
+            logger.error("Exception running pipelined commands {}".format(
+                list(in_flight)))
+            raise
+        finally:
+            self.child.setecho(True)
+        return n_sent
 
     def set_active_file(self, filename, file_logdir=None):
+        """
+        Load a rawfile, and refresh its info.
+
+        Also resets the record of command timings for the file
+        (``keys.command_timings``), which then builds up as commands are run.
+        """
+        start = timeit.default_timer()
+        filename = self._activate_file(filename, file_logdir)
+        self.run_command(r'file %s \ ' % filename)
+        self.get_obs_details(filename, incomplete=self._is_incomplete())
+        self._fire_hook('file_activated', filename=filename)
+        self._record_timing('set_active_file',
+                            timeit.default_timer() - start, 0)
+        logger.debug('Active file: %s', filename)
+
+    def _activate_file(self, filename, file_logdir):
         filename = filename.strip()  # Ensure no stray whitespace
         self.active_file = filename
+        if filename in self.files:
+            self.files[filename][keys.command_timings] = []
         self._setup_file_loggers(filename, file_logdir)
-        file_listing = self.run_command(r'file %s \ ' % filename)
-        incomplete_obs = False
-        for line in file_listing:
-            if 'incomplete observation' in line:
-                incomplete_obs = True
-        self.get_obs_details(filename, incomplete=incomplete_obs)
-        logger.debug('Active file: %s', filename)
+        return filename
+
+    def _is_incomplete(self):
+        """Did the last ``file`` command report an incomplete observation?"""
+        return self.last_output_metrics.get('incomplete', False)
 
     def write_files(self, rawfile, output_dir,
                     write_command_template=scripts.write_command,
@@ -480,6 +983,26 @@ class Reduce(object):
         this function hacks around the limitations.
         Kludgey but effective.
         """
+        self._fire_hook('write_files_start', rawfile=rawfile,
+                        output_dir=output_dir)
+        start = timeit.default_timer()
+        write_command, renames = self._prepare_write(rawfile, output_dir,
+                                                     write_command_template,
+                                                     write_command_overrides)
+        self.run_command(write_command)
+        self._finish_write(renames)
+        seconds = timeit.default_timer() - start
+        self._record_timing('write_files', seconds, 0)
+        self._fire_hook('write_files_end', rawfile=rawfile,
+                        output_dir=output_dir, seconds=seconds)
+
+    def _prepare_write(self, rawfile, output_dir, write_command_template,
+                       write_command_overrides):
+        """
+        Returns:
+            tuple: (write_command, renames), where ``renames`` lists the
+            ``(temp_path, final_path, info_key)`` for each output file.
+        """
         ensure_dir(output_dir)
         tgt_name = os.path.splitext(rawfile)[0]
         tgt_path = os.path.join(output_dir, tgt_name + '.fits')
@@ -489,16 +1012,20 @@ class Reduce(object):
             cal_path = os.path.join(output_dir, cal_basename)
         else:
             cal_path = None
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            tgt_temp = os.tempnam(self.working_dir, 'ami_') + '.fits'
-            cal_temp = os.tempnam(self.working_dir, 'ami_') + '.fits'
-
+        # NB ``reduce`` is run from the working dir, and we pass it only
+        # the (short) basenames of these temp files.
+        tgt_temp = tempfile.mktemp(prefix='ami_', suffix='.fits',
+                                   dir=self.working_dir)
+        cal_temp = tempfile.mktemp(prefix='ami_', suffix='.fits',
+                                   dir=self.working_dir)
+
+        renames = [(tgt_temp, tgt_path, keys.target_uvfits)]
         if cal_path is None:
             output_paths_string = os.path.basename(tgt_temp)
         else:
             output_paths_string = " ".join((os.path.basename(tgt_temp),
                                             os.path.basename(cal_temp)))
+            renames.append((cal_temp, cal_path, keys.cal_uvfits))
         logger.debug("Writing to temp files %s" % output_paths_string)
 
         write_command_args = scripts.write_command_defaults.copy()
@@ -507,37 +1034,24 @@ class Reduce(object):
 
         write_command_args['output_paths'] = output_paths_string
         write_command = write_command_template.format(**write_command_args)
-        self.run_command(write_command)
+        return write_command, renames
 
-        logger.debug("Renaming tempfile %s -> %s", tgt_temp, tgt_path)
-        shutil.move(tgt_temp, tgt_path)
+    def _finish_write(self, renames):
         info = self.files[self.active_file]
-        info[keys.target_uvfits] = os.path.abspath(tgt_path)
-        if cal_path is not None:
-            logger.debug("Renaming tempfile %s -> %s", cal_temp, cal_path)
-            shutil.move(cal_temp, cal_path)
-            info[keys.cal_uvfits] = os.path.abspath(cal_path)
-        logger.debug("Wrote target, calib. UVFITs to:\n\t%s\n\t%s",
-                     tgt_path, cal_path)
+        for temp_path, final_path, info_key in renames:
+            logger.debug("Renaming tempfile %s -> %s", temp_path, final_path)
+            shutil.move(temp_path, final_path)
+            info[info_key] = os.path.abspath(final_path)
+        logger.debug("Wrote target, calib. UVFITs to:\n\t%s",
+                     "\n\t".join(final_path for _, final_path, _ in renames))
 
     def update_flagging_info(self):
-        lines = self.run_command(r'show flagging no yes \ ')
-        final_flagging = self._parse_flagging_results(lines)
+        self.run_command(r'show flagging no yes \ ')
+        final_flagging = self.last_output_metrics['flagging']
         self.files[self.active_file][keys.flagged_final] = final_flagging
 
 # logger.info("Final flagging estimate: %s%%", final_flagging)
 
-    def _parse_cal_inter_results(self, output_lines):
-        days_apart = None
-        archive_cal_available = True
-        for line in output_lines:
-            if 'fluxes for this source not available' in line:
-                archive_cal_available = False
-            if 'days apart' in line:
-                tokens = line.strip().split()
-                days_apart = float(tokens[6])
-        return archive_cal_available, days_apart
-
     @staticmethod
     def _parse_calibrator(obs_listing):
         for line in obs_listing:
@@ -545,40 +1059,19 @@ class Reduce(object):
                 tokens = line.split()
                 return tokens[-1]
 
-    def _parse_command_output(self, command, output_lines):
-        #        try:
-        file_info = self.files[self.active_file]
-        if 'apply rain' in command:
-            rain_amp_corr = self._parse_rain_results(output_lines)
-            file_info[keys.rain] = rain_amp_corr
-            if rain_amp_corr is None:
-                logger.warning(
-                    "Could not parse rain modulation for {}.".format(
-                        self.active_file
-                    ))
-        # logger.info("Rain mean amplitude correction factor: %s",
-        #                             rain_amp_corr)
-        if 'flag' in command:
-            flagging = self._parse_flagging_results(output_lines)
-            file_info[keys.flagged_max] = max(flagging,
-                                              file_info.get(keys.flagged_max,
-                                                            None))
-
-        if 'reweight' in command:
-            est_noise = self._parse_reweight_results(output_lines)
-            file_info[keys.est_noise_jy] = est_noise
-        # logger.info("Estimated noise: %s mJy", est_noise * 1000.0)
-        # self.files[self.active_file][keys.flagging_max]
-
-        if 'cal inter' in command:
-            avail, daysep = self._parse_cal_inter_results(output_lines)
-            file_info[keys.archive_cal_available] = avail
-            file_info[keys.archive_cal_days_apart] = daysep
-
-            #        except Exception as e:
-            #            raise ValueError("Problem parsing command output for file: %s,",
-            #                             "command: %s, error message:\n%s"
-            #                             ,self.active_file, command, e.msg)
+    def _parse_command_output(self, command, output):
+        """
+        Extract metrics from the output of ``command`` in a single pass,
+        recording them in :attr:`last_output_metrics` and (where configured)
+        the active file's info.
+        """
+        self._record_metrics(command,
+                             self.output_parser.parse(command, output))
+
+    def _record_metrics(self, command, metrics):
+        self.last_output_metrics = metrics
+        self.output_parser.apply(self, command, metrics,
+                                 self.files[self.active_file])
 
     @staticmethod
     def _parse_coords(filename, obs_listing):
@@ -609,16 +1102,6 @@ class Reduce(object):
                 tokens = line.split()
                 return tokens[0]
 
-    def _parse_flagging_results(self, output_lines):
-        for line in output_lines:
-            if "samples flagged" in line:
-                if "Total of" in line:
-                    tokens = line.strip().split()
-                    for t in tokens:
-                        if '%' in t:
-                            return float(t.strip('%'))
-
-
     @staticmethod
     def _parse_obs_datetime(obs_listing):
         timeinfo = {}
@@ -642,13 +1125,6 @@ class Reduce(object):
         timeinfo[keys.duration] = duration.total_seconds() / 3600.
         return timeinfo
 
-    def _parse_rain_results(self, output_lines):
-        for line in output_lines:
-            if "Mean amplitude correction factor" in line:
-                return float(line.strip().split()[-1])
-        return None
-
-
     @staticmethod
     def _parse_raster(obs_listing):
         for line in obs_listing:
@@ -657,14 +1133,6 @@ class Reduce(object):
         return False
 
 
-    def _parse_reweight_results(self, output_lines):
-        for line in output_lines:
-            if "estimated noise" in line:
-                tokens = line.strip().split()
-                return float(tokens[-2])
-        raise ValueError("Parsing error, could not find noise estimate.")
-
-
     @staticmethod
     def _parse_times(line):
         """Returns (UTC time, sidereal time)"""
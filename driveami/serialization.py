@@ -2,13 +2,21 @@
 Utility routines for loading and saving lists of datafiles (raw or calibrated).
 """
 from __future__ import absolute_import
+import datetime
 import json
+import logging
+import os
 import driveami.keys as keys
+from driveami.pointing import PointingTree
+from driveami.reduce import RaDecPair
+
+logger = logging.getLogger(__name__)
 
 class Datatype:
     magic_key = '#DATATYPE'
     ami_la_raw='AMILA_RAWFILES'
     ami_la_calibrated='AMILA_CALIBRATED_UVFITS'
+    ami_la_pointing_tree='AMILA_POINTING_TREE'
 
 
 datetime_format = '%Y-%m-%d %H:%M:%S'
@@ -22,6 +30,26 @@ def make_serializable(file_info_dict):
     d[keys.time_ut] = [t.strftime(datetime_format) for t in d[keys.time_ut]]
     return d
 
+
+def restore_file_info(serialized_info_dict):
+    """Inverse of :func:`make_serializable`.
+
+    Restores the datetimes, tuples and RA/Dec pairs of a file info dictionary
+    that has been through a JSON round-trip.
+    """
+    d = serialized_info_dict.copy()
+    if d.get(keys.time_ut) is not None:
+        d[keys.time_ut] = tuple(
+            datetime.datetime.strptime(t, datetime_format)
+            for t in d[keys.time_ut])
+    for key in (keys.pointing_degrees, keys.pointing_hms_dms):
+        if d.get(key) is not None:
+            d[key] = RaDecPair(*d[key])
+    for key in (keys.time_st, keys.time_mjd):
+        if d.get(key) is not None:
+            d[key] = tuple(d[key])
+    return d
+
 def save_rawfile_listing(raw_obs_groups_dict, filepointer):
     savedict = raw_obs_groups_dict.copy()
     savedict[Datatype.magic_key] = Datatype.ami_la_raw
@@ -43,6 +71,9 @@ def load_listing(filepointer, expected_datatype=None):
     """
     Load a json listing tagged with a driveami Datatype key.
 
+    Reads either the legacy single-dict format, or the JSON Lines format
+    written by :class:`ListingWriter` (detected automatically).
+
     Args:
         filepointer: Filestream for reading.
         expected_datatype: If defined, this will raise a ValueError if
@@ -53,8 +84,43 @@ def load_listing(filepointer, expected_datatype=None):
 
 
     """
-    listing = json.load(filepointer)
-    if (Datatype.magic_key not in listing):
+    found_datatype, records = iter_listing(filepointer, expected_datatype)
+    return dict(records), found_datatype
+
+
+def iter_listing(filepointer, expected_datatype=None):
+    """
+    As :func:`load_listing`, but returns ``(found_datatype, records)``,
+    where ``records`` iterates over the ``(key, value)`` entries.
+
+    For a JSON Lines listing the entries are read one line at a time, so
+    memory use is independent of the listing size.
+    """
+    first_line = filepointer.readline()
+    header = _parse_jsonl_header(first_line)
+    if header is None:
+        listing = json.loads(first_line + filepointer.read())
+        found_datatype = _check_datatype(listing, filepointer,
+                                         expected_datatype)
+        listing.pop(Datatype.magic_key)
+        return found_datatype, iter(listing.items())
+    found_datatype = _check_datatype(header, filepointer, expected_datatype)
+    return found_datatype, _iter_jsonl_records(filepointer)
+
+
+def _parse_jsonl_header(line):
+    """The header record of a JSON Lines listing, else None."""
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    if isinstance(record, dict) and list(record) == [Datatype.magic_key]:
+        return record
+    return None
+
+
+def _check_datatype(listing, filepointer, expected_datatype):
+    if (not isinstance(listing, dict)) or Datatype.magic_key not in listing:
         raise ValueError(
             "{} does not appear to be an AMI listing".format(filepointer)
         )
@@ -65,5 +131,118 @@ def load_listing(filepointer, expected_datatype=None):
             "{} does not appear to be an AMI listing of type {}".format(
                 filepointer, expected_datatype)
             )
-    listing.pop(Datatype.magic_key)
-    return listing, found_datatype
+    return found_datatype
+
+
+def _iter_jsonl_records(filepointer):
+    for line in filepointer:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            if line.endswith('\n'):
+                raise
+            # A record cut short, e.g. by a crash mid-write:
+            logger.warning("Ignoring truncated final record in %s",
+                           filepointer)
+            return
+        for key, value in record.items():
+            yield key, value
+
+
+class ListingWriter(object):
+    """
+    Writes a listing in JSON Lines format, one entry at a time.
+
+    The first line is a header record holding just the ``#DATATYPE`` key,
+    then each entry is written as a single-key JSON object on its own line,
+    and flushed straight away. So entries can be recorded as they are
+    produced (e.g. as each rawfile is calibrated) without holding the whole
+    listing in memory, and the file can be followed while it grows.
+    Read back with :func:`load_listing` or :func:`iter_listing`.
+
+    With ``sync``, each entry is also fsync'd to disk as it is written,
+    so survives e.g. a power cut.
+    """
+
+    def __init__(self, filepointer, datatype, write_header=True, sync=False):
+        self.filepointer = filepointer
+        self.datatype = datatype
+        self.sync = sync
+        if write_header:
+            self._write_line({Datatype.magic_key: datatype})
+
+    @classmethod
+    def open(cls, path, datatype, append=False, sync=False):
+        """
+        Open a writer on ``path``.
+
+        With ``append``, entries are added to any existing listing at
+        ``path`` (which must be a JSON Lines listing of the same datatype).
+        A final entry left incomplete (e.g. by a crash mid-write) is
+        dropped first.
+        """
+        if append and os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'rb+') as f:
+                header = _parse_jsonl_header(f.readline().decode('utf-8'))
+                if header is None:
+                    raise ValueError(
+                        "Cannot append to {}, not a JSON Lines listing".format(
+                            path))
+                _check_datatype(header, path, datatype)
+                _drop_partial_final_line(f)
+            return cls(open(path, 'a'), datatype, write_header=False,
+                       sync=sync)
+        return cls(open(path, 'w'), datatype, sync=sync)
+
+    def write(self, key, value):
+        self._write_line({key: value})
+
+    def _write_line(self, record):
+        self.filepointer.write(json.dumps(record, sort_keys=True) + '\n')
+        self.filepointer.flush()
+        if self.sync:
+            os.fsync(self.filepointer.fileno())
+
+    def close(self):
+        self.filepointer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _drop_partial_final_line(f, blocksize=4096):
+    """Truncate the binary file ``f`` after its last newline."""
+    f.seek(0, os.SEEK_END)
+    size = pos = f.tell()
+    while pos > 0:
+        start = max(0, pos - blocksize)
+        f.seek(start)
+        newline = f.read(pos - start).rfind(b'\n')
+        if newline >= 0:
+            pos = start + newline + 1
+            break
+        pos = start
+    if pos != size:
+        logger.warning("Dropping truncated final record of %s", f.name)
+        f.truncate(pos)
+
+
+def save_pointing_tree(pointing_tree, filepointer):
+    savedict = pointing_tree.to_dict()
+    savedict[Datatype.magic_key] = Datatype.ami_la_pointing_tree
+    json.dump(savedict, filepointer)
+
+
+def load_pointing_tree(filepointer):
+    """
+    Load a :class:`driveami.pointing.PointingTree` saved with
+    :func:`save_pointing_tree`.
+    """
+    d, _ = load_listing(filepointer,
+                        expected_datatype=Datatype.ami_la_pointing_tree)
+    return PointingTree.from_dict(d)
@@ -0,0 +1,373 @@
+"""
+SQLite-backed store for rawfile metadata, groupings and calibrated results.
+
+Holds the same information as the JSON listings (``_metadata``, ``_by_id``
+and ``_by_pointing`` rawfile listings, calibrated-file listings), but indexed
+by filename, target id, group, calibrator, MJD range and pointing, so
+that scripts can pick out what they need without reparsing everything.
+
+Each record's full info is kept as JSON, alongside the indexed columns::
+
+    with ListingStore('ami_listings.db') as store:
+        with open('rawfiles_by_id.json') as f:
+            store.import_listing(f, grouping='target_id')
+        groups = store.groups('target_id', names=['SWIFT_590206'])
+        nearby = store.query_files(cone=(233.9, 23.4, 0.5),
+                                   mjd_range=(56700, 56800))
+"""
+from __future__ import absolute_import
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+
+import numpy as np
+
+import driveami.keys as keys
+from driveami.pointing import degrees_to_chord, unit_vectors
+from driveami.serialization import (Datatype, ListingWriter, datetime_format,
+                                    iter_listing, restore_file_info,
+                                    save_calfile_listing, save_rawfile_listing)
+
+logger = logging.getLogger(__name__)
+
+_sqlite_magic = b'SQLite format 3\x00'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS rawfiles (
+    filename TEXT PRIMARY KEY, target_id TEXT, calibrator TEXT,
+    mjd_start REAL, mjd_end REAL, ra_deg REAL, dec_deg REAL, info TEXT);
+CREATE INDEX IF NOT EXISTS rawfiles_target_id ON rawfiles (target_id);
+CREATE INDEX IF NOT EXISTS rawfiles_calibrator ON rawfiles (calibrator);
+CREATE INDEX IF NOT EXISTS rawfiles_mjd ON rawfiles (mjd_start, mjd_end);
+CREATE INDEX IF NOT EXISTS rawfiles_pointing ON rawfiles (dec_deg, ra_deg);
+
+CREATE TABLE IF NOT EXISTS rawfile_groups (
+    grouping TEXT, name TEXT, ra_deg REAL, dec_deg REAL, info TEXT,
+    PRIMARY KEY (grouping, name));
+CREATE INDEX IF NOT EXISTS groups_pointing ON rawfile_groups (dec_deg, ra_deg);
+CREATE TABLE IF NOT EXISTS group_files (
+    grouping TEXT, name TEXT, filename TEXT);
+CREATE INDEX IF NOT EXISTS group_files_group ON group_files (grouping, name);
+CREATE INDEX IF NOT EXISTS group_files_filename ON group_files (filename);
+
+CREATE TABLE IF NOT EXISTS calibrated (
+    filename TEXT PRIMARY KEY, group_name TEXT, calibrator TEXT,
+    mjd_start REAL, mjd_end REAL, ra_deg REAL, dec_deg REAL, info TEXT);
+CREATE INDEX IF NOT EXISTS calibrated_group ON calibrated (group_name);
+CREATE INDEX IF NOT EXISTS calibrated_calibrator ON calibrated (calibrator);
+CREATE INDEX IF NOT EXISTS calibrated_mjd ON calibrated (mjd_start, mjd_end);
+CREATE INDEX IF NOT EXISTS calibrated_pointing ON calibrated (dec_deg, ra_deg);
+"""
+
+
+def is_store(path):
+    """Is the file at ``path`` a SQLite database (rather than a listing)?"""
+    with open(path, 'rb') as f:
+        return f.read(len(_sqlite_magic)) == _sqlite_magic
+
+
+def _to_json(info):
+    # (Accepts file info either fresh from Reduce, or already serializable)
+    def encode(obj):
+        if isinstance(obj, datetime.datetime):
+            return obj.strftime(datetime_format)
+        raise TypeError(repr(obj) + " is not JSON serializable")
+    return json.dumps(info, sort_keys=True, default=encode)
+
+
+def _file_columns(info):
+    """(calibrator, mjd_start, mjd_end, ra_deg, dec_deg) for a file info."""
+    mjd = info.get(keys.time_mjd) or (None, None)
+    pointing = info.get(keys.pointing_degrees) or (None, None)
+    return (info.get(keys.calibrator), mjd[0], mjd[1],
+            pointing[0], pointing[1])
+
+
+class ListingStore(object):
+    """
+    Rawfile metadata, groupings and calibrated results in a SQLite database.
+
+    Groupings are named, e.g. ``'target_id'`` for the groups produced by
+    :meth:`.Reduce.group_obs_by_target_id`, or ``'pointing_0.5'`` for
+    pointing groups at 0.5 degree tolerance.
+
+    Safe to share between threads. Each ``put_*`` call is committed as a
+    single transaction.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.executescript(_schema)
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _write(self, statements):
+        """Run ``(sql, rows)`` pairs in a single transaction."""
+        with self._lock:
+            with self.connection:
+                for sql, rows in statements:
+                    self.connection.executemany(sql, rows)
+
+    def _read(self, sql, params=()):
+        with self._lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    # Rawfile metadata
+
+    def put_files(self, files):
+        """Store (or replace) info for each rawfile in ``files``."""
+        rows = []
+        for filename, info in files.items():
+            rows.append((filename, filename.rsplit('-', 1)[0]) +
+                        _file_columns(info) + (_to_json(info),))
+        self._write([("INSERT OR REPLACE INTO rawfiles "
+                      "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)])
+
+    def get_file(self, filename):
+        rows = self._read("SELECT info FROM rawfiles WHERE filename=?",
+                          (filename,))
+        if not rows:
+            return None
+        return restore_file_info(json.loads(rows[0][0]))
+
+    def files(self, filenames=None, target_id=None, calibrator=None):
+        """
+        Returns:
+            dict: Info for the rawfiles matching all the given criteria
+            (all the rawfiles, if none are given), keyed by filename.
+        """
+        clauses, params = [], []
+        if target_id is not None:
+            clauses.append('target_id=?')
+            params.append(target_id)
+        if calibrator is not None:
+            clauses.append('calibrator=?')
+            params.append(calibrator)
+        rows = self._select('rawfiles', 'filename', clauses, params,
+                            filenames)
+        return dict((name, restore_file_info(json.loads(info)))
+                    for name, info in rows)
+
+    def query_files(self, cone=None, mjd_range=None, calibrator=None):
+        """
+        Args:
+            cone: Optional ``(ra_deg, dec_deg, radius_deg)`` tuple.
+            mjd_range: Optional ``(mjd_min, mjd_max)``; matches observations
+                overlapping the range.
+            calibrator: Optional calibrator name.
+
+        Returns:
+            list: Filenames matching all the given criteria, sorted by name.
+        """
+        return self._query('rawfiles', cone, mjd_range,
+                           [] if calibrator is None else
+                           [('calibrator=?', calibrator)])
+
+    # Groupings
+
+    def put_groups(self, grouping, groups):
+        """
+        Store ``groups`` (a ``{name: {files: [...], ...}}`` dict, as in a
+        grouped rawfile listing), replacing any existing grouping of the same
+        name.
+        """
+        group_rows, file_rows = [], []
+        for name, group in groups.items():
+            pointing = group.get(keys.target_pointing_deg) or (None, None)
+            group_rows.append((grouping, name, pointing[0], pointing[1],
+                               _to_json(group)))
+            file_rows.extend((grouping, name, filename)
+                             for filename in group[keys.files])
+        self._write([
+            ("DELETE FROM rawfile_groups WHERE grouping=?", [(grouping,)]),
+            ("DELETE FROM group_files WHERE grouping=?", [(grouping,)]),
+            ("INSERT INTO rawfile_groups VALUES (?, ?, ?, ?, ?)", group_rows),
+            ("INSERT INTO group_files VALUES (?, ?, ?)", file_rows)])
+
+    def groupings(self):
+        return [row[0] for row in self._read(
+            "SELECT DISTINCT grouping FROM rawfile_groups ORDER BY grouping")]
+
+    def group_names(self, grouping):
+        return [row[0] for row in self._read(
+            "SELECT name FROM rawfile_groups WHERE grouping=? ORDER BY name",
+            (grouping,))]
+
+    def groups(self, grouping, names=None):
+        """
+        Returns:
+            dict: The groups of ``grouping`` (only those listed in ``names``,
+            if given), as in a grouped rawfile listing.
+        """
+        rows = self._select('rawfile_groups', 'name', ['grouping=?'], [grouping],
+                            names)
+        return dict((name, json.loads(info)) for name, info in rows)
+
+    def groups_containing(self, grouping, match):
+        """
+        Names of the groups with any filename containing ``match``
+        (case-insensitive).
+        """
+        pattern = (match.replace('\\', '\\\\').replace('%', '\\%')
+                   .replace('_', '\\_'))
+        return [row[0] for row in self._read(
+            "SELECT DISTINCT name FROM group_files "
+            "WHERE grouping=? AND filename LIKE ? ESCAPE '\\' "
+            "ORDER BY name",
+            (grouping, '%' + pattern + '%'))]
+
+    def groups_for_file(self, filename):
+        """
+        Returns:
+            list: ``(grouping, name)`` for each group containing ``filename``.
+        """
+        return [tuple(row) for row in self._read(
+            "SELECT grouping, name FROM group_files WHERE filename=? "
+            "ORDER BY grouping, name", (filename,))]
+
+    # Calibrated results
+
+    def put_calibrated(self, calibrated):
+        """
+        Store (or replace) the info for each calibrated rawfile in
+        ``calibrated`` (as in a calibrated-file listing).
+        """
+        rows = []
+        for filename, info in calibrated.items():
+            rows.append((filename, info.get(keys.group_name)) +
+                        _file_columns(info) + (_to_json(info),))
+        self._write([("INSERT OR REPLACE INTO calibrated "
+                      "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)])
+
+    def calibrated(self, filenames=None, group_name=None, calibrator=None):
+        clauses, params = [], []
+        if group_name is not None:
+            clauses.append('group_name=?')
+            params.append(group_name)
+        if calibrator is not None:
+            clauses.append('calibrator=?')
+            params.append(calibrator)
+        rows = self._select('calibrated', 'filename', clauses, params,
+                            filenames)
+        return dict((name, json.loads(info)) for name, info in rows)
+
+    def query_calibrated(self, cone=None, mjd_range=None, group_name=None):
+        """As :meth:`query_files`, for the calibrated results."""
+        return self._query('calibrated', cone, mjd_range,
+                           [] if group_name is None else
+                           [('group_name=?', group_name)])
+
+    # Queries
+
+    def _select(self, table, key_column, clauses, params, keys_in):
+        """
+        ``(key, info)`` rows of ``table`` matching ``clauses``, and with
+        ``key_column`` in ``keys_in`` (if given).
+        """
+        sql = "SELECT {}, info FROM {}".format(key_column, table)
+        if keys_in is None:
+            if clauses:
+                sql += " WHERE " + " AND ".join(clauses)
+            return self._read(sql, params)
+        rows = []
+        keys_in = list(keys_in)
+        # (Batched, to stay within SQLite's limit on query parameters)
+        for start in range(0, len(keys_in), 500):
+            batch = keys_in[start:start + 500]
+            batch_clauses = clauses + ['{} IN ({})'.format(
+                key_column, ', '.join('?' * len(batch)))]
+            rows.extend(self._read(
+                sql + " WHERE " + " AND ".join(batch_clauses),
+                list(params) + batch))
+        return rows
+
+    def _query(self, table, cone, mjd_range, extra_clauses):
+        clauses = [clause for clause, _ in extra_clauses]
+        params = [param for _, param in extra_clauses]
+        if mjd_range is not None:
+            clauses.append('mjd_start <= ? AND mjd_end >= ?')
+            params.extend([mjd_range[1], mjd_range[0]])
+        if cone is not None:
+            # The declination band is answered from the pointing index,
+            # then the exact separation checked here:
+            ra_deg, dec_deg, radius_deg = cone
+            clauses.append('dec_deg BETWEEN ? AND ?')
+            params.extend([dec_deg - radius_deg, dec_deg + radius_deg])
+        sql = "SELECT filename, ra_deg, dec_deg FROM " + table
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        rows = self._read(sql, params)
+        if cone is not None and rows:
+            centre = unit_vectors([ra_deg], [dec_deg])[0]
+            offsets = unit_vectors([r[1] for r in rows],
+                                   [r[2] for r in rows]) - centre
+            chord_sq = np.einsum('ij,ij->i', offsets, offsets)
+            max_chord_sq = degrees_to_chord(radius_deg) ** 2
+            rows = [r for r, c in zip(rows, chord_sq) if c <= max_chord_sq]
+        return sorted(r[0] for r in rows)
+
+    # Import / export of JSON listings
+
+    def import_listing(self, filepointer, grouping=None):
+        """
+        Import a JSON (or JSON Lines) listing.
+
+        Calibrated-file listings are imported as calibrated results. Rawfile
+        listings are imported as a grouping named ``grouping`` if given
+        (e.g. ``'target_id'`` for a ``_by_id`` listing), else as rawfile
+        metadata (e.g. a ``_metadata`` listing).
+
+        Returns:
+            int: Number of entries imported.
+        """
+        datatype, records = iter_listing(filepointer)
+        listing = dict(records)
+        if datatype == Datatype.ami_la_calibrated:
+            self.put_calibrated(listing)
+        elif datatype == Datatype.ami_la_raw:
+            if grouping is not None:
+                self.put_groups(grouping, listing)
+            else:
+                self.put_files(listing)
+        else:
+            raise ValueError("Cannot import listings of type " + datatype)
+        logger.info("Imported %s entries from %s", len(listing), filepointer)
+        return len(listing)
+
+    def export_files(self, filepointer):
+        """Write the rawfile metadata as a (legacy format) rawfile listing."""
+        save_rawfile_listing(
+            dict((name, json.loads(info))
+                 for name, info in self._select('rawfiles', 'filename',
+                                                [], [], None)),
+            filepointer)
+
+    def export_groups(self, filepointer, grouping):
+        """Write ``grouping`` as a (legacy format) rawfile listing."""
+        save_rawfile_listing(self.groups(grouping), filepointer)
+
+    def export_calibrated(self, filepointer, jsonl=False):
+        """
+        Write the calibrated results as a calibrated-file listing, optionally
+        in the JSON Lines format.
+        """
+        if not jsonl:
+            save_calfile_listing(self.calibrated(), filepointer,
+                                 keep_rawtext=True)
+            return
+        writer = ListingWriter(filepointer, Datatype.ami_la_calibrated)
+        for name, info in self._select('calibrated', 'filename', [], [],
+                                       None):
+            writer.write(name, json.loads(info))
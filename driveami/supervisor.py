@@ -0,0 +1,127 @@
+"""
+Keep a long run going when an AMI-reduce session hangs or dies.
+
+A :class:`SupervisedReduce` processes rawfiles much as
+:func:`driveami.process_rawfile` does, but if the ``reduce`` child times out
+or exits part-way through a rawfile, the child is killed and replaced by a
+fresh session (same installation, array and environment). The rawfile is
+reported as failed, and processing can carry on with the next one, rather
+than abandoning the rest of the queue.
+
+Each restart is recorded in a :class:`RestartLog`, which may be shared
+between several supervised sessions (e.g. those of a
+:class:`driveami.pool.ReducePool`).
+"""
+from __future__ import absolute_import
+import logging
+import threading
+import timeit
+from collections import namedtuple
+
+import pexpect
+
+import driveami
+
+logger = logging.getLogger(__name__)
+
+RestartEvent = namedtuple('RestartEvent', 'rawfile reason lost_seconds')
+
+
+class RestartLog(object):
+    """Thread-safe record of the session restarts over a run."""
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def record(self, rawfile, reason, lost_seconds):
+        with self._lock:
+            self.events.append(RestartEvent(rawfile, reason, lost_seconds))
+
+    @property
+    def restarts(self):
+        return len(self.events)
+
+    @property
+    def lost_seconds(self):
+        """
+        Wall-clock time spent on the failed rawfiles, including respawning
+        their sessions.
+        """
+        return sum(event.lost_seconds for event in self.events)
+
+    @property
+    def failed_rawfiles(self):
+        return [event.rawfile for event in self.events]
+
+    def summary(self):
+        """Run-level values, e.g. for the calibrate script's summary."""
+        return {'session_restarts': self.restarts,
+                'session_restart_lost_seconds': self.lost_seconds,
+                'session_restart_failed_rawfiles': self.failed_rawfiles}
+
+
+class SupervisedReduce(object):
+    """
+    Wraps a :class:`.Reduce` session, replacing it if it hangs or dies.
+
+    ``reduce`` is the current session (replaced on restart).
+    """
+
+    def __init__(self, reduce, restart_log=None):
+        self.reduce = reduce
+        if restart_log is None:
+            restart_log = RestartLog()
+        self.restart_log = restart_log
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        try:
+            self.reduce.__exit__(None, None, None)
+        except (pexpect.ExceptionPexpect, OSError):
+            logger.debug("Error closing reduce session", exc_info=True)
+
+    def process_rawfile(self, rawfile, output_dir, script, **kwargs):
+        """
+        As for :func:`driveami.process_rawfile`, using the current session.
+
+        Returns:
+            dict: The rawfile info, or None if the session hung or died
+            (in which case it has been replaced).
+        """
+        start = timeit.default_timer()
+        try:
+            return driveami.process_rawfile(rawfile, output_dir,
+                                            reduce=self.reduce,
+                                            script=script, **kwargs)
+        except (pexpect.TIMEOUT, pexpect.EOF) as e:
+            reason = type(e).__name__
+            timed_out = isinstance(e, pexpect.TIMEOUT)
+        except OSError:
+            # (E.g. writing to the pty of a child which has exited)
+            if self.reduce.child.isalive():
+                raise
+            reason = 'OSError'
+            timed_out = False
+        logger.error("Reduce session %s reducing %s, restarting it.",
+                     'timed out' if timed_out else 'died', rawfile)
+        self.restart()
+        self.restart_log.record(rawfile, reason,
+                                timeit.default_timer() - start)
+        return None
+
+    def restart(self):
+        """Kill the current session and spawn a replacement."""
+        old = self.reduce
+        old.close_per_file_logs()
+        try:
+            old.child.close(force=True)
+        except (pexpect.ExceptionPexpect, OSError):
+            logger.debug("Error killing reduce session", exc_info=True)
+        self.reduce = old.spawn_sibling()
+        self.reduce.obs_info_cache = old.obs_info_cache
@@ -0,0 +1,168 @@
+"""
+Tools for exercising the driver without an AMI installation.
+
+:func:`make_fake_ami_rootdir` lays out a directory which can be passed as
+the ``ami_rootdir`` of a :class:`driveami.Reduce` (or pool, etc.), in place of
+a real installation. Its ``reduce`` and ``reduce_dc`` binaries are the
+scriptable fake in :mod:`driveami.testing.fakereduce`, e.g.::
+
+    rootdir = make_fake_ami_rootdir('/tmp/fakeami', n_files=1000,
+                                    output_lines=500, latency=0.01)
+    r = driveami.Reduce(rootdir, 'legacy')
+    r.load_obs_info()
+
+The fake's config can also be swapped per-session, by pointing
+``$FAKE_REDUCE_CONFIG`` at another JSON file via
+``additional_env_variables``.
+
+For unit tests, :class:`FakeRootdirTestCase` sets up a fresh fake rootdir
+per test, and spawns sessions against it.
+"""
+from __future__ import absolute_import
+import json
+import logging
+import os
+import shutil
+import stat
+import sys
+import tempfile
+from unittest import TestCase
+
+import driveami
+from driveami.testing import fakereduce
+
+_tcsh_shim = """#!/bin/sh
+# Stand-in for tcsh, just enough to run 'tcsh -c <command>':
+exec /bin/sh "$@"
+"""
+
+_reduce_stub = """#!/bin/sh
+exec {python} {script} '{prompt}' "$@"
+"""
+
+
+def _write_executable(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+    os.chmod(path, os.stat(path).st_mode |
+             stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def write_config(path, **config):
+    """
+    Write a config file for the fake ``reduce``, see
+    :data:`driveami.testing.fakereduce.default_config` for the options.
+    """
+    unknown = set(config) - set(fakereduce.default_config)
+    if unknown:
+        raise ValueError("Unknown fake reduce config option(s): {}".format(
+            sorted(unknown)))
+    full_config = dict(fakereduce.default_config)
+    full_config.update(config)
+    with open(path, 'w') as f:
+        json.dump(full_config, f, sort_keys=True, indent=4)
+    return full_config
+
+
+def make_fake_ami_rootdir(rootdir, create_rawfiles=True, array='LA',
+                          **config):
+    """
+    Set up a fake AMI installation at ``rootdir``.
+
+    Args:
+        rootdir: Directory to create (or reuse). NB as for a real install,
+            keep this path short.
+        create_rawfiles: Also create a small dummy rawfile for each
+            observation, under ``<rootdir>/<array>/data`` (so that e.g.
+            :func:`driveami.result_key` can fingerprint them).
+        config: Options for the fake ``reduce``, e.g. ``n_files``,
+            ``output_lines``, ``latency``.
+
+    Returns:
+        str: ``rootdir``
+    """
+    bin_dir = os.path.join(rootdir, 'bin')
+    data_dir = os.path.join(rootdir, array, 'data')
+    for dirname in (bin_dir, data_dir):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+    full_config = write_config(
+        os.path.join(rootdir, fakereduce.config_basename), **config)
+
+    script = os.path.splitext(os.path.abspath(fakereduce.__file__))[0] + '.py'
+    _write_executable(os.path.join(bin_dir, 'tcsh'), _tcsh_shim)
+    for binary, prompt in (('reduce', 'AMI-reduce>'),
+                           ('reduce_dc', 'AMIDC-reduce>')):
+        _write_executable(os.path.join(bin_dir, binary),
+                          _reduce_stub.format(python=sys.executable,
+                                              script=script, prompt=prompt))
+
+    if create_rawfiles:
+        for obs in fakereduce.archive(full_config):
+            path = os.path.join(data_dir, obs['name'])
+            if not os.path.exists(path):
+                with open(path, 'w') as f:
+                    f.write(json.dumps(obs))
+    return rootdir
+
+
+class ListHandler(logging.Handler):
+    """Records the messages logged to it."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class FakeRootdirTestCase(TestCase):
+    """
+    Sets up a fake AMI rootdir (see :func:`make_fake_ami_rootdir`) for each
+    test, from the class's ``config``.
+    """
+    config = dict(n_files=12, n_targets=3, incomplete_every=5,
+                  raster_every=6, comment_every=4)
+    create_rawfiles = True
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.rootdir = make_fake_ami_rootdir(
+            os.path.join(self.tempdir, 'ami'),
+            create_rawfiles=self.create_rawfiles, **self.config)
+        self.output_dir = os.path.join(self.tempdir, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def spawn(self, ami_version='legacy', **kwargs):
+        """
+        Spawn a :class:`driveami.Reduce` session, closed after the test
+        (unless the test has already closed it).
+        """
+        kwargs.setdefault('timeout', 10)
+        r = driveami.Reduce(self.rootdir, ami_version,
+                            working_dir=self.tempdir, **kwargs)
+
+        def close():
+            if not r.child.closed:
+                r.__exit__(None, None, None)
+
+        self.addCleanup(close)
+        return r
+
+    def capture_file_logs(self, r):
+        """
+        Record the messages logged for the active file of session ``r``
+        (so call after :meth:`driveami.Reduce.set_active_file`).
+
+        Returns:
+            tuple: :class:`ListHandler` for the output log and the command log.
+        """
+        log, cmd_log = ListHandler(), ListHandler()
+        for file_logger, handler in ((r.file_log, log),
+                                     (r.file_cmd_log, cmd_log)):
+            file_logger.addHandler(handler)
+            self.addCleanup(file_logger.removeHandler, handler)
+        return log, cmd_log
@@ -0,0 +1,304 @@
+"""
+A scriptable stand-in for the AMI ``reduce`` / ``reduce_dc`` binaries.
+
+Speaks just enough of the interactive protocol (prompt, command echo via the
+terminal, canned output) to drive :class:`driveami.Reduce` end to end without
+an AMI installation. The archive it reports is generated deterministically
+from a JSON config, so the same config always lists the same rawfiles.
+
+NB this module is run directly as the ``reduce`` executable (see
+:func:`driveami.testing.make_fake_ami_rootdir`), so uses only the standard
+library, and must not import ``driveami``.
+
+Config values (see :data:`default_config`):
+
+n_files, n_targets
+    Size of the archive. Rawfiles are named ``FAKE<target>-<index>.raw``
+    and assigned to targets in turn.
+incomplete_every, raster_every, comment_every
+    Every n'th rawfile is an incomplete observation (zero duration in
+    ``list observation``) / a raster / has a comment. Zero for none.
+output_lines
+    Filler lines of output from each reduction command (e.g. ``flag``).
+latency
+    Seconds to wait before responding to each command.
+command_latency
+    Per-command overrides of ``latency``, keyed by the first word of the
+    command, e.g. ``{"reweight": 2.0}``.
+line_latency
+    Seconds to wait before each line of output (so the output trickles
+    out, as for a slow but busy command).
+hang_files, crash_files
+    Rawfile names for which loading the file (``file <name>``) hangs
+    indefinitely / makes the process exit abruptly, as for a wedged or
+    crashed ``reduce``.
+"""
+from __future__ import print_function
+import datetime
+import json
+import os
+import sys
+import time
+
+config_env_var = 'FAKE_REDUCE_CONFIG'
+config_basename = 'fake_reduce.json'
+
+default_config = {
+    'n_files': 10,
+    'n_targets': 3,
+    'incomplete_every': 0,
+    'raster_every': 0,
+    'comment_every': 0,
+    'output_lines': 20,
+    'latency': 0.0,
+    'command_latency': {},
+    'line_latency': 0.0,
+    'hang_files': [],
+    'crash_files': [],
+}
+
+calibrators = ('3C286', '3C48')
+
+# Recognised by the fake, in addition to those with specific responses:
+generic_commands = ('update', 'subtract', 'fft', 'frotate', 'smooth', 'scan',
+                    'set', 'apply', 'cal')
+
+_mjd_epoch = datetime.datetime(1858, 11, 17)
+
+
+def load_config(path=None):
+    """
+    Read the config from ``path``, or failing that from the file named by
+    ``$FAKE_REDUCE_CONFIG``, or ``$AMI_DIR/fake_reduce.json``.
+    """
+    config = dict(default_config)
+    if path is None:
+        path = os.environ.get(config_env_var)
+    if path is None and 'AMI_DIR' in os.environ:
+        path = os.path.join(os.environ['AMI_DIR'], config_basename)
+    if path is not None and os.path.exists(path):
+        with open(path) as f:
+            config.update(json.load(f))
+    return config
+
+
+def _every(n, idx):
+    return n > 0 and idx % n == n - 1
+
+
+def rawfile_name(config, idx):
+    return 'FAKE{:04d}-{:06d}.raw'.format(idx % config['n_targets'], idx)
+
+
+def archive(config):
+    """
+    Returns:
+        list: A dict describing each rawfile in the fake archive.
+    """
+    obs = []
+    for idx in range(config['n_files']):
+        target = idx % config['n_targets']
+        # Targets are spread over the sky, repeat visits jitter slightly:
+        jitter = (idx // config['n_targets']) % 10 / 3600.
+        mjd = 56000.0 + idx * 0.37
+        obs.append({
+            'name': rawfile_name(config, idx),
+            'field': 'FAKE{:04d}'.format(target),
+            'calibrator': calibrators[target % len(calibrators)],
+            'ra_hours': (target * 2.7 + jitter) % 24,
+            'dec_deg': (target * 17.3) % 150 - 75 + jitter,
+            'mjd_start': mjd,
+            'mjd_end': mjd + (1 + idx % 4) / 24.,
+            'incomplete': _every(config['incomplete_every'], idx),
+            'raster': _every(config['raster_every'], idx),
+            'comment': ('fake comment {}'.format(idx)
+                        if _every(config['comment_every'], idx) else None),
+        })
+    return obs
+
+
+def _sexagesimal(value, sign=False):
+    negative = value < 0
+    # (Rounded up front, so the seconds never print as 60.00)
+    hundredths = int(round(abs(value) * 360000))
+    units, hundredths = divmod(hundredths, 360000)
+    minutes, hundredths = divmod(hundredths, 6000)
+    text = '{:02d} {:02d} {:05.2f}'.format(units, minutes, hundredths / 100.)
+    if sign:
+        text = ('-' if negative else '+') + text
+    return text
+
+
+def _times(mjd):
+    dt = _mjd_epoch + datetime.timedelta(days=mjd)
+    st = dt + datetime.timedelta(hours=6)
+    return dt, dt.strftime('%H.%M.%S'), st.strftime('%H.%M.%S')
+
+
+def observation_listing(obs, full=True):
+    """
+    Output of ``list observation`` (or with ``full``, ``show observation``).
+
+    An incomplete observation lacks a stop time, unless ``full``.
+    """
+    start, ut0, st0 = _times(obs['mjd_start'])
+    mjd_end = obs['mjd_end']
+    if obs['incomplete'] and not full:
+        mjd_end = obs['mjd_start']
+    _, ut1, st1 = _times(mjd_end)
+    # Reduce separates RA and Dec by 3 spaces for +ve Dec, 2 for -ve:
+    separator = '  ' if obs['dec_deg'] < 0 else '   '
+    lines = ['',
+             ' {}   field observation with calibrator {}'.format(
+                 obs['field'], obs['calibrator']),
+             ' Tracking    : {}{}{}  J2000'.format(
+                 _sexagesimal(obs['ra_hours']), separator,
+                 _sexagesimal(obs['dec_deg'], sign=True).lstrip('+')),
+             '               {}'.format(start.strftime('%d/%m/%Y')),
+             ' Start time  : {} UT  {} ST  {:.5f} MJD'.format(
+                 ut0, st0, obs['mjd_start']),
+             ' Stop time   : {} UT  {} ST  {:.5f} MJD'.format(
+                 ut1, st1, mjd_end)]
+    if obs['raster']:
+        lines.append(' Pointing    : raster, 19 points')
+    return lines
+
+
+def fits_header():
+    """A minimal (empty primary HDU) FITS file."""
+    cards = ['SIMPLE  = {:>20}'.format('T'),
+             'BITPIX  = {:>20}'.format(8),
+             'NAXIS   = {:>20}'.format(0),
+             'END']
+    header = ''.join(card.ljust(80) for card in cards)
+    return header.ljust(2880)
+
+
+class FakeReduce(object):
+    def __init__(self, prompt, config, out=sys.stdout):
+        self.prompt = prompt
+        self.config = config
+        self.out = out
+        self.obs = archive(config)
+        self.by_name = dict((o['name'], o) for o in self.obs)
+        self.active = None
+        self.n_flag_commands = 0
+
+    def filler(self, tag):
+        return ['  {} {:6d}  baseline {:3d}  chan {:2d}  amp {:8.4f}'.format(
+            tag, i, i % 45, i % 8, 0.01 * (i % 97))
+            for i in range(self.config['output_lines'])]
+
+    def flag_summary(self):
+        self.n_flag_commands += 1
+        percent = min(5.0 * self.n_flag_commands, 99.0)
+        return [' Total of {:9d} samples flagged ( {:.2f}% )'.format(
+            1000 * self.n_flag_commands, percent)]
+
+    def respond(self, command):
+        """Returns the lines of output for ``command``."""
+        words = command.split()
+        if not words:
+            return []
+        name = words[0]
+        if command == 'set def la':
+            return [' Default array is now LA']
+        if name == 'version':
+            return [' AMI-REDUCE (fake, driveami.testing) version 1.0']
+        if command == 'list files':
+            lines = ['']
+            for o in self.obs:
+                lines.append(' {}  {}  {:.2f} hrs'.format(
+                    o['name'], o['field'],
+                    (o['mjd_end'] - o['mjd_start']) * 24))
+            total = sum(o['mjd_end'] - o['mjd_start'] for o in self.obs) * 24
+            return lines + ['', '', ' Total obs time {:.1f} hrs'.format(total),
+                            '']
+        if command == 'list comment':
+            return [''] + ['{} {}'.format(o['name'], o['comment'])
+                           for o in self.obs if o['comment']]
+        if command.startswith('list observation'):
+            obs = self.by_name.get(words[-1])
+            if obs is None:
+                return [' Error: file not found ' + words[-1]]
+            return observation_listing(obs, full=False)
+        if name == 'file':
+            obs = self.by_name.get(words[-1])
+            if obs is None:
+                return [' Error: file not found ' + words[-1]]
+            self.active = obs
+            self.n_flag_commands = 0
+            lines = [' Reading file ' + obs['name']]
+            if obs['incomplete']:
+                lines.append(' Warning: incomplete observation, '
+                             'no stop time recorded')
+            return lines
+        if self.active is None:
+            return [' Error: no file loaded']
+        if command.startswith('show observation'):
+            return observation_listing(self.active)
+        if name == 'flag' or command.startswith('show flagging'):
+            return self.filler('flag') + self.flag_summary()
+        if command.startswith('apply rain'):
+            return self.filler('rain') + [
+                ' Mean amplitude correction factor  1.0213']
+        if command.startswith('cal inter'):
+            return self.filler('cal') + [
+                ' Nearest flux cal {} obs at 1.25 days apart'.format(
+                    self.active['calibrator'])]
+        if name == 'reweight':
+            return self.filler('rwt') + [
+                ' Overall estimated noise  0.00123 Jy']
+        if name == 'write':
+            lines = []
+            for path in words:
+                if path.endswith('.fits'):
+                    with open(path, 'w') as f:
+                        f.write(fits_header())
+                    lines.append(' Written ' + path)
+            return lines
+        if name in generic_commands:
+            return self.filler(name)
+        return [' Error: unknown command ' + command]
+
+    def latency(self, command):
+        words = command.split()
+        if words and words[0] in self.config['command_latency']:
+            return self.config['command_latency'][words[0]]
+        return self.config['latency']
+
+    def run(self, commands=sys.stdin):
+        self.out.write(self.prompt)
+        self.out.flush()
+        for command in iter(commands.readline, ''):
+            command = command.strip().rstrip('\\').strip()
+            if command in ('exit', 'quit'):
+                return 0
+            words = command.split()
+            if words and words[0] == 'file':
+                if words[-1] in self.config['crash_files']:
+                    return 1
+                while words[-1] in self.config['hang_files']:
+                    time.sleep(60)
+            delay = self.latency(command)
+            if delay:
+                time.sleep(delay)
+            for line in self.respond(command):
+                if self.config['line_latency']:
+                    self.out.flush()
+                    time.sleep(self.config['line_latency'])
+                self.out.write(line + '\n')
+            self.out.write(self.prompt)
+            self.out.flush()
+        return 0
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    prompt = argv[0] if argv else 'AMI-reduce>'
+    return FakeReduce(prompt, load_config()).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+from unittest import TestCase
+import json
+import os
+import shutil
+import tempfile
+
+import driveami
+import driveami.keys as keys
+from driveami.metrics import command_key
+from driveami.testing import FakeRootdirTestCase
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+class TestCommandKey(TestCase):
+    def test_arguments_dropped(self):
+        self.assertEqual(command_key(r'flag amp field no 0.95 1 yes \ '),
+                         'flag amp field')
+        self.assertEqual(command_key(r'file SWIFT_590206-140305.raw \ '),
+                         'file')
+        self.assertEqual(command_key(r'show flagging no yes \ '),
+                         'show flagging')
+        self.assertEqual(command_key('version'), 'version')
+        self.assertEqual(command_key(''), '(blank)')
+
+
+class TestCommandTimings(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.timings = driveami.CommandTimings()
+        for seconds in range(1, 101):
+            self.timings.add(r'smooth 20 \ ', float(seconds), 10)
+        self.timings.add_file_info({keys.command_timings: [
+            {'command': 'flag all', 'seconds': 0.5, 'output_bytes': 7}]})
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_summary(self):
+        summary = self.timings.summary()
+        self.assertEqual(sorted(summary.keys()), ['flag all', 'smooth'])
+        smooth = summary['smooth']
+        self.assertEqual(smooth['count'], 100)
+        self.assertAlmostEqual(smooth['p50_seconds'], 50.5)
+        self.assertAlmostEqual(smooth['p95_seconds'], 95.05)
+        self.assertEqual(smooth['max_seconds'], 100.)
+        self.assertEqual(smooth['output_bytes'], 1000)
+
+    def test_exports(self):
+        json_path = os.path.join(self.tempdir, 'summary.json')
+        self.timings.write_json_summary(json_path, run_seconds=12.5)
+        with open(json_path) as f:
+            summary = json.load(f)
+        self.assertEqual(summary['run_seconds'], 12.5)
+        self.assertEqual(summary['commands']['flag all']['count'], 1)
+
+        prom_path = os.path.join(self.tempdir, 'driveami.prom')
+        self.timings.write_prometheus_textfile(prom_path)
+        with open(prom_path) as f:
+            lines = f.read().splitlines()
+        self.assertIn('driveami_command_duration_seconds_count'
+                      '{command="smooth"} 100', lines)
+        self.assertIn('driveami_command_duration_max_seconds'
+                      '{command="smooth"} 100.0', lines)
+        self.assertIn('driveami_command_output_bytes_total'
+                      '{command="flag all"} 7', lines)
+
+
+class TestTimingsRecorded(FakeRootdirTestCase):
+    config = dict(n_files=1, n_targets=1, output_lines=20)
+    rawfile = 'FAKE0000-000000.raw'
+
+    def setUp(self):
+        FakeRootdirTestCase.setUp(self)
+        self.reduce = self.spawn()
+        self.reduce.set_active_file(self.rawfile)
+
+    def test_run_command_timings(self):
+        r = self.reduce
+        # (Starts a fresh record, after those of set_active_file)
+        r._activate_file(self.rawfile, None)
+        r.run_script('smooth 20 \\\nscan dat cal yes \\')
+        timings = r.files[r.active_file][keys.command_timings]
+        self.assertEqual([t['command'] for t in timings],
+                         ['smooth 20 \\', 'scan dat cal yes \\'])
+        self.assertGreater(timings[1]['output_bytes'], 999)
+        self.assertTrue(all(t['seconds'] >= 0 for t in timings))
+
+        # Re-activating the file starts a fresh record:
+        r._activate_file(self.rawfile, None)
+        self.assertEqual(r.files[r.active_file][keys.command_timings], [])
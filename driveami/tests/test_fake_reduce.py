@@ -0,0 +1,219 @@
+from unittest import skipIf
+import json
+import os
+import sys
+import timeit
+
+import driveami
+import driveami.keys as keys
+from driveami.scripts import (standard_legacy_reduction,
+                              standard_digital_reduction)
+from driveami.metrics import command_key
+from driveami.testing import FakeRootdirTestCase, write_config
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestFakeReduce(FakeRootdirTestCase):
+    def test_obs_info(self):
+        r = self.spawn()
+        self.assertEqual(len(r.files), 12)
+        r.load_obs_info()
+        info = r.files['FAKE0001-000004.raw']
+        self.assertTrue(info[keys.warnings][keys.warning_incomplete])
+        self.assertEqual(info[keys.duration], 1.0)
+        self.assertEqual(info[keys.calibrator], '3C48')
+        self.assertEqual(info[keys.pointing_hms_dms],
+                         ('02:42:01.00', '-57:41:59.00'))
+        self.assertTrue(r.files['FAKE0002-000005.raw'][keys.raster])
+        self.assertEqual(r.files['FAKE0000-000003.raw'][keys.comment],
+                         'fake comment 3')
+        self.assertEqual(sorted(r.group_obs_by_target_id()),
+                         ['FAKE0000', 'FAKE0001', 'FAKE0002'])
+
+    def test_streamed_file_list(self):
+        buffered = self.spawn()
+        streamed = self.spawn(streaming=True)
+        self.assertEqual(len(streamed.files), 12)
+        self.assertEqual(streamed.files, buffered.files)
+        self.assertEqual(streamed.files['FAKE0000-000003.raw'][keys.comment],
+                         'fake comment 3')
+
+    def test_sharded_obs_info(self):
+        def without_timings(files):
+            return dict((filename, dict((k, v) for k, v in info.items()
+                                        if k != keys.command_timings))
+                        for filename, info in files.items())
+
+        serial = self.spawn()
+        serial.load_obs_info()
+        for _ in range(3):
+            sharded = self.spawn()
+            sharded.load_obs_info(workers=4)
+            self.assertEqual(without_timings(sharded.files),
+                             without_timings(serial.files))
+
+    def test_process_rawfile(self):
+        r = self.spawn()
+        info = driveami.process_rawfile('FAKE0000-000000.raw',
+                                        self.output_dir, r,
+                                        standard_legacy_reduction)
+        self.assertEqual(info[keys.est_noise_jy], 0.00123)
+        self.assertEqual(info[keys.rain], 1.0213)
+        self.assertEqual(info[keys.archive_cal_days_apart], 1.25)
+        self.assertIsNotNone(info[keys.flagged_final])
+        for key in (keys.target_uvfits, keys.cal_uvfits):
+            with open(info[key]) as f:
+                self.assertTrue(f.read().startswith('SIMPLE  ='))
+        self.assertEqual(os.path.getsize(info[keys.target_uvfits]), 2880)
+
+    def test_skipped_marked(self):
+        r = self.spawn()
+        manifest = driveami.ResultManifest.for_output_dir(self.output_dir)
+        results = [driveami.process_rawfile('FAKE0000-000000.raw',
+                                            self.output_dir, r,
+                                            standard_legacy_reduction,
+                                            file_logging=False,
+                                            manifest=manifest)
+                   for _ in range(2)]
+        self.assertNotIn(keys.skipped, results[0])
+        self.assertTrue(results[1][keys.skipped])
+        with open(os.path.join(self.output_dir,
+                               'FAKE0000-000000.json')) as f:
+            self.assertNotIn(keys.skipped, json.load(f))
+
+    def test_pipelined_matches_lockstep(self):
+        results = []
+        for pipelined in (False, True):
+            r = self.spawn('digital', pipelined=pipelined)
+            info = driveami.process_rawfile(
+                'FAKE0002-000002.raw', self.output_dir, r,
+                standard_digital_reduction, file_logging=False)
+            results.append([info[k] for k in (
+                keys.est_noise_jy, keys.flagged_max, keys.flagged_final)])
+        self.assertEqual(results[0], results[1])
+
+    def test_pool(self):
+        jobs = [driveami.RawfileJob(rawfile, self.output_dir,
+                                    standard_legacy_reduction, None)
+                for rawfile in ('FAKE0000-000000.raw', 'FAKE0001-000001.raw',
+                                'FAKE0001-000004.raw')]
+        with driveami.ReducePool(2, self.rootdir, 'legacy',
+                                 working_dir=self.tempdir, timeout=10,
+                                 high_throughput=True) as pool:
+            results = pool.process_rawfiles(jobs, file_logging=False,
+                                            incremental=True)
+        self.assertEqual(sorted(job.rawfile for job, _ in results),
+                         sorted(job.rawfile for job in jobs))
+        with open(os.path.join(self.output_dir,
+                               'FAKE0001-000004.json')) as f:
+            self.assertGreater(json.load(f)[keys.duration], 0)
+
+    def test_pool_on_result(self):
+        jobs = [driveami.RawfileJob(rawfile, self.output_dir,
+                                    standard_legacy_reduction, None)
+                for rawfile in ('FAKE0000-000000.raw', 'FAKE0001-000001.raw')]
+        handed_over = []
+        with driveami.ReducePool(2, self.rootdir, 'legacy',
+                                 working_dir=self.tempdir,
+                                 timeout=10) as pool:
+            results = pool.process_rawfiles(
+                jobs, file_logging=False,
+                on_result=lambda job, info: handed_over.append(job.rawfile))
+        self.assertEqual(results, [])
+        self.assertEqual(sorted(handed_over),
+                         sorted(job.rawfile for job in jobs))
+
+    def test_pool_spawn_failure(self):
+        spawned = []
+
+        def fail_second_spawn(session):
+            spawned.append(session)
+            if len(spawned) == 2:
+                session.child.close(force=True)
+                raise RuntimeError("spawn failed")
+
+        hooks = driveami.HookRegistry()
+        hooks.register('session_spawn', fail_second_spawn)
+        with self.assertRaises(RuntimeError):
+            driveami.ReducePool(3, self.rootdir, 'legacy',
+                                working_dir=self.tempdir, timeout=10,
+                                hooks=hooks)
+        self.assertEqual(len(spawned), 2)
+        self.assertFalse(spawned[0].child.isalive())
+
+    def test_config_override(self):
+        config_path = os.path.join(self.tempdir, 'slow.json')
+        write_config(config_path, n_files=2, n_targets=1,
+                     command_latency={'reweight': 0.2})
+        r = self.spawn(additional_env_variables={
+            'FAKE_REDUCE_CONFIG': config_path})
+        self.assertEqual(len(r.files), 2)
+        r.set_active_file('FAKE0000-000001.raw')
+        start = timeit.default_timer()
+        r.run_command('reweight \\')
+        self.assertGreaterEqual(timeit.default_timer() - start, 0.2)
+        with self.assertRaises(ValueError):
+            write_config(config_path, n_file=2)
+
+
+@skipIf(sys.version_info < (3, 5), "AsyncReduce requires Python 3.5+")
+class TestFakeAsyncReduce(FakeRootdirTestCase):
+    def test_process_rawfile(self):
+        import asyncio
+        from driveami.asyncreduce import AsyncReduce, process_rawfile
+
+        # (No async syntax here, so this module still compiles on Python 2)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        r = loop.run_until_complete(AsyncReduce.create(
+            self.rootdir, 'legacy', working_dir=self.tempdir, timeout=10))
+        info = loop.run_until_complete(process_rawfile(
+            'FAKE0000-000000.raw', self.output_dir, r,
+            standard_legacy_reduction))
+        loop.run_until_complete(r.__aexit__(None, None, None))
+        self.assertEqual(info[keys.est_noise_jy], 0.00123)
+
+    def test_spawn_sibling(self):
+        import asyncio
+        from driveami.asyncreduce import AsyncReduce
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        r = loop.run_until_complete(AsyncReduce.create(
+            self.rootdir, 'legacy', working_dir=self.tempdir, timeout=10))
+        sibling = loop.run_until_complete(r.spawn_sibling())
+        self.assertIsInstance(sibling, AsyncReduce)
+        self.assertEqual(sorted(sibling.files), sorted(r.files))
+        for session in (r, sibling):
+            loop.run_until_complete(session.__aexit__(None, None, None))
+
+    def test_housekeeping_hooks_and_timeouts(self):
+        import asyncio
+        from driveami.asyncreduce import AsyncReduce
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        commands = []
+        hooks = driveami.HookRegistry()
+        hooks.register('after_command',
+                       lambda session, command, seconds, output_bytes:
+                       commands.append(command))
+        policy = driveami.TimeoutPolicy()
+        r = loop.run_until_complete(AsyncReduce.create(
+            self.rootdir, 'legacy', working_dir=self.tempdir, timeout=10,
+            hooks=hooks, timeout_policy=policy))
+        loop.run_until_complete(r.get_obs_details('FAKE0001-000001.raw'))
+        loop.run_until_complete(r.__aexit__(None, None, None))
+        self.assertEqual(commands, [
+            'set def la', r'list files \ ', r'list comment \ ',
+            r'list observation FAKE0001-000001.raw \ '])
+        self.assertEqual(sorted(policy.latencies),
+                         sorted(set(command_key(c) for c in commands)))
+
+    def test_unsupported_options(self):
+        from driveami.asyncreduce import AsyncReduce
+        for option in ('streaming', 'pipelined', 'stall_timeout'):
+            with self.assertRaises(ValueError):
+                AsyncReduce(self.rootdir, 'legacy', **{option: 5})
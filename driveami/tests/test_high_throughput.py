@@ -0,0 +1,19 @@
+import driveami.keys as keys
+from driveami.testing import FakeRootdirTestCase
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestHighThroughputMode(FakeRootdirTestCase):
+    config = dict(n_files=20000, n_targets=100, comment_every=4)
+    create_rawfiles = False
+
+    def test_update_files_matches_default_mode(self):
+        # (Each session runs update_files as it starts)
+        default = self.spawn(high_throughput=False, timeout=60)
+        fast = self.spawn(high_throughput=True, timeout=60)
+        self.assertEqual(len(fast.files), self.config['n_files'])
+        self.assertEqual(fast.files, default.files)
+        self.assertEqual(fast.files['FAKE0003-000003.raw'],
+                         {keys.comment: 'fake comment 3'})
@@ -0,0 +1,88 @@
+from unittest import TestCase
+import json
+import os
+
+import driveami
+from driveami.testing import FakeRootdirTestCase
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+
+class RecordingHook(object):
+    def __init__(self):
+        self.calls = []
+
+    def on_before_command(self, session, command):
+        self.calls.append(('before_command', command))
+
+    def on_after_command(self, session, command, seconds, output_bytes):
+        self.calls.append(('after_command', command, output_bytes))
+
+    def on_session_exit(self, session):
+        self.calls.append(('session_exit',))
+
+
+class TestHooks(FakeRootdirTestCase):
+    config = dict(n_files=1, n_targets=1, output_lines=2)
+
+    def spawn(self, hooks=None):
+        r = FakeRootdirTestCase.spawn(self, hooks=hooks)
+        r.set_active_file('FAKE0000-000000.raw')
+        return r
+
+    def test_session_hooks(self):
+        hook = RecordingHook()
+        registry = driveami.HookRegistry()
+        r = self.spawn(hooks=registry)
+        other = self.spawn()
+        # (After the session's housekeeping commands)
+        registry.add(hook)
+        r.run_command(r'scan dat cal yes \ ')
+        other.run_command(r'smooth 20 \ ')
+        r.__exit__(None, None, None)
+        other.__exit__(None, None, None)
+        self.assertEqual(hook.calls[0],
+                         ('before_command', r'scan dat cal yes \ '))
+        self.assertEqual(hook.calls[1][:2],
+                         ('after_command', r'scan dat cal yes \ '))
+        self.assertGreater(hook.calls[1][2], 99)
+        self.assertEqual(hook.calls[2:], [('session_exit',)])
+
+        registry.remove(hook)
+        self.assertEqual(registry.callbacks['after_command'], [])
+
+    def test_global_hooks(self):
+        hook = RecordingHook()
+        r = self.spawn()
+        driveami.global_hooks.add(hook)
+        self.addCleanup(driveami.global_hooks.remove, hook)
+        r.run_command(r'smooth 20 \ ')
+        r.__exit__(None, None, None)
+        self.assertEqual([c[0] for c in hook.calls],
+                         ['before_command', 'after_command', 'session_exit'])
+
+    def test_unknown_event(self):
+        with self.assertRaises(ValueError):
+            driveami.HookRegistry().register('on_command', lambda s: None)
+
+    def test_chrome_trace(self):
+        path = os.path.join(self.tempdir, 'trace.json')
+        trace = driveami.ChromeTraceHook(path)
+        registry = driveami.HookRegistry()
+        sessions = [self.spawn(hooks=registry) for _ in range(2)]
+        registry.add(trace)
+        for r in sessions:
+            r.run_script('smooth 20 \\\nscan dat cal yes \\')
+            r.__exit__(None, None, None)
+        trace.write()
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+        commands = [e for e in events if e['ph'] == 'X']
+        self.assertEqual(len(commands), 4)
+        self.assertEqual(sorted(set(e['name'] for e in commands)),
+                         ['scan dat cal', 'smooth'])
+        self.assertEqual(sorted(set(e['tid'] for e in commands)), [1, 2])
+        self.assertTrue(all(e['dur'] >= 0 for e in commands))
+        thread_names = [e for e in events if e['ph'] == 'M']
+        self.assertEqual(len(thread_names), 2)
@@ -0,0 +1,93 @@
+from unittest import TestCase
+import json
+import os
+import shutil
+import tempfile
+
+import driveami
+from driveami.lazylisting import offsets_path_for_listing
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestLazyListing(TestCase):
+    def setUp(self):
+        self.testdata = {
+            'foo1': {'files': ['foo1-1.raw', 'foo1-2.raw']},
+            'foo2': {'files': ['foo2-1.raw'], 'note': 'brackets {[",]}'},
+            u'foo\xe93': {'files': [], 'nested': {'a': [1, {'b': 2}]}},
+        }
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def save_legacy(self):
+        path = os.path.join(self.tempdir, 'by_id.json')
+        with open(path, 'w') as f:
+            driveami.save_rawfile_listing(self.testdata, f)
+        return path
+
+    def save_jsonl(self):
+        path = os.path.join(self.tempdir, 'by_id.jsonl')
+        with driveami.ListingWriter.open(
+                path, driveami.Datatype.ami_la_raw) as writer:
+            for key in sorted(self.testdata):
+                writer.write(key, self.testdata[key])
+        return path
+
+    def check_listing(self, path):
+        with driveami.open_listing(path) as listing:
+            self.assertEqual(listing.datatype, driveami.Datatype.ami_la_raw)
+            self.assertEqual(sorted(listing), sorted(self.testdata))
+            self.assertEqual(len(listing), 3)
+            self.assertTrue('foo2' in listing)
+            self.assertFalse(driveami.Datatype.magic_key in listing)
+            self.assertEqual(listing['foo2'], self.testdata['foo2'])
+            self.assertEqual(listing.select(['foo1', u'foo\xe93']),
+                             {'foo1': self.testdata['foo1'],
+                              u'foo\xe93': self.testdata[u'foo\xe93']})
+            self.assertEqual(dict(listing.items()), self.testdata)
+            with self.assertRaises(KeyError):
+                listing.select(['foo1', 'missing'])
+
+    def test_legacy(self):
+        self.check_listing(self.save_legacy())
+
+    def test_jsonl(self):
+        self.check_listing(self.save_jsonl())
+
+    def test_expected_datatype(self):
+        path = self.save_legacy()
+        with self.assertRaises(ValueError):
+            driveami.open_listing(
+                path, expected_datatype=driveami.Datatype.ami_la_calibrated)
+        other = os.path.join(self.tempdir, 'other.json')
+        with open(other, 'w') as f:
+            json.dump(self.testdata, f)
+        with self.assertRaises(ValueError):
+            driveami.open_listing(other)
+
+    def test_offsets_cached(self):
+        path = self.save_legacy()
+        offsets_path = offsets_path_for_listing(path)
+        driveami.open_listing(path).close()
+        self.assertTrue(os.path.exists(offsets_path))
+
+        # The cached index is used while the listing is unchanged...
+        with open(offsets_path) as f:
+            index = json.load(f)
+        index['offsets'].pop('foo1')
+        with open(offsets_path, 'w') as f:
+            json.dump(index, f)
+        with driveami.open_listing(path) as listing:
+            self.assertEqual(len(listing), 2)
+
+        # ...and rebuilt once it changes.
+        self.testdata['foo4'] = {'files': []}
+        self.save_legacy()
+        os.utime(path, (0, 0))
+        with driveami.open_listing(path) as listing:
+            self.assertEqual(sorted(listing), sorted(self.testdata))
+            self.assertEqual(listing['foo4'], {'files': []})
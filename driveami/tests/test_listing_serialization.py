@@ -1,6 +1,9 @@
 from unittest import TestCase
 import driveami
 import json
+import os
+import shutil
+import tempfile
 
 from StringIO import StringIO
 
@@ -47,4 +50,76 @@ class TestListingSerialization(TestCase):
         driveami.save_rawfile_listing(self.testdata, s)
         with self.assertRaises(ValueError):
             listing, datatype = driveami.load_listing(StringIO(s.getvalue()),
-                              expected_datatype=driveami.Datatype.ami_la_calibrated)
\ No newline at end of file
+                              expected_datatype=driveami.Datatype.ami_la_calibrated)
+
+
+class TestJsonLinesListing(TestCase):
+    def setUp(self):
+        self.testdata = {'foo1': {'bar': 'baz1'},
+                         'foo2': {'bar': 'baz2'},
+                         }
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'listing.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, datatype=driveami.Datatype.ami_la_calibrated, **kwargs):
+        with driveami.ListingWriter.open(self.path, datatype,
+                                         **kwargs) as writer:
+            for key in sorted(self.testdata):
+                writer.write(key, self.testdata[key])
+
+    def test_roundtrip(self):
+        self.write()
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(json.loads(lines[0]),
+                         {'#DATATYPE': driveami.Datatype.ami_la_calibrated})
+        self.assertEqual(len(lines), 3)
+        with open(self.path) as f:
+            listing, datatype = driveami.load_listing(f)
+        self.assertEqual(datatype, driveami.Datatype.ami_la_calibrated)
+        self.assertEqual(listing, self.testdata)
+        with open(self.path) as f:
+            with self.assertRaises(ValueError):
+                driveami.load_listing(
+                    f, expected_datatype=driveami.Datatype.ami_la_raw)
+
+    def test_flushed_per_record(self):
+        writer = driveami.ListingWriter.open(
+            self.path, driveami.Datatype.ami_la_calibrated)
+        self.addCleanup(writer.close)
+        writer.write('foo1', self.testdata['foo1'])
+        with open(self.path) as f:
+            listing, _ = driveami.load_listing(f)
+        self.assertEqual(listing, {'foo1': {'bar': 'baz1'}})
+
+    def test_append(self):
+        self.write()
+        self.testdata = {'foo3': {'bar': 'baz3'}}
+        self.write(append=True)
+        with open(self.path) as f:
+            datatype, records = driveami.iter_listing(f)
+            self.assertEqual([key for key, _ in records],
+                             ['foo1', 'foo2', 'foo3'])
+        with self.assertRaises(ValueError):
+            self.write(datatype=driveami.Datatype.ami_la_raw, append=True)
+
+    def test_truncated_final_record(self):
+        self.write()
+        with open(self.path, 'a') as f:
+            f.write('{"foo3": {"ba')
+        with open(self.path) as f:
+            listing, _ = driveami.load_listing(f)
+        self.assertEqual(listing, self.testdata)
+
+    def test_append_after_truncated_record(self):
+        self.write()
+        with open(self.path, 'a') as f:
+            f.write('{"foo3": {"ba')
+        self.testdata = {'foo4': {'bar': 'baz4'}}
+        self.write(append=True, sync=True)
+        with open(self.path) as f:
+            listing, _ = driveami.load_listing(f)
+        self.assertEqual(sorted(listing), ['foo1', 'foo2', 'foo4'])
@@ -0,0 +1,145 @@
+from unittest import TestCase
+from datetime import datetime
+import json
+import os
+import shutil
+import tempfile
+
+import driveami
+import driveami.keys as keys
+from driveami.reduce import RaDecPair
+from driveami.store import is_store
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+
+def file_info(ra, dec, mjd, calibrator='3C286'):
+    return {
+        keys.pointing_degrees: RaDecPair(ra, dec),
+        keys.calibrator: calibrator,
+        keys.time_mjd: (mjd, mjd + 0.05),
+        keys.time_ut: (datetime(2014, 3, 5, 13, 55, 49),
+                       datetime(2014, 3, 5, 15, 0, 50)),
+    }
+
+
+class TestListingStore(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tempdir, 'listings.db')
+        self.store = driveami.ListingStore(self.db_path)
+        self.files = {
+            'SWIFT_590206-140305.raw': file_info(233.9, 23.4, 56721.58),
+            'SWIFT_590206-140306.raw': file_info(233.9, 23.5, 56722.58),
+            'GRB_1234-140310.raw': file_info(10.0, -45.0, 56726.1, '3C48'),
+        }
+        self.groups = {
+            'SWIFT_590206': {keys.files: ['SWIFT_590206-140305.raw',
+                                          'SWIFT_590206-140306.raw'],
+                             keys.target_pointing_deg: [233.9, 23.45]},
+            'GRB_1234': {keys.files: ['GRB_1234-140310.raw'],
+                         keys.target_pointing_deg: [10.0, -45.0]},
+        }
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_files(self):
+        self.store.put_files(self.files)
+        info = self.store.get_file('SWIFT_590206-140305.raw')
+        self.assertEqual(info[keys.pointing_degrees], RaDecPair(233.9, 23.4))
+        self.assertEqual(info[keys.time_ut],
+                         self.files['SWIFT_590206-140305.raw'][keys.time_ut])
+        self.assertEqual(sorted(self.store.files(target_id='SWIFT_590206')),
+                         ['SWIFT_590206-140305.raw',
+                          'SWIFT_590206-140306.raw'])
+        self.assertEqual(list(self.store.files(calibrator='3C48')),
+                         ['GRB_1234-140310.raw'])
+        self.assertIsNone(self.store.get_file('missing.raw'))
+
+    def test_query_files(self):
+        self.store.put_files(self.files)
+        self.assertEqual(self.store.query_files(cone=(233.9, 23.42, 0.05)),
+                         ['SWIFT_590206-140305.raw'])
+        self.assertEqual(self.store.query_files(cone=(234.0, 23.45, 0.5)),
+                         ['SWIFT_590206-140305.raw',
+                          'SWIFT_590206-140306.raw'])
+        self.assertEqual(
+            self.store.query_files(cone=(234.0, 23.45, 0.5),
+                                   mjd_range=(56722.6, 56730)),
+            ['SWIFT_590206-140306.raw'])
+        self.assertEqual(self.store.query_files(mjd_range=(56726, 56727),
+                                                calibrator='3C48'),
+                         ['GRB_1234-140310.raw'])
+
+    def test_groups(self):
+        self.store.put_groups('target_id', self.groups)
+        self.assertEqual(self.store.groupings(), ['target_id'])
+        self.assertEqual(self.store.group_names('target_id'),
+                         ['GRB_1234', 'SWIFT_590206'])
+        self.assertEqual(self.store.groups('target_id', names=['GRB_1234']),
+                         {'GRB_1234': self.groups['GRB_1234']})
+        self.assertEqual(self.store.groups_containing('target_id', 'swift_'),
+                         ['SWIFT_590206'])
+        # ('_' is matched literally, not as a wildcard)
+        self.assertEqual(self.store.groups_containing('target_id', 'GRB_1'),
+                         ['GRB_1234'])
+        self.assertEqual(self.store.groups_containing('target_id', 'GRBX1'),
+                         [])
+        self.assertEqual(self.store.groups_for_file('GRB_1234-140310.raw'),
+                         [('target_id', 'GRB_1234')])
+
+        # Re-storing a grouping replaces it:
+        del self.groups['GRB_1234']
+        self.store.put_groups('target_id', self.groups)
+        self.assertEqual(self.store.group_names('target_id'),
+                         ['SWIFT_590206'])
+        self.assertEqual(self.store.groups_for_file('GRB_1234-140310.raw'),
+                         [])
+
+    def test_import_export(self):
+        listing_path = os.path.join(self.tempdir, 'by_id.json')
+        with open(listing_path, 'w') as f:
+            driveami.save_rawfile_listing(self.groups, f)
+        with open(listing_path) as f:
+            self.assertEqual(self.store.import_listing(f, 'target_id'), 2)
+
+        calibrated = dict(
+            (name, driveami.make_serializable(info))
+            for name, info in self.files.items())
+        calibrated['GRB_1234-140310.raw'][keys.group_name] = 'GRB_1234'
+        cal_path = os.path.join(self.tempdir, 'calibrated.jsonl')
+        with driveami.ListingWriter.open(
+                cal_path, driveami.Datatype.ami_la_calibrated) as writer:
+            for name in sorted(calibrated):
+                writer.write(name, calibrated[name])
+        with open(cal_path) as f:
+            self.store.import_listing(f)
+        self.assertEqual(list(self.store.calibrated(group_name='GRB_1234')),
+                         ['GRB_1234-140310.raw'])
+        self.assertEqual(self.store.query_calibrated(cone=(10., -45., 0.1)),
+                         ['GRB_1234-140310.raw'])
+
+        export_path = os.path.join(self.tempdir, 'exported.json')
+        with open(export_path, 'w') as f:
+            self.store.export_groups(f, 'target_id')
+        with open(export_path) as f:
+            groups, datatype = driveami.load_listing(f)
+        self.assertEqual(datatype, driveami.Datatype.ami_la_raw)
+        self.assertEqual(groups, self.groups)
+
+        with open(export_path, 'w') as f:
+            self.store.export_calibrated(f, jsonl=True)
+        with open(export_path) as f:
+            exported, _ = driveami.load_listing(f)
+        self.assertEqual(exported, json.loads(json.dumps(calibrated)))
+
+    def test_is_store(self):
+        listing_path = os.path.join(self.tempdir, 'by_id.json')
+        with open(listing_path, 'w') as f:
+            driveami.save_rawfile_listing(self.groups, f)
+        self.store.put_groups('target_id', self.groups)
+        self.assertTrue(is_store(self.db_path))
+        self.assertFalse(is_store(listing_path))
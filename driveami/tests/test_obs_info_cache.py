@@ -0,0 +1,70 @@
+from unittest import TestCase
+from datetime import datetime
+import os
+import shutil
+import tempfile
+import time
+
+import driveami
+import driveami.keys as keys
+from driveami.reduce import RaDecPair
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestObsInfoCache(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.rawfile = os.path.join(self.tempdir, 'SWIFT_590206-140305.raw')
+        with open(self.rawfile, 'w') as f:
+            f.write('rawdata')
+        self.info = {
+            keys.comment: 'A comment',
+            keys.command_timings: [{'command': 'version', 'seconds': 0.1,
+                                    'output_bytes': 42}],
+            keys.raster: False,
+            keys.pointing_hms_dms: RaDecPair('12:34:56.7', '+12:34:56'),
+            keys.pointing_degrees: RaDecPair(188.73, 12.58),
+            keys.calibrator: '3C286',
+            keys.field: 'SWIFT_590206',
+            keys.time_st: ('01:02:03', '02:03:04'),
+            keys.time_mjd: (56721.58, 56721.62),
+            keys.time_ut: (datetime(2014, 3, 5, 13, 55, 49),
+                           datetime(2014, 3, 5, 15, 0, 50)),
+            keys.duration: 1.08361,
+        }
+        self.cache = driveami.ObsInfoCache(
+            os.path.join(self.tempdir, 'cache', 'info.sqlite'))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_roundtrip(self):
+        self.assertIsNone(self.cache.get(self.rawfile))
+        self.cache.put(self.rawfile, self.info)
+        cached = self.cache.get(self.rawfile)
+        expected = self.info.copy()
+        expected.pop(keys.comment)
+        expected.pop(keys.command_timings)
+        self.assertEqual(cached, expected)
+        self.assertIsInstance(cached[keys.pointing_degrees], RaDecPair)
+
+    def test_persists(self):
+        self.cache.put(self.rawfile, self.info)
+        self.cache.close()
+        self.cache = driveami.ObsInfoCache(self.cache.db_path)
+        self.assertIsNotNone(self.cache.get(self.rawfile))
+
+    def test_changed_file_invalidates(self):
+        self.cache.put(self.rawfile, self.info)
+        with open(self.rawfile, 'a') as f:
+            f.write('more rawdata')
+        self.assertIsNone(self.cache.get(self.rawfile))
+
+    def test_touched_file_invalidates(self):
+        self.cache.put(self.rawfile, self.info)
+        later = time.time() + 60
+        os.utime(self.rawfile, (later, later))
+        self.assertIsNone(self.cache.get(self.rawfile))
@@ -0,0 +1,83 @@
+from unittest import TestCase
+
+import driveami
+import driveami.keys as keys
+import driveami.parsing as parsing
+from driveami.parsing import LineMetric, OutputParser
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+filler = '\r\n'.join('  sample {:5d}  amp {:.3f}'.format(i, i * 0.01)
+                     for i in range(50))
+
+
+def command_output(*lines):
+    return '\r\n'.join((filler,) + lines + (filler,))
+
+
+class TestOutputParsing(TestCase):
+    def setUp(self):
+        # Parsing doesn't touch the reduce child, so skip spawning one:
+        self.reduce = driveami.Reduce.__new__(driveami.Reduce)
+        self.reduce.output_parser = parsing.default_parser
+        self.reduce.active_file = 'SWIFT_590206-140305.raw'
+        self.reduce.files = {self.reduce.active_file: {}}
+        self.info = self.reduce.files[self.reduce.active_file]
+
+    def parse(self, command, output):
+        self.reduce._parse_command_output(command, output)
+        return self.reduce.last_output_metrics
+
+    def test_flagging(self):
+        self.parse('flag all', command_output(
+            ' Total of  1234 samples flagged ( 5.00% )'))
+        self.assertEqual(self.info[keys.flagged_max], 5.0)
+        metrics = self.parse(r'show flagging no yes \ ', command_output(
+            ' 1000 samples flagged in baseline 3 ( 1.00% )',
+            ' Total of  2345 samples flagged ( 3.50% )'))
+        self.assertEqual(metrics['flagging'], 3.5)
+        self.assertEqual(self.info[keys.flagged_max], 5.0)
+
+    def test_rain_and_noise(self):
+        self.parse(r'apply rain \ ', command_output(
+            ' Mean amplitude correction factor  1.0213'))
+        self.assertEqual(self.info[keys.rain], 1.0213)
+        self.parse(r'reweight \ ', command_output(
+            ' Overall estimated noise  0.00123 Jy'))
+        self.assertEqual(self.info[keys.est_noise_jy], 0.00123)
+        with self.assertRaises(ValueError):
+            self.parse(r'reweight \ ', command_output())
+
+    def test_cal_inter(self):
+        self.parse(r'cal inter \ ', command_output(
+            ' Nearest flux cal 3C286 obs at 1.25 days apart',
+            ' Nearest flux cal 3C286 obs at 0.83 days apart'))
+        self.assertEqual(self.info[keys.archive_cal_available], True)
+        self.assertEqual(self.info[keys.archive_cal_days_apart], 0.83)
+        self.parse(r'cal inter \ ', command_output(
+            ' fluxes for this source not available'))
+        self.assertEqual(self.info[keys.archive_cal_available], False)
+        self.assertIsNone(self.info[keys.archive_cal_days_apart])
+
+    def test_incomplete(self):
+        self.parse(r'file SWIFT_590206-140305.raw \ ', command_output())
+        self.assertFalse(self.reduce._is_incomplete())
+        self.parse(r'file SWIFT_590206-140305.raw \ ', command_output(
+            ' *** incomplete observation ***'))
+        self.assertTrue(self.reduce._is_incomplete())
+
+    def test_unrelated_command(self):
+        self.assertEqual(self.parse(r'smooth 20 \ ', command_output()), {})
+        self.assertEqual(self.info, {})
+
+    def test_registered_metric(self):
+        parser = OutputParser([parsing.flagging])
+        parser.register(LineMetric(
+            'n_baselines', command='show base', pattern=r'(\d+) baselines',
+            extract=lambda m, line: int(m.group(1)), mode='last'))
+        output = command_output(' 45 baselines', ' 43 baselines')
+        self.assertEqual(parser.parse('show base', output),
+                         {'n_baselines': 43})
+        self.assertEqual(parser.parse('flag all', output),
+                         {'flagging': None})
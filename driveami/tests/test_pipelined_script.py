@@ -0,0 +1,76 @@
+import driveami
+import driveami.keys as keys
+from driveami.testing import FakeRootdirTestCase
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+script = r"""
+flag all
+apply rain \
+smooth 20 \
+reweight \
+flag all
+"""
+
+
+class TestPipelinedScript(FakeRootdirTestCase):
+    config = dict(n_files=1, n_targets=1, output_lines=5)
+    rawfile = 'FAKE0000-000000.raw'
+
+    def spawn_logged(self, pipelined, hooks=None):
+        r = self.spawn(pipelined=pipelined, hooks=hooks)
+        r.set_active_file(self.rawfile)
+        r.log, r.cmd_log = self.capture_file_logs(r)
+        return r
+
+    def test_matches_lockstep(self):
+        lockstep = self.spawn_logged(pipelined=False)
+        lockstep.run_script(script)
+        pipelined = self.spawn_logged(pipelined=True)
+        pipelined.pipeline_depth = 3
+        pipelined.run_script(script)
+        self.assertEqual(pipelined.cmd_log.messages,
+                         lockstep.cmd_log.messages)
+        self.assertEqual(pipelined.log.messages, lockstep.log.messages)
+        info = pipelined.files[pipelined.active_file]
+        lockstep_info = lockstep.files[lockstep.active_file]
+        self.assertEqual(
+            [t['command'] for t in info.pop(keys.command_timings)],
+            [t['command'] for t in lockstep_info.pop(keys.command_timings)])
+        self.assertEqual(info, lockstep_info)
+        self.assertEqual(info[keys.est_noise_jy], 0.00123)
+
+    def test_falls_back_to_lockstep_on_error(self):
+        hooks = driveami.HookRegistry()
+        r = self.spawn_logged(pipelined=True, hooks=hooks)
+        r.pipeline_depth = 3
+        events = []
+
+        def on_before_command(session, command):
+            events.append(('send', command))
+
+        def on_after_command(session, command, seconds, output_bytes):
+            events.append(('done', command))
+
+        hooks.register('before_command', on_before_command)
+        hooks.register('after_command', on_after_command)
+        r.run_script('flag all\nsmooth 20 \\\nbogus\napply rain \\\n'
+                     'reweight \\\nscan dat cal yes \\')
+        self.assertEqual(events, [
+            ('send', 'flag all'),
+            ('send', 'smooth 20 \\'),
+            ('send', 'bogus'),
+            ('done', 'flag all'),
+            ('send', 'apply rain \\'),
+            ('done', 'smooth 20 \\'),
+            ('send', 'reweight \\'),
+            # Nothing more is sent ahead once the error is seen:
+            ('done', 'bogus'),
+            ('done', 'apply rain \\'),
+            ('done', 'reweight \\'),
+            ('send', 'scan dat cal yes \\'),
+            ('done', 'scan dat cal yes \\'),
+        ])
+        self.assertEqual(len(r.cmd_log.messages), 6)
+        self.assertEqual(r.files[r.active_file][keys.est_noise_jy], 0.00123)
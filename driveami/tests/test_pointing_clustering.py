@@ -0,0 +1,188 @@
+from unittest import TestCase
+import time
+from StringIO import StringIO
+
+import numpy as np
+from astropy.coordinates import SkyCoord
+
+import driveami
+import driveami.keys as keys
+from driveami.reduce import RaDecPair
+from driveami.pointing import friends_of_friends, neighbour_pairs, UnionFind
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+
+def brute_force_clusters(ra, dec, tolerance_deg):
+    coords = SkyCoord(ra, dec, unit='deg')
+    i, j = np.triu_indices(len(ra), k=1)
+    separations = coords[i].separation(coords[j]).degree
+    uf = UnionFind(len(ra))
+    for close in np.nonzero(separations < tolerance_deg)[0]:
+        uf.union(int(i[close]), int(j[close]))
+    return uf.clusters()
+
+
+class TestFriendsOfFriends(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        # Clumps of pointings, including some straddling RA=0 and the pole:
+        centres = [(0.1, 10.), (359.9, 10.2), (120., 45.), (200., 89.8),
+                   (20., 89.9), (300., -30.)]
+        ra, dec = [], []
+        for c_ra, c_dec in centres:
+            ra.extend((c_ra + rng.normal(scale=0.3, size=30)) % 360.)
+            dec.extend(np.clip(c_dec + rng.normal(scale=0.3, size=30),
+                               -90., 90.))
+        self.ra, self.dec = np.array(ra), np.array(dec)
+
+    def test_matches_brute_force(self):
+        for tolerance in (0.05, 0.2, 0.5, 1.0):
+            self.assertEqual(
+                friends_of_friends(self.ra, self.dec, tolerance),
+                brute_force_clusters(self.ra, self.dec, tolerance))
+
+    def test_neighbour_separations(self):
+        i, j, sep = neighbour_pairs(self.ra, self.dec, 0.5)
+        self.assertTrue(np.all(i < j))
+        coords = SkyCoord(self.ra, self.dec, unit='deg')
+        expected = coords[i].separation(coords[j]).degree
+        self.assertTrue(np.allclose(sep, expected, atol=1e-8))
+
+    def test_single_position(self):
+        self.assertEqual(friends_of_friends([10.], [10.], 0.5), [[0]])
+
+    def test_large_input(self):
+        rng = np.random.RandomState(1)
+        n = 100000
+        ra = rng.uniform(0, 360, size=n)
+        dec = np.degrees(np.arcsin(rng.uniform(-1, 1, size=n)))
+        start = time.time()
+        clusters = friends_of_friends(ra, dec, 0.1)
+        self.assertLess(time.time() - start, 30)
+        self.assertEqual(sum(len(c) for c in clusters), n)
+
+
+class TestGroupTargetIdsByPointing(TestCase):
+    def test_group_keys_and_files(self):
+        id_groups = {
+            'B': {keys.files: ['B-1.raw'], keys.target_pointing_deg: (10., 10.)},
+            'A': {keys.files: ['A-1.raw', 'A-2.raw'],
+                  keys.target_pointing_deg: (10.3, 10.)},
+            'C': {keys.files: ['C-1.raw'], keys.target_pointing_deg: (10.6, 10.)},
+            'D': {keys.files: ['D-1.raw'], keys.target_pointing_deg: (50., 10.)},
+        }
+        # Grouping doesn't touch the reduce child, so skip spawning one:
+        reduce = driveami.Reduce.__new__(driveami.Reduce)
+        groups = reduce.group_target_ids_by_pointing(id_groups, 0.5)
+        self.assertEqual(sorted(groups.keys()), ['A', 'D'])
+        self.assertEqual(groups['A'][keys.files],
+                         ['A-1.raw', 'A-2.raw', 'B-1.raw', 'C-1.raw'])
+        self.assertEqual(groups['A'][keys.target_pointing_deg], (10.3, 10.))
+
+
+class TestPointingTree(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(7)
+        ra = rng.uniform(10, 20, size=300)
+        dec = rng.uniform(-5, 5, size=300)
+        self.id_groups = {}
+        for idx in range(len(ra)):
+            target_id = 'TARGET{:03d}'.format(idx)
+            self.id_groups[target_id] = {
+                keys.files: [target_id + '-140305.raw'],
+                keys.target_pointing_deg: (ra[idx], dec[idx])}
+        self.tree = driveami.PointingTree.build(self.id_groups,
+                                                max_tolerance_deg=1.0)
+        self.reduce = driveami.Reduce.__new__(driveami.Reduce)
+
+    def test_matches_direct_grouping(self):
+        for tolerance in (0.1, 0.25, 0.5, 1.0):
+            self.assertEqual(
+                self.tree.group(self.id_groups, tolerance),
+                self.reduce.group_target_ids_by_pointing(self.id_groups,
+                                                         tolerance))
+
+    def test_group_by_tolerances(self):
+        groups = self.tree.group_by_tolerances(self.id_groups, [0.1, 0.5])
+        self.assertEqual(sorted(groups.keys()), [0.1, 0.5])
+        self.assertGreater(len(groups[0.1]), len(groups[0.5]))
+
+    def test_tolerance_too_large(self):
+        with self.assertRaises(ValueError):
+            self.tree.clusters(2.0)
+
+    def test_save_load(self):
+        s = StringIO()
+        driveami.save_pointing_tree(self.tree, s)
+        tree = driveami.load_pointing_tree(StringIO(s.getvalue()))
+        self.assertEqual(tree.group(self.id_groups, 0.5),
+                         self.tree.group(self.id_groups, 0.5))
+
+
+class TestIncrementalGrouping(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        n = 200
+        ra = rng.uniform(10, 14, size=n)
+        dec = rng.uniform(-2, 2, size=n)
+        self.all_id_groups = {}
+        for idx in range(n):
+            target_id = 'TARGET{:03d}'.format(idx)
+            self.all_id_groups[target_id] = {
+                keys.files: [target_id + '-140305.raw'],
+                keys.target_pointing_deg: (ra[idx], dec[idx])}
+        self.new_ids = ['TARGET{:03d}'.format(idx) for idx in (5, 77, 150)]
+        self.id_groups = dict((k, v) for k, v in self.all_id_groups.items()
+                              if k not in self.new_ids)
+
+    def test_tree_update_matches_rebuild(self):
+        tree = driveami.PointingTree.build(self.id_groups, 0.5)
+        tree.update(self.all_id_groups, self.new_ids)
+        # Move an existing pointing, too:
+        moved = dict(self.all_id_groups)
+        moved['TARGET010'] = {keys.files: ['TARGET010-140305.raw'],
+                              keys.target_pointing_deg: (13.9, -1.9)}
+        tree.update(moved, ['TARGET010'])
+        rebuilt = driveami.PointingTree.build(moved, 0.5)
+        for tolerance in (0.1, 0.3, 0.5):
+            self.assertEqual(tree.group(moved, tolerance),
+                             rebuilt.group(moved, tolerance))
+
+    def test_merge_keeps_keys(self):
+        tree = driveami.PointingTree.build(self.id_groups, 0.5)
+        previous = tree.group(self.id_groups, 0.2)
+        tree.update(self.all_id_groups, self.new_ids)
+        merged = driveami.merge_pointing_groups(previous, self.all_id_groups,
+                                                tree, 0.2)
+        full = tree.group(self.all_id_groups, 0.2)
+
+        def memberships(groups):
+            return sorted(sorted(g[keys.files]) for g in groups.values())
+
+        # No pointings moved, so nothing would have split:
+        self.assertEqual(memberships(merged), memberships(full))
+        for key, group in previous.items():
+            merged_keys = [k for k, g in merged.items()
+                           if set(group[keys.files]) <= set(g[keys.files])]
+            self.assertEqual(len(merged_keys), 1)
+            self.assertTrue(merged_keys[0] in previous)
+            self.assertLessEqual(merged_keys[0], key)
+
+    def test_update_obs_groups_by_target_id(self):
+        reduce = driveami.Reduce.__new__(driveami.Reduce)
+        reduce.files = {
+            'A-140305.raw': {keys.pointing_degrees: RaDecPair(10., 10.)},
+            'A-140306.raw': {keys.pointing_degrees: RaDecPair(10.2, 10.)},
+            'A-140307.raw': {keys.pointing_degrees: RaDecPair(10.4, 10.)},
+            'B-140305.raw': {keys.pointing_degrees: RaDecPair(20., 10.)},
+        }
+        id_groups = {'A': {keys.files: ['A-140305.raw', 'A-140306.raw'],
+                           keys.target_pointing_deg: (10.1, 10.)}}
+        updated = reduce.update_obs_groups_by_target_id(id_groups)
+        self.assertEqual(updated, set(['A', 'B']))
+        expected = reduce.group_obs_by_target_id()
+        for group in expected.values():
+            group[keys.files].sort()
+        self.assertEqual(id_groups, expected)
@@ -0,0 +1,118 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import driveami
+import driveami.keys as keys
+from driveami.postwrite import PostWritePipeline, check_fits
+from driveami.scripts import standard_legacy_reduction
+from driveami.testing.fakereduce import fits_header
+from driveami.testing import FakeRootdirTestCase
+
+
+class TestCheckFits(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def write(self, data, name='test.fits'):
+        path = os.path.join(self.tempdir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_valid(self):
+        data = fits_header().encode('ascii') + b'\0' * 2880
+        check = check_fits(self.write(data))
+        self.assertTrue(check['verified'])
+        self.assertIsNone(check['problem'])
+        self.assertEqual(check['bytes'], 5760)
+        self.assertEqual(check['sha256'], hashlib.sha256(data).hexdigest())
+
+    def test_problems(self):
+        header = fits_header().encode('ascii')
+        for data, problem in [
+                (b'', 'Empty'),
+                (b'X' * 2880, 'SIMPLE'),
+                (header.replace(b'END ', b'    '), 'END'),
+                (header + b'\0' * 100, 'blocks')]:
+            check = check_fits(self.write(data))
+            self.assertFalse(check['verified'])
+            self.assertIn(problem, check['problem'])
+
+    def test_gzipped(self):
+        data = fits_header().encode('ascii')
+        path = os.path.join(self.tempdir, 'test.fits.gz')
+        with gzip.open(path, 'wb') as f:
+            f.write(data)
+        check = check_fits(path)
+        self.assertTrue(check['verified'])
+        self.assertEqual(check['bytes'], 2880)
+
+
+class TestPostWriteErrors(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def test_unreadable_uvfits(self):
+        truncated = os.path.join(self.tempdir, 'cal.fits.gz')
+        with gzip.open(truncated, 'wb') as f:
+            f.write(fits_header().encode('ascii') * 4)
+        with open(truncated, 'rb') as f:
+            data = f.read()
+        with open(truncated, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        info = {keys.target_uvfits: os.path.join(self.tempdir, 'missing.fits'),
+                keys.cal_uvfits: truncated}
+        done = {}
+        with PostWritePipeline(compress=True) as post_write:
+            post_write.submit('TEST-000000.raw', info,
+                              on_done=done.__setitem__)
+        self.assertEqual(list(done), ['TEST-000000.raw'])
+        for info_key in (keys.target_uvfits, keys.cal_uvfits):
+            check = info[keys.uvfits_checks][info_key]
+            self.assertFalse(check['verified'])
+            self.assertIn('Error', check['problem'])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tempdir, 'missing.fits.gz.tmp')))
+
+
+class TestPostWritePipeline(FakeRootdirTestCase):
+    config = dict(n_files=2, n_targets=1)
+
+    def test_compress(self):
+        r = self.spawn()
+        manifest = driveami.ResultManifest.for_output_dir(self.output_dir)
+        done = {}
+        with PostWritePipeline(compress=True) as post_write:
+            for rawfile in sorted(r.files):
+                info = driveami.process_rawfile(
+                    rawfile, self.output_dir, r, standard_legacy_reduction,
+                    file_logging=False, manifest=manifest)
+                post_write.submit(rawfile, info, output_dir=self.output_dir,
+                                  on_done=done.__setitem__)
+        self.assertEqual(sorted(done), sorted(r.files))
+        info = done['FAKE0000-000000.raw']
+        for info_key in (keys.target_uvfits, keys.cal_uvfits):
+            check = info[keys.uvfits_checks][info_key]
+            self.assertTrue(check['verified'])
+            self.assertEqual(check['bytes'], 2880)
+            self.assertTrue(info[info_key].endswith('.fits.gz'))
+            self.assertEqual(check['compressed_bytes'],
+                             os.path.getsize(info[info_key]))
+            self.assertFalse(os.path.exists(info[info_key][:-len('.gz')]))
+
+        # The saved info matches, so the manifest still finds it current:
+        with open(os.path.join(self.output_dir,
+                               'FAKE0000-000000.json')) as f:
+            self.assertEqual(json.load(f)[keys.uvfits_checks],
+                             info[keys.uvfits_checks])
+        rerun = driveami.process_rawfile(
+            'FAKE0000-000000.raw', self.output_dir, r,
+            standard_legacy_reduction, file_logging=False, manifest=manifest)
+        self.assertEqual(rerun[keys.target_uvfits], info[keys.target_uvfits])
@@ -0,0 +1,132 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from astropy.coordinates import SkyCoord
+
+import driveami
+import driveami.keys as keys
+from driveami.index import load_or_build_index
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestRawfileIndex(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(11)
+        n = 2000
+        self.ra = rng.uniform(0, 360, size=n)
+        self.dec = np.degrees(np.arcsin(rng.uniform(-1, 1, size=n)))
+        self.start = rng.uniform(56000, 56100, size=n)
+        self.end = self.start + rng.uniform(0.01, 0.5, size=n)
+        self.filenames = ['OBS{:04d}-140305.raw'.format(i) for i in range(n)]
+        self.listing = {}
+        for i, fname in enumerate(self.filenames):
+            self.listing[fname] = {
+                keys.pointing_degrees: [self.ra[i], self.dec[i]],
+                keys.time_mjd: [self.start[i], self.end[i]]}
+        self.listing['NOINFO-140305.raw'] = {}
+        self.index = driveami.RawfileIndex.from_listing(self.listing)
+        self.coords = SkyCoord(self.ra, self.dec, unit='deg')
+
+    def brute_force_cone(self, ra, dec, radius):
+        seps = self.coords.separation(SkyCoord(ra, dec, unit='deg')).degree
+        return sorted(self.filenames[i] for i in np.nonzero(seps <= radius)[0])
+
+    def brute_force_overlap(self, mjd_min, mjd_max):
+        overlaps = (self.start <= mjd_max) & (self.end >= mjd_min)
+        return sorted(self.filenames[i] for i in np.nonzero(overlaps)[0])
+
+    def test_cone_search_matches_brute_force(self):
+        # Include searches straddling RA=0 and the poles:
+        for ra, dec, radius in [(0.2, 5., 8.), (180., -30., 5.),
+                                (90., 88., 6.), (270., -89.5, 4.)]:
+            self.assertEqual(self.index.cone_search(ra, dec, radius),
+                             self.brute_force_cone(ra, dec, radius))
+
+    def test_time_overlap_matches_brute_force(self):
+        for mjd_min, mjd_max in [(56010., 56010.), (56050.2, 56051.),
+                                 (55000., 55001.)]:
+            self.assertEqual(self.index.time_overlap(mjd_min, mjd_max),
+                             self.brute_force_overlap(mjd_min, mjd_max))
+
+    def test_combined_query(self):
+        cone = (100., 20., 20.)
+        mjd_range = (56020., 56040.)
+        expected = sorted(set(self.brute_force_cone(*cone)) &
+                          set(self.brute_force_overlap(*mjd_range)))
+        self.assertEqual(self.index.query(cone=cone, mjd_range=mjd_range),
+                         expected)
+        self.assertEqual(self.index.query(), sorted(self.filenames))
+
+    def test_large_listing_query_speed(self):
+        rng = np.random.RandomState(5)
+        n = 100000
+        ra = rng.uniform(0, 360, size=n)
+        dec = np.degrees(np.arcsin(rng.uniform(-1, 1, size=n)))
+        start = rng.uniform(56000, 57000, size=n)
+        index = driveami.RawfileIndex(np.arange(n).astype(str), ra, dec,
+                                      start, start + 0.2)
+        t0 = time.time()
+        for _ in range(100):
+            index.query(cone=(120., 30., 0.3), mjd_range=(56500., 56510.))
+        self.assertLess((time.time() - t0) / 100, 0.05)
+
+
+class TestIndexPersistence(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.listing_path = os.path.join(self.tempdir, 'rawfiles_metadata.json')
+        self.listing = {
+            'A-140305.raw': {keys.pointing_degrees: [10., 10.],
+                             keys.time_mjd: [56721.58, 56721.62]},
+            'B-140306.raw': {keys.pointing_degrees: [10.1, 10.],
+                             keys.time_mjd: [56722.58, 56722.62]},
+        }
+        self._write_listing()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _write_listing(self):
+        with open(self.listing_path, 'w') as f:
+            driveami.save_rawfile_listing(self.listing, f)
+
+    def test_save_load(self):
+        index = driveami.RawfileIndex.from_listing(self.listing)
+        path = os.path.join(self.tempdir, 'index.npz')
+        index.save(path)
+        loaded = driveami.RawfileIndex.load(path)
+        self.assertEqual(loaded.cone_search(10., 10., 0.5),
+                         ['A-140305.raw', 'B-140306.raw'])
+        self.assertEqual(loaded.time_overlap(56722., 56723.),
+                         ['B-140306.raw'])
+
+    def test_rebuilt_when_listing_newer(self):
+        index = load_or_build_index(self.listing_path)
+        self.assertEqual(index.cone_search(50., 10., 0.5), [])
+        self.listing['C-140307.raw'] = {keys.pointing_degrees: [50., 10.],
+                                        keys.time_mjd: [56723.58, 56723.62]}
+        self._write_listing()
+        index_path = os.path.splitext(self.listing_path)[0] + '_index.npz'
+        past = os.path.getmtime(self.listing_path) - 10
+        os.utime(index_path, (past, past))
+        index = load_or_build_index(self.listing_path)
+        self.assertEqual(index.cone_search(50., 10., 0.5), ['C-140307.raw'])
+
+    def test_custom_index_path(self):
+        index_path = os.path.join(self.tempdir, 'lookup.idx')
+        load_or_build_index(self.listing_path, index_path)
+        self.assertTrue(os.path.isfile(index_path))
+        self.assertFalse(os.path.exists(index_path + '.npz'))
+        # Up to date, so loaded rather than rebuilt:
+        future = int(os.path.getmtime(self.listing_path)) + 10
+        os.utime(index_path, (future, future))
+        index = load_or_build_index(self.listing_path, index_path)
+        self.assertEqual(os.path.getmtime(index_path), future)
+        self.assertEqual(index.cone_search(10., 10., 0.5),
+                         ['A-140305.raw', 'B-140306.raw'])
@@ -0,0 +1,81 @@
+from unittest import TestCase
+from datetime import datetime
+import json
+import os
+import shutil
+import tempfile
+
+import driveami
+import driveami.keys as keys
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestResultManifest(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.rawfile = 'SWIFT_590206-140305.raw'
+        self.rawfile_path = os.path.join(self.tempdir, self.rawfile)
+        with open(self.rawfile_path, 'w') as f:
+            f.write('rawdata')
+        self.output_dir = os.path.join(self.tempdir, 'GROUP', 'ami')
+        os.makedirs(self.output_dir)
+
+        uvfits = os.path.join(self.output_dir, 'SWIFT_590206-140305.fits')
+        with open(uvfits, 'w') as f:
+            f.write('uvfits')
+        self.info = {keys.target_uvfits: uvfits,
+                     keys.time_ut: (datetime(2014, 3, 5, 13, 55, 49),
+                                    datetime(2014, 3, 5, 15, 0, 50))}
+        self.info_file = 'SWIFT_590206-140305.json'
+        with open(os.path.join(self.output_dir, self.info_file), 'w') as f:
+            json.dump(driveami.make_serializable(self.info), f)
+        self.key, self.components = self._key()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _key(self, script='flag all', overrides=None, version='v1'):
+        return driveami.result_key(script, overrides or {}, version,
+                                   self.rawfile_path)
+
+    def _record(self):
+        manifest = driveami.ResultManifest.for_output_dir(self.output_dir)
+        manifest.record(self.rawfile, self.key, self.components,
+                        self.info_file)
+
+    def test_manifest_location(self):
+        self._record()
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.tempdir, 'GROUP', 'ami_manifest.json')))
+
+    def test_current_output_loaded(self):
+        self._record()
+        manifest = driveami.ResultManifest.for_output_dir(self.output_dir)
+        info = manifest.load_if_current(self.rawfile, self.key,
+                                        self.output_dir)
+        self.assertEqual(info, self.info)
+
+    def test_key_changes(self):
+        self.assertNotEqual(self.key, self._key(script='flag none')[0])
+        self.assertNotEqual(self.key,
+                            self._key(overrides={'channels': '3-8'})[0])
+        self.assertNotEqual(self.key, self._key(version='v2')[0])
+        with open(self.rawfile_path, 'a') as f:
+            f.write('more rawdata')
+        self.assertNotEqual(self.key, self._key()[0])
+
+    def test_stale_output_not_loaded(self):
+        self._record()
+        manifest = driveami.ResultManifest.for_output_dir(self.output_dir)
+        new_key = self._key(script='flag none')[0]
+        self.assertIsNone(
+            manifest.load_if_current(self.rawfile, new_key, self.output_dir))
+
+    def test_missing_output_not_loaded(self):
+        self._record()
+        os.remove(self.info[keys.target_uvfits])
+        manifest = driveami.ResultManifest.for_output_dir(self.output_dir)
+        self.assertIsNone(
+            manifest.load_if_current(self.rawfile, self.key, self.output_dir))
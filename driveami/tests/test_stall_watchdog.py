@@ -0,0 +1,56 @@
+import timeit
+
+import pexpect
+
+import driveami
+from driveami.scripts import standard_legacy_reduction
+from driveami.testing import FakeRootdirTestCase, write_config
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestStallWatchdog(FakeRootdirTestCase):
+    config = dict(n_files=4, n_targets=2, output_lines=8,
+                  hang_files=['FAKE0001-000003.raw'])
+
+    def test_stall_caught_early(self):
+        r = self.spawn(stall_timeout=1)
+        r.child.timeout = 60
+        start = timeit.default_timer()
+        with self.assertRaises(driveami.CommandStalled) as context:
+            r.set_active_file('FAKE0001-000003.raw')
+        self.assertLess(timeit.default_timer() - start, 5)
+        self.assertEqual(context.exception.rawfile, 'FAKE0001-000003.raw')
+        self.assertTrue(context.exception.command.startswith('file '))
+        self.assertIsInstance(context.exception, pexpect.TIMEOUT)
+
+    def test_progress_extends_deadline(self):
+        config_path = self.tempdir + '/trickle.json'
+        write_config(config_path, n_files=1, n_targets=1, output_lines=12,
+                     line_latency=0.1)
+        for kwargs in ({}, {'streaming': True}, {'pipelined': True}):
+            r = self.spawn(stall_timeout=1, additional_env_variables={
+                'FAKE_REDUCE_CONFIG': config_path}, **kwargs)
+            r.set_active_file('FAKE0000-000000.raw')
+            # (Each flag command trickles out output for over a second)
+            r.child.timeout = 1
+            r.run_script('flag amp field no 0.95 \\\nflag amp field no 0.9 \\')
+            self.assertIsNotNone(r.files['FAKE0000-000000.raw']
+                                 [driveami.keys.flagged_max])
+
+    def test_supervised_restart(self):
+        restart_log = driveami.RestartLog()
+        session = driveami.SupervisedReduce(
+            driveami.Reduce(self.rootdir, 'legacy', working_dir=self.tempdir,
+                            timeout=10, stall_timeout=1),
+            restart_log)
+        self.addCleanup(session.close)
+        self.assertIsNone(session.process_rawfile(
+            'FAKE0001-000003.raw', self.output_dir,
+            standard_legacy_reduction, file_logging=False))
+        self.assertEqual(restart_log.events[0].reason, 'CommandStalled')
+        self.assertIsNotNone(session.process_rawfile(
+            'FAKE0000-000000.raw', self.output_dir,
+            standard_legacy_reduction, file_logging=False))
+        self.assertEqual(session.reduce.stall_timeout, 1)
@@ -0,0 +1,42 @@
+import driveami.keys as keys
+from driveami.testing import FakeRootdirTestCase
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestStreamingOutput(FakeRootdirTestCase):
+    config = dict(n_files=2, n_targets=1, output_lines=2000)
+
+    def setUp(self):
+        FakeRootdirTestCase.setUp(self)
+        # (Separate rawfiles, so each session has its own file log)
+        self.buffered = self.spawn()
+        self.buffered.set_active_file('FAKE0000-000000.raw')
+        self.buffered_log, _ = self.capture_file_logs(self.buffered)
+        self.streamed = self.spawn(streaming=True)
+        self.streamed.set_active_file('FAKE0000-000001.raw')
+        self.streamed_log, _ = self.capture_file_logs(self.streamed)
+
+    def run_both_modes(self, command):
+        lines = self.buffered.run_command(command)
+        self.assertEqual(self.streamed.run_command(command), [])
+        return (lines, self.buffered.last_output_metrics,
+                self.streamed.last_output_metrics)
+
+    def test_metrics_match_buffered_mode(self):
+        for command in ('flag all', r'apply rain \ '):
+            _, buffered, streamed = self.run_both_modes(command)
+            self.assertEqual(buffered, streamed)
+        info = self.streamed.files[self.streamed.active_file]
+        self.assertEqual(info[keys.flagged_max], 5.0)
+        self.assertEqual(info[keys.rain], 1.0213)
+
+    def test_lines_logged_individually(self):
+        lines, _, _ = self.run_both_modes('flag all')
+        streamed = self.streamed_log.messages
+        self.assertEqual(len(streamed), 2002)
+        self.assertTrue(streamed[0].startswith(self.streamed.prompt))
+        buffered = [l.rstrip('\r') for l in lines if l.strip()]
+        self.assertEqual(streamed,
+                         [self.streamed.prompt + buffered[0]] + buffered[1:])
@@ -0,0 +1,57 @@
+import os
+
+import driveami
+from driveami.scripts import standard_legacy_reduction
+from driveami.supervisor import RestartLog, SupervisedReduce
+from driveami.testing import FakeRootdirTestCase
+
+import logging
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TestSupervisedReduce(FakeRootdirTestCase):
+    config = dict(n_files=6, n_targets=2,
+                  hang_files=['FAKE0001-000001.raw'],
+                  crash_files=['FAKE0000-000002.raw'])
+    rawfiles = ['FAKE0000-000000.raw', 'FAKE0001-000001.raw',
+                'FAKE0000-000002.raw', 'FAKE0001-000003.raw']
+
+    def test_restarts(self):
+        restart_log = RestartLog()
+        session = SupervisedReduce(
+            driveami.Reduce(self.rootdir, 'legacy', working_dir=self.tempdir,
+                            timeout=2),
+            restart_log)
+        self.addCleanup(session.close)
+        processed = []
+        for rawfile in self.rawfiles:
+            info = session.process_rawfile(rawfile, self.output_dir,
+                                           standard_legacy_reduction,
+                                           file_logging=False)
+            if info is not None:
+                processed.append(rawfile)
+        self.assertEqual(processed,
+                         ['FAKE0000-000000.raw', 'FAKE0001-000003.raw'])
+        self.assertEqual([(e.rawfile, e.reason) for e in restart_log.events],
+                         [('FAKE0001-000001.raw', 'TIMEOUT'),
+                          ('FAKE0000-000002.raw', 'EOF')])
+        self.assertGreaterEqual(restart_log.lost_seconds, 2)
+        self.assertEqual(restart_log.summary()['session_restarts'], 2)
+        self.assertTrue(session.reduce.child.isalive())
+
+    def test_pool(self):
+        jobs = [driveami.RawfileJob(rawfile, self.output_dir,
+                                    standard_legacy_reduction, None)
+                for rawfile in self.rawfiles]
+        restart_log = RestartLog()
+        with driveami.ReducePool(2, self.rootdir, 'legacy',
+                                 restart_log=restart_log,
+                                 working_dir=self.tempdir,
+                                 timeout=2) as pool:
+            results = pool.process_rawfiles(jobs, file_logging=False)
+        self.assertEqual(sorted(job.rawfile for job, _ in results),
+                         ['FAKE0000-000000.raw', 'FAKE0001-000003.raw'])
+        self.assertEqual(sorted(restart_log.failed_rawfiles),
+                         ['FAKE0000-000002.raw', 'FAKE0001-000001.raw'])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.output_dir, 'FAKE0001-000003.json')))
@@ -0,0 +1,64 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import timeit
+
+import pexpect
+
+import driveami
+import driveami.keys as keys
+from driveami.scripts import standard_legacy_reduction
+from driveami.testing import FakeRootdirTestCase
+
+
+class TestTimeoutPolicy(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_learned_timeouts(self):
+        policy = driveami.TimeoutPolicy(default_timeout=120, quantile=0.5,
+                                        margin=2., min_timeout=1,
+                                        max_timeout=300, min_samples=3)
+        self.assertEqual(policy.timeout('reweight \\'), 120)
+        for seconds in (9., 10., 11.):
+            policy.observe('reweight \\', seconds, duration_hrs=2.)
+        # 5 seconds per hour of observation, times the margin:
+        self.assertAlmostEqual(policy.timeout('reweight \\', 4.), 40.)
+        # Short (or unknown) durations count as an hour:
+        self.assertAlmostEqual(policy.timeout('reweight \\', 0.25), 10.)
+        self.assertAlmostEqual(policy.timeout('reweight \\'), 10.)
+        self.assertEqual(policy.timeout('reweight \\', 1000.), 300)
+        # Other commands are unaffected:
+        self.assertEqual(policy.timeout('version'), 120)
+
+    def test_persistence(self):
+        path = os.path.join(self.tempdir, 'timeouts.json')
+        policy = driveami.TimeoutPolicy.load(path, max_samples=5)
+        policy.add_file_info({
+            keys.duration: 3.,
+            keys.command_timings: [
+                {'command': 'flag amp field no 0.95 \\', 'seconds': 3.,
+                 'output_bytes': 10}] * 7})
+        policy.save()
+        loaded = driveami.TimeoutPolicy.load(path)
+        self.assertEqual(loaded.latencies, {'flag amp field': [1.] * 5})
+
+
+class TestTimeoutPolicySession(FakeRootdirTestCase):
+    config = dict(n_files=4, n_targets=2, hang_files=['FAKE0001-000003.raw'])
+
+    def test_hang_caught_quickly(self):
+        policy = driveami.TimeoutPolicy(min_timeout=1, min_samples=1)
+        r = self.spawn(timeout_policy=policy)
+        driveami.process_rawfile('FAKE0000-000000.raw', self.output_dir, r,
+                                 standard_legacy_reduction,
+                                 file_logging=False)
+        self.assertIn('file', policy.latencies)
+        start = timeit.default_timer()
+        with self.assertRaises(pexpect.TIMEOUT):
+            r.set_active_file('FAKE0001-000003.raw')
+        self.assertLess(timeit.default_timer() - start, 5)
@@ -0,0 +1,110 @@
+"""
+Per-command timeouts, learned from the command latencies seen in past runs.
+
+A fixed timeout has to cover the slowest command on the longest
+observation, so a session hung on a quick command (e.g. ``version``) takes
+just as long to notice. A :class:`TimeoutPolicy` instead records how long
+each kind of command (see :func:`driveami.metrics.command_key`) takes,
+relative to the duration of the observation being reduced, and sets the
+timeout for each command to a high quantile of its expected time.
+
+E.g.::
+
+    policy = TimeoutPolicy.load('~/.driveami_timeouts.json')
+    r = driveami.Reduce(ami_dir, 'digital', timeout_policy=policy)
+    ...
+    policy.save()
+"""
+from __future__ import absolute_import
+import json
+import os
+import threading
+
+import numpy as np
+
+import driveami.keys as keys
+from driveami.metrics import command_key, _write_atomically
+
+
+class TimeoutPolicy(object):
+    """
+    Learns per-command latencies, scaled by observation duration.
+
+    Latencies are recorded in seconds per hour of observation (observations
+    shorter than an hour, or with no active file, count as an hour). The
+    timeout for a command is the ``quantile`` of its recorded latencies,
+    scaled up to the duration of the current observation, times ``margin``;
+    clipped to ``[min_timeout, max_timeout]``. Until a command has been seen
+    ``min_samples`` times, it gets the ``default_timeout``.
+    """
+
+    def __init__(self, default_timeout=120, quantile=0.99, margin=3.0,
+                 min_timeout=10, max_timeout=3600, min_samples=10,
+                 max_samples=500, path=None):
+        self.default_timeout = default_timeout
+        self.quantile = quantile
+        self.margin = margin
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        # Where the policy is saved to, by default:
+        self.path = path
+        # Seconds per hour of observation, most recent last, by command key:
+        self.latencies = {}
+        # (One policy may be shared by several sessions, e.g. in a pool.)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """
+        Load the latencies saved at ``path`` (if it exists).
+
+        Keyword arguments are passed on to :class:`TimeoutPolicy`.
+        """
+        path = os.path.expanduser(path)
+        policy = cls(path=path, **kwargs)
+        if os.path.exists(path):
+            with open(path) as f:
+                policy.latencies = json.load(f)['latencies']
+        return policy
+
+    def save(self, path=None):
+        if path is None:
+            path = self.path
+        with self._lock:
+            text = json.dumps({'latencies': self.latencies}, sort_keys=True)
+        _write_atomically(path, text)
+
+    @staticmethod
+    def _hours(duration_hrs):
+        return max(duration_hrs or 0., 1.)
+
+    def observe(self, command, seconds, duration_hrs=None):
+        """Record the time taken by ``command``."""
+        key = command_key(command)
+        with self._lock:
+            latencies = self.latencies.setdefault(key, [])
+            latencies.append(seconds / self._hours(duration_hrs))
+            if len(latencies) > self.max_samples:
+                del latencies[:-self.max_samples]
+
+    def add_file_info(self, file_info):
+        """
+        Record the command timings in a rawfile's info dict, e.g. to learn
+        from an existing listing of calibrated files.
+        """
+        for record in file_info.get(keys.command_timings, []):
+            self.observe(record['command'], record['seconds'],
+                         file_info.get(keys.duration))
+
+    def timeout(self, command, duration_hrs=None):
+        """Timeout (in seconds) for ``command``."""
+        with self._lock:
+            latencies = list(self.latencies.get(command_key(command), []))
+        if len(latencies) < self.min_samples:
+            return self.default_timeout
+        expected = (np.percentile(latencies, 100 * self.quantile) *
+                    self._hours(duration_hrs))
+        return float(np.clip(expected * self.margin,
+                             self.min_timeout, self.max_timeout))
@@ -3,7 +3,7 @@
 from setuptools import setup
 import versioneer
 
-requirements = ['pexpect>=4.0.1,<5',
+requirements = ['pexpect>=4.3,<5',
                 'astropy>=1.0,<2',
                 'colorlog',
 ]
@@ -13,10 +13,12 @@ setup(
     name="drive-ami",
     version=versioneer.get_version(),
     cmdclass=versioneer.get_cmdclass(),
-    packages=['driveami'],
+    packages=['driveami', 'driveami.testing'],
     scripts=['bin/driveami_filter_rawfile_listing.py',
              'bin/driveami_list_rawfiles.py',
-             'bin/driveami_calibrate_rawfiles.py'],
+             'bin/driveami_calibrate_rawfiles.py',
+             'bin/driveami_query_rawfiles.py',
+             'bin/driveami_listing_store.py'],
     description="An interface layer for scripting the AMI-Reduce pipeline.",
     author="Tim Staley",
     author_email="timstaley337@gmail.com",